@@ -400,6 +400,52 @@
 # the fields that are being displayed.
 sort_dates_using_visible_fields = False
 
+#: Use an index to speed up searching in large libraries
+# When searching text fields such as title, tags, series or publisher for
+# values that contain the search text, calibre normally checks every value
+# in the field. For very large libraries you can have calibre build an
+# in-memory index for fields that have at least the specified number of
+# values, making such searches much faster at the cost of extra memory. The
+# index is not used for case sensitive searches or for fields that contain
+# long text, such as comments.
+# Default: 0, do not use an index
+# Example: search_index_minimum_size = 20000
+search_index_minimum_size = 0
+
+#: Use less memory for very large libraries
+# calibre keeps the metadata of all books in memory. For very large libraries
+# you can have calibre store numbers, dates and yes/no values more compactly
+# for columns that have at least the specified number of values, and share
+# repeated text values. This reduces memory usage considerably, at the cost of
+# slightly slower access to these values. Changes take effect after a restart.
+# Default: 0, do not use compact storage
+# Example: compact_storage_minimum_size = 100000
+compact_storage_minimum_size = 0
+
+#: Open very large libraries faster
+# When a library with at least the specified number of books is closed,
+# calibre saves a snapshot of the book metadata it has in memory to its cache
+# folder. If the library has not been changed by the time it is next opened,
+# the metadata is loaded from the snapshot, which is much faster than reading
+# it from the database. Snapshots use disk space comparable to the size of the
+# metadata.db file of the library.
+# Default: 0, do not use snapshots
+# Example: library_snapshot_minimum_size = 50000
+library_snapshot_minimum_size = 0
+
+#: Back up metadata of many changed books at a time
+# calibre backs up the metadata of changed books to an OPF file in the folder
+# of each book, one book every couple of seconds. After changing the metadata
+# of a great many books at once, this can keep going for hours. Set
+# metadata_backup_batch_size to back up that many books at a time instead.
+# metadata_backup_books_per_second limits how many books are backed up per
+# second in that case, so that calibre stays responsive. Use 0 for no limit.
+# Changes take effect after a restart.
+# Default: 0, back up one book at a time
+# Example: metadata_backup_batch_size = 200
+metadata_backup_batch_size = 0
+metadata_backup_books_per_second = 100
+
 #: Fuzz value for trimming covers
 # The value used for the fuzz distance when trimming a cover.
 # Colors within this distance are considered equal.
@@ -3,6 +3,7 @@
 
 import os
 import re
+import shutil
 import time
 from collections import defaultdict
 from contextlib import contextmanager, suppress
@@ -201,6 +202,93 @@ def create_format_map(formats):
     return format_map
 
 
+def read_metadata_for_group(paths, group_id, tdir, run_plugins=False):
+    # Usually runs in a worker process, see read_metadata_in_pool()
+    from calibre.ebooks.metadata.meta import metadata_from_formats
+    from calibre.ebooks.metadata.worker import run_import_plugins
+
+    if run_plugins:
+        paths = run_import_plugins(paths, group_id, tdir)
+    return paths, metadata_from_formats(paths)
+
+
+def read_metadata_in_pool(groups, tdir, run_plugins=False, max_in_flight=None, in_process_threshold=8):
+    """
+    Read the metadata, including covers, for groups of formats in a pool of
+    worker processes. groups must be an iterable of (key, paths) pairs.
+    Yields (key, paths, mi) in input order, where paths are the formats after
+    running import plugins (if run_plugins is True) and mi is None if reading
+    metadata failed. At most max_in_flight groups are read ahead of the one
+    being consumed, so memory use is bounded however many groups there are.
+    Any files created by import plugins for a group are deleted once the
+    consumer asks for the next group. If there are no more than
+    in_process_threshold groups, they are read in this process instead, since
+    starting the worker processes would take longer than reading them.
+    """
+    from itertools import chain, islice
+    from queue import Empty
+
+    from calibre.utils.ipc.pool import Failure, Pool
+
+    groups = iter(groups)
+    first = tuple(islice(groups, in_process_threshold + 1))
+    if len(first) <= in_process_threshold:
+        for group_id, (key, paths) in enumerate(first):
+            mi = None
+            try:
+                paths, mi = read_metadata_for_group(paths, group_id, tdir, run_plugins)
+            except Exception:
+                import traceback
+
+                prints('Failed to read metadata from:', *paths)
+                traceback.print_exc()
+            yield key, paths, mi
+            shutil.rmtree(os.path.join(tdir, str(group_id)), ignore_errors=True)
+        return
+    groups = chain(first, groups)
+    pool = Pool(name='ReadMetadata')
+    max_in_flight = max_in_flight or 4 * pool.max_workers
+    pending, results = {}, {}
+    submitted = consumed = 0
+    try:
+        while True:
+            while submitted - consumed < max_in_flight:
+                try:
+                    key, paths = next(groups)
+                except StopIteration:
+                    break
+                pending[submitted] = key, paths
+                pool(submitted, 'calibre.db.adding', 'read_metadata_for_group', paths, submitted, tdir, run_plugins)
+                submitted += 1
+            if consumed >= submitted:
+                break
+            while consumed not in results:
+                try:
+                    worker_result = pool.results.get(True, 0.1)
+                except Empty:
+                    # Jobs queued before a terminal failure never produce results
+                    if pool.failed:
+                        raise Failure(pool.terminal_failure)
+                    continue
+                pool.results.task_done()
+                if worker_result.is_terminal_failure:
+                    raise Failure(pool.terminal_failure)
+                results[worker_result.id] = worker_result.result
+            result = results.pop(consumed)
+            key, paths = pending.pop(consumed)
+            mi = None
+            if result.err:
+                prints('Failed to read metadata from:', *paths)
+                prints(result.traceback)
+            else:
+                paths, mi = result.value
+            yield key, paths, mi
+            shutil.rmtree(os.path.join(tdir, str(consumed)), ignore_errors=True)
+            consumed += 1
+    finally:
+        pool.shutdown()
+
+
 def import_book_directory_multiple(db, dirpath, callback=None, added_ids=None, compiled_rules=(), add_duplicates=False):
     from calibre.ebooks.metadata.meta import metadata_from_formats
 
@@ -245,22 +333,53 @@ def import_book_directory(db, dirpath, callback=None, added_ids=None, compiled_r
 
 
 def recursive_import(db, root, single_book_per_directory=True, callback=None, added_ids=None, compiled_rules=(), add_duplicates=False):
+    from calibre.ptempfile import TemporaryDirectory
+
     root = os.path.abspath(root)
     duplicates = []
-    for dirpath in os.walk(root):
-        func = import_book_directory if single_book_per_directory else import_book_directory_multiple
-        res = func(
-            db,
-            dirpath[0],
-            callback=callback,
-            added_ids=added_ids,
-            compiled_rules=compiled_rules,
-            add_duplicates=add_duplicates,
-        )
-        if res is not None:
-            duplicates.extend(res)
-        if callable(callback):
-            if callback(''):
+
+    dir_sizes, consumed = [], defaultdict(int)
+    dirs_done = 0
+    cancelled = False
+
+    def finish_dirs():
+        # Report every directory whose books have all been added, including
+        # directories with no books, so that callers can show progress and
+        # cancel the import
+        nonlocal dirs_done, cancelled
+        while not cancelled and dirs_done < len(dir_sizes) and consumed[dirs_done] >= dir_sizes[dirs_done]:
+            dirs_done += 1
+            if callable(callback) and callback(''):
+                cancelled = True
+        return cancelled
+
+    def groups():
+        for dirpath in os.walk(root):
+            dir_num, num = len(dir_sizes), 0
+            for formats in find_books_in_directory(dirpath[0], single_book_per_directory, compiled_rules=compiled_rules):
+                yield dir_num, formats
+                num += 1
+            dir_sizes.append(num)
+            if finish_dirs():
+                break
+
+    # Metadata is read in parallel in worker processes, the books are added
+    # in the order they were found
+    with TemporaryDirectory('recursive-import') as tdir:
+        for dir_num, formats, mi in read_metadata_in_pool(groups(), tdir):
+            if cancelled:
+                break
+            if mi is not None and mi.title is not None:
+                ids, dups = db.new_api.add_books([(mi, create_format_map(formats))], add_duplicates=add_duplicates)
+                if dups:
+                    duplicates.append((mi, formats))
+                else:
+                    if added_ids is not None:
+                        added_ids.add(next(iter(ids)))
+                    if callable(callback) and callback(mi.title):
+                        break
+            consumed[dir_num] += 1
+            if finish_dirs():
                 break
     return duplicates
 
@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+# License: GPLv3 Copyright: 2026, Kovid Goyal <kovid at kovidgoyal.net>
+
+"""
+Record how long calls to the locked API methods of
+:class:`calibre.db.cache.Cache` spend waiting for and holding the db lock.
+Enabled by setting the environment variable CALIBRE_DB_API_STATS=1.
+"""
+
+import heapq
+import os
+import sys
+from functools import wraps
+from threading import Lock
+from time import monotonic
+
+from calibre.db.locking import DowngradeLockError
+
+NUM_SLOWEST_CALLERS = 5
+
+
+def api_stats_enabled():
+    return os.environ.get('CALIBRE_DB_API_STATS') == '1'
+
+
+class MethodStats:
+    __slots__ = ('calls', 'hold_time', 'max_hold', 'max_wait', 'slowest', 'wait_time')
+
+    def __init__(self):
+        self.calls = 0
+        self.wait_time = self.hold_time = self.max_wait = self.max_hold = 0.0
+        self.slowest = []  # min heap of (total, wait, hold, caller)
+
+    def as_dict(self):
+        return {
+            'calls': self.calls,
+            'wait_time': self.wait_time,
+            'hold_time': self.hold_time,
+            'max_wait': self.max_wait,
+            'max_hold': self.max_hold,
+            'slowest_callers': sorted(self.slowest, reverse=True),
+        }
+
+
+def describe_caller(frame):
+    if frame is None:
+        return 'unknown'
+    code = frame.f_code
+    return f'{code.co_filename}:{frame.f_lineno} ({code.co_name})'
+
+
+class ApiStats:
+    def __init__(self):
+        self.lock = Lock()
+        self.methods = {}
+        self.started_at = monotonic()
+
+    def record(self, name, wait, hold, frame):
+        total = wait + hold
+        with self.lock:
+            s = self.methods.get(name)
+            if s is None:
+                s = self.methods[name] = MethodStats()
+            s.calls += 1
+            s.wait_time += wait
+            s.hold_time += hold
+            s.max_wait = max(s.max_wait, wait)
+            s.max_hold = max(s.max_hold, hold)
+            # Only describe the caller for calls that make it into the
+            # slowest list, so that the common case stays cheap
+            if len(s.slowest) < NUM_SLOWEST_CALLERS:
+                heapq.heappush(s.slowest, (total, wait, hold, describe_caller(frame)))
+            elif total > s.slowest[0][0]:
+                heapq.heapreplace(s.slowest, (total, wait, hold, describe_caller(frame)))
+
+    def as_dict(self, reset=False):
+        with self.lock:
+            ans = {
+                'duration': monotonic() - self.started_at,
+                'methods': {name: s.as_dict() for name, s in self.methods.items()},
+            }
+            if reset:
+                self.methods = {}
+                self.started_at = monotonic()
+        return ans
+
+    def wrap(self, lock, func):
+        name = func.__name__
+        record = self.record
+
+        @wraps(func)
+        def call_func_with_lock(*args, **kwargs):
+            start = monotonic()
+            try:
+                lock.acquire()
+            except DowngradeLockError:
+                # We already have an exclusive lock, no need to acquire a
+                # shared lock.
+                acquired = False
+            else:
+                acquired = True
+            locked = monotonic()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                if acquired:
+                    lock.release()
+                record(name, locked - start, monotonic() - locked, sys._getframe(1))
+
+        return call_func_with_lock
@@ -14,6 +14,7 @@
 from contextlib import closing, suppress
 from datetime import datetime
 from functools import partial
+from threading import RLock
 from typing import TYPE_CHECKING, cast
 
 import apsw
@@ -33,6 +34,7 @@
 )
 from calibre.db.errors import NoSuchFormat
 from calibre.db.schema_upgrades import SchemaUpgrade
+from calibre.db.snapshot import db_file_state, read_snapshot, snapshot_path, write_snapshot
 from calibre.db.tables import (
     AuthorsTable,
     CompositeTable,
@@ -544,6 +546,10 @@ def __init__(
         if not os.path.exists(os.path.dirname(self.dbpath)):
             os.makedirs(os.path.dirname(self.dbpath))
 
+        # Used to check that the snapshot of the tables from when the library
+        # was last closed is still valid, see read_tables()
+        self.db_file_state_at_open = db_file_state(self.dbpath)
+        self.snapshot_tables = frozenset()
         self._conn = None
         if self.user_version == 0:
             self.initialize_database()
@@ -1736,21 +1742,113 @@ def last_modified(self):
         """Return last modified time as a UTC datetime object"""
         return utcfromtimestamp(os.stat(self.dbpath).st_mtime)
 
-    def read_tables(self):
+    def read_tables(self, preload=None):
         """
-        Read all data from the db into the python in-memory tables
+        Read data from the db into the python in-memory tables. If preload is
+        None, all tables are read. Otherwise only the tables named in preload
+        are read, reading the data for the other tables is deferred until it
+        is first used, so that opening a large library is fast.
         """
-
+        self.table_load_lock = RLock()
+        snapshot = self.read_snapshot()
         with self.conn:  # Use a single transaction, to ensure nothing modifies the db while we are reading
-            for table in self.tables.values():
-                try:
-                    table.read(self)
-                except Exception:
-                    prints('Failed to read table:', table.name)
-                    import pprint
+            for name, table in self.tables.items():
+                data = snapshot.get(name)
+                if data is not None:
+                    table.__dict__.update(data)
+                    table.data_attributes = tuple(data)
+                elif preload is None or name in preload or isinstance(table, CompositeTable):
+                    self.read_table(table)
+                else:
+                    table.loader = self.load_table
 
-                    pprint.pprint(table.metadata)
-                    raise
+    def read_table(self, table):
+        existing = frozenset(table.__dict__)
+        try:
+            table.read(self)
+        except Exception:
+            prints('Failed to read table:', table.name)
+            import pprint
+
+            pprint.pprint(table.metadata)
+            raise
+        table.data_attributes = tuple(k for k in table.__dict__ if k not in existing)
+
+    def load_table(self, table):
+        """
+        Read the data for a table whose reading was deferred by read_tables().
+        The data is read into a copy of the table and only then transferred to
+        it, so that other threads never see partially read data.
+        """
+        with self.table_load_lock:
+            if table.loader is None:
+                return  # Already read by another thread
+            shadow = object.__new__(table.__class__)
+            shadow.__dict__.update(table.__dict__)
+            del shadow.loader
+            self.read_table(shadow)
+            table.__dict__.update(shadow.__dict__)
+            del table.loader
+
+    def load_tables(self, names=None):
+        """
+        Read the data for all tables, or only the tables named in names, whose
+        reading was deferred by read_tables().
+        """
+        with self.conn:
+            for name, table in self.tables.items():
+                if table.loader is not None and (names is None or name in names):
+                    self.load_table(table)
+
+    # Snapshots {{{
+    def schema_state(self):
+        num_books, last_modified = self.conn.get('SELECT COUNT(*), MAX(last_modified) FROM books')[0]
+        return self.user_version, self.conn.get('PRAGMA schema_version', all=False), num_books, last_modified
+
+    def read_snapshot(self):
+        if tweaks['library_snapshot_minimum_size'] < 1:
+            return {}
+        ans = read_snapshot(snapshot_path(self.library_id), self.db_file_state_at_open, self.schema_state)
+        self.snapshot_tables = frozenset(ans)
+        return ans
+
+    def prepare_snapshot(self):
+        """
+        Return the data needed to write a snapshot of the in-memory tables
+        with write_snapshot() once the db is closed, or None if the library
+        is too small to need one. Must be called before the db is closed.
+        """
+        minimum_size = tweaks['library_snapshot_minimum_size']
+        if minimum_size < 1:
+            return None
+        try:
+            schema_state = self.schema_state()
+        except Exception:
+            import traceback
+
+            traceback.print_exc()
+            return None
+        if schema_state[2] < minimum_size:
+            return None
+        tables = {
+            name: {k: table.__dict__[k] for k in table.data_attributes}
+            for name, table in self.tables.items()
+            if table.loader is None and not isinstance(table, CompositeTable)
+        }
+        return schema_state, tables
+
+    def write_snapshot(self, schema_state, tables):
+        file_state = db_file_state(self.dbpath)
+        if file_state is None or (file_state == self.db_file_state_at_open and self.snapshot_tables.issuperset(tables)):
+            return  # The existing snapshot is still valid
+        try:
+            write_snapshot(snapshot_path(self.library_id), file_state, schema_state, tables)
+        except Exception:
+            import traceback
+
+            traceback.print_exc()
+
+    # }}}
 
     def find_path_for_book(self, book_id):
         q = BOOK_ID_PATH_TEMPLATE.format(book_id)
@@ -2355,12 +2453,14 @@ def add_extra_file(self, relpath, stream, book_path, replace=True, auto_rename=F
                 shutil.copyfileobj(stream, d)
         return os.path.relpath(dest, bookdir).replace(os.sep, '/')
 
-    def write_backup(self, path, raw):
+    def write_backup(self, path, raw, create_dirs=True):
         path = os.path.abspath(os.path.join(self.library_path, path, METADATA_FILE_NAME))
         try:
             with open(path, 'wb') as f:
                 f.write(raw)
         except OSError:
+            if not create_dirs:
+                raise
             exc_info = sys.exc_info()
             try:
                 os.makedirs(os.path.dirname(path))
@@ -2610,6 +2710,10 @@ def dirty_books(self, book_ids):
     def mark_book_as_clean(self, book_id):
         self.execute('DELETE FROM metadata_dirtied WHERE book=?', (book_id,))
 
+    def mark_books_as_clean(self, book_ids):
+        with self.conn:
+            self.executemany('DELETE FROM metadata_dirtied WHERE book=?', ((x,) for x in book_ids))
+
     def get_ids_for_custom_book_data(self, name):
         return frozenset(r[0] for r in self.execute('SELECT book FROM books_plugin_data WHERE name=?', (name,)))
 
@@ -7,6 +7,7 @@
 from threading import Event, Thread
 
 from calibre.ebooks.metadata.opf2 import metadata_to_opf
+from calibre.utils.config_base import tweaks
 
 
 def prints(*a, **kw):
@@ -25,13 +26,15 @@ class MetadataBackup(Thread):
     thread.
     """
 
-    def __init__(self, db, interval=2, scheduling_interval=0.1):
+    def __init__(self, db, interval=2, scheduling_interval=0.1, batch_size=None, books_per_second=None):
         super().__init__(name='MetadataBackup', daemon=True)
         self.daemon = True
         self._db = weakref.ref(getattr(db, 'new_api', db))
         self.stop_running = Event()
         self.interval = interval
         self.scheduling_interval = scheduling_interval
+        self.batch_size = tweaks['metadata_backup_batch_size'] if batch_size is None else batch_size
+        self.books_per_second = tweaks['metadata_backup_books_per_second'] if books_per_second is None else books_per_second
         self.check_dirtied_annotations = 0
 
     @property
@@ -53,11 +56,17 @@ def run(self):
             try:
                 if self.wait(self.interval):
                     break
-                self.do_one()
+                if self.batch_size > 1:
+                    # Keep going without waiting for the interval as long as
+                    # there are more dirtied books
+                    while self.do_batch() >= self.batch_size:
+                        pass
+                else:
+                    self.do_one()
             except Abort:
                 break
 
-    def do_one(self):
+    def do_check_dirtied_annotations(self):
         self.check_dirtied_annotations += 1
         if self.check_dirtied_annotations > 2:
             self.check_dirtied_annotations = 0
@@ -65,8 +74,13 @@ def do_one(self):
                 self.db.check_dirtied_annotations()
             except Exception:
                 if self.stop_running.is_set() or self.db.is_closed:
-                    return
+                    return False
                 traceback.print_exc()
+        return True
+
+    def do_one(self):
+        if not self.do_check_dirtied_annotations():
+            return
 
         try:
             book_id = self.db.get_a_dirtied_book()
@@ -127,6 +141,66 @@ def do_one(self):
 
         self.db.clear_dirtied(book_id, sequence)
 
+    def do_batch(self):
+        """Backup up to batch_size dirtied books, fetching their metadata
+        under a single lock, writing their OPF files without holding the lock
+        and marking them as clean in a single transaction. Returns the number
+        of books processed."""
+        if not self.do_check_dirtied_annotations():
+            return 0
+        try:
+            items = self.db.get_metadata_for_dump_batch(self.batch_size)
+        except Abort:
+            raise
+        except Exception:
+            if self.stop_running.is_set() or self.db.is_closed:
+                # Happens during interpreter shutdown
+                return 0
+            prints('Failed to get backup metadata for a batch of books, getting it one book at a time')
+            traceback.print_exc()
+            items = self.get_metadata_one_at_a_time()
+        if not items:
+            return 0
+
+        self.wait(self.scheduling_interval)
+        done, opfs = {}, {}
+        for book_id, mi, sequence in items:
+            if mi is not None:
+                try:
+                    opfs[book_id] = metadata_to_opf(mi)
+                except Exception:
+                    prints('Failed to convert to opf for id:', book_id)
+                    traceback.print_exc()
+            done[book_id] = sequence
+
+        self.wait(self.scheduling_interval)
+        failures = self.db.write_backups(opfs)
+        if failures:
+            prints('Failed to write backup metadata for ids:', ', '.join(map(str, failures)), 'once')
+            self.wait(self.interval)
+            for book_id, tb in self.db.write_backups({book_id: opfs[book_id] for book_id in failures}).items():
+                prints('Failed to write backup metadata for id:', book_id, 'again, giving up')
+                prints(tb)
+                del done[book_id]
+
+        self.db.clear_dirtied_books(done)
+        # Stay within the throughput budget
+        self.wait(max(self.scheduling_interval, len(items) / self.books_per_second if self.books_per_second > 0 else 0))
+        return len(items)
+
+    def get_metadata_one_at_a_time(self):
+        items = []
+        for book_id, sequence in self.db.least_recently_dirtied_books(self.batch_size):
+            try:
+                items.append((book_id, *self.db.get_metadata_for_dump(book_id)))
+            except Exception:
+                prints('Failed to get backup metadata for id:', book_id, 'giving up')
+                traceback.print_exc()
+                # The least recently dirtied books are backed up first, so
+                # leaving the book dirtied would block the backup for good
+                self.db.clear_dirtied(book_id, sequence)
+        return items
+
     def break_cycles(self):
         # Legacy compatibility
         pass
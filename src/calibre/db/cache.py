@@ -2,6 +2,7 @@
 # License: GPLv3 Copyright: 2011, Kovid Goyal <kovid@kovidgoyal.net>
 
 import hashlib
+import heapq
 import operator
 import os
 import random
@@ -11,7 +12,7 @@
 import types
 import weakref
 from collections import defaultdict
-from collections.abc import Callable, Iterable, Iterator, MutableSet, Set
+from collections.abc import Callable, Iterable, Iterator, MutableSet, Set, Sized
 from contextlib import contextmanager
 from datetime import datetime
 from functools import partial, wraps
@@ -26,6 +27,7 @@
 from calibre.customize.ui import run_plugins_on_import, run_plugins_on_postadd, run_plugins_on_postdelete, run_plugins_on_postimport
 from calibre.db import SPOOL_SIZE, _get_next_series_num_for_list
 from calibre.db.annotations import merge_annotations
+from calibre.db.api_stats import ApiStats, api_stats_enabled
 from calibre.db.categories import get_categories
 from calibre.db.constants import COVER_FILE_NAME, DATA_DIR_NAME, NOTES_DIR_NAME, Pages
 from calibre.db.errors import NoSuchBook, NoSuchFormat
@@ -35,9 +37,10 @@
 from calibre.db.locking import DowngradeLockError, LockingError, RWLockWrapper, SafeReadLock, create_locks, try_lock
 from calibre.db.notes.connect import copy_marked_up_text
 from calibre.db.page_count import MaintainPageCounts
-from calibre.db.search import Search
+from calibre.db.search import RELATED_FIELDS, Search
 from calibre.db.tables import VirtualTable
-from calibre.db.utils import type_safe_sort_key_function
+from calibre.db.utils import IdenticalBooksIndex, SortIndex, type_safe_sort_key_function
+from calibre.db.versions import Versions
 from calibre.db.write import get_series_values, sqlite_datetime, uniq
 from calibre.ebooks import check_ebook_format
 from calibre.ebooks.metadata import author_to_author_sort, string_to_authors, title_sort
@@ -48,6 +51,7 @@
 from calibre.utils.date import UNDEFINED_DATE, is_date_undefined, timestampfromdt, utcnow
 from calibre.utils.date import now as nowf
 from calibre.utils.filenames import make_long_path_useable
+from calibre.utils.formatter import template_field_references
 from calibre.utils.icu import lower as icu_lower
 from calibre.utils.icu import sort_key
 from calibre.utils.iso8601 import parse_iso8601
@@ -94,6 +98,19 @@ def call_func_with_lock(*args: P.args, **kwargs: P.kwargs) -> R:
     return call_func_with_lock
 
 
+def sort_using_ranks(ids_to_sort, fields, field_ranks):
+    if len(fields) == 1:
+        ranks = field_ranks[0]
+        return sorted(ids_to_sort, key=IDENTITY if ranks is None else ranks.__getitem__, reverse=not fields[0][1])
+    ids_to_sort = list(ids_to_sort)
+    columns = []
+    for (field, ascending), ranks in zip(fields, field_ranks):
+        column = ids_to_sort if ranks is None else list(map(ranks.__getitem__, ids_to_sort))
+        columns.append(column if ascending else [-x for x in column])
+    keys = list(zip(*columns))
+    return [ids_to_sort[i] for i in sorted(range(len(ids_to_sort)), key=keys.__getitem__)]
+
+
 def run_import_plugins(path_or_stream, fmt):
     fmt = fmt.lower()
     if hasattr(path_or_stream, 'seek'):
@@ -143,6 +160,10 @@ def _add_default_custom_column_values(mi, fm):
 })
 
 
+# Names used in templates for fields that have a different name in the db
+TEMPLATE_FIELD_ALIASES = {'title_sort': 'sort', 'isbn': 'identifiers', 'book_size': 'size', 'author_sort_map': 'authors', 'author_link_map': 'authors'}
+
+
 class Cache:
     """
     An in-memory cache of the metadata.db file from a calibre library.
@@ -181,7 +202,12 @@ def __init__(self, backend, library_database_instance=None):
         self.vls_cache_lock = Lock()
         self.dirtied_sequence = 0
         self.cover_caches = set()
+        self.sort_indexes = {}
+        self.identical_books_index = IdenticalBooksIndex()
         self.clear_search_cache_count = 0
+        self.versions = Versions(self)
+        self.api_stats_recorder = ApiStats() if api_stats_enabled() else None
+        self.composite_dependencies_key, self.composite_dependencies = None, {}
 
         # Implement locking for all simple read/write API methods
         # An unlocked version of the method is stored with the name starting
@@ -192,7 +218,10 @@ def __init__(self, backend, library_database_instance=None):
                 func = getattr(self, name)
                 # Wrap it in a lock
                 lock = self.write_lock if is_write_api else self.read_lock
-                setattr(self, name, wrap_simple(lock, func))
+                if self.api_stats_recorder is None:
+                    setattr(self, name, wrap_simple(lock, func))
+                else:
+                    setattr(self, name, self.api_stats_recorder.wrap(lock, func))
 
         self._search_api = Search(self, 'saved_searches', self.field_metadata.get_search_terms())
         self.initialize_dynamic()
@@ -287,22 +316,107 @@ def set_user_template_functions(self, user_template_functions):
 
     _set_user_template_functions = set_user_template_functions
 
+    @api
+    def api_stats(self, reset=False):
+        """
+        Return the time spent waiting for and holding the db lock by calls to
+        each API method, along with the slowest callers of each method, as a
+        dictionary. Returns None unless recording was enabled by setting the
+        environment variable CALIBRE_DB_API_STATS=1. If reset is True, the
+        recorded data is discarded after being returned.
+        """
+        if self.api_stats_recorder is not None:
+            return self.api_stats_recorder.as_dict(reset=reset)
+
     @write_api
-    def clear_composite_caches(self, book_ids=None):
-        for field in self.composites.values():
-            field.clear_caches(book_ids=book_ids)
+    def clear_composite_caches(self, book_ids=None, changed_fields=None):
+        if changed_fields is None:
+            for field in self.composites.values():
+                field.clear_caches(book_ids=book_ids)
+            return
+        dependencies = self._composite_dependencies()
+        for name, field in self.composites.items():
+            deps = dependencies.get(name)
+            if deps is None or not deps.isdisjoint(changed_fields):
+                field.clear_caches(book_ids=book_ids)
 
     _clear_composite_caches = clear_composite_caches
 
+    def _composite_dependencies(self):
+        """Return a map of composite column name to the set of fields its
+        template depends on, or None if that cannot be determined. The map is
+        recomputed when the templates or template functions change."""
+        funcs = self.backend.get_template_functions()
+        templates = tuple((name, f.metadata['display'].get('composite_template', '')) for name, f in self.composites.items())
+        key = self.composite_dependencies_key
+        if key is not None and key[0] is funcs and key[1] == templates:
+            return self.composite_dependencies
+        references = {name: template_field_references(template, funcs) for name, template in templates}
+        resolved = {}
+
+        def resolve(name, seen):
+            if name in resolved:
+                return resolved[name]
+            refs = references[name]
+            if refs is None or name in seen:
+                return None
+            deps = set()
+            for ref in refs:
+                if ref == 'id':
+                    continue
+                field = TEMPLATE_FIELD_ALIASES.get(ref, ref)
+                if field not in self.fields:
+                    field = self.field_metadata.search_term_to_field_key(ref)
+                if field not in self.fields or field == 'ondevice':
+                    return None
+                if field in self.composites:
+                    sub = resolve(field, seen | {name})
+                    if sub is None:
+                        return None
+                    deps |= sub
+                else:
+                    deps.add(field)
+                    deps.update(RELATED_FIELDS.get(field, ()))
+                    # Removing series items is reported as a change to the
+                    # series index
+                    index_field = getattr(self.fields[field], 'index_field', None)
+                    if index_field is not None:
+                        deps.add(index_field.name)
+            return frozenset(deps)
+
+        for name in references:
+            resolved[name] = resolve(name, frozenset())
+        self.composite_dependencies_key, self.composite_dependencies = (funcs, templates), resolved
+        return self.composite_dependencies
+
     @write_api
-    def clear_search_caches(self, book_ids=None):
+    def clear_search_caches(self, book_ids=None, changed_fields=None):
         self.clear_search_cache_count += 1
-        self._search_api.update_or_clear(self, book_ids)
+        self._search_api.update_or_clear(self, book_ids, changed_fields)
         self.vls_for_books_cache = None
         self.vls_for_books_lib_in_process = None
 
     _clear_search_caches = clear_search_caches
 
+    @write_api
+    def clear_sort_caches(self, book_ids=None, changed_fields=None):
+        for sort_index in self.sort_indexes.values():
+            if changed_fields is None or not sort_index.depends_on.isdisjoint(changed_fields):
+                sort_index.invalidate(book_ids)
+        self.versions.mark_stale(book_ids, changed_fields)
+
+    _clear_sort_caches = clear_sort_caches
+
+    @write_api
+    def clear_category_caches(self, book_ids=None, changed_fields=None):
+        if changed_fields is not None:
+            changed_fields = frozenset(changed_fields)
+        for field in self.fields.values():
+            if field.is_many:
+                field.invalidate_category_stats(book_ids, changed_fields)
+
+    _clear_category_caches = clear_category_caches
+
     @write_api
     def clear_extra_files_cache(self, book_id=None):
         if book_id is None:
@@ -338,7 +452,10 @@ def clear_caches(self, book_ids=None, template_cache=True, search_cache=True):
             self.format_metadata_cache.clear()
         if search_cache:
             self._clear_search_caches(book_ids)
+        self._clear_sort_caches(book_ids)
+        self._clear_category_caches(book_ids)
         self._clear_link_map_cache(book_ids)
+        self.identical_books_index.invalidate(book_ids)
 
     _clear_caches = clear_caches
 
@@ -456,12 +573,16 @@ def _get_metadata(self, book_id, get_user_categories=True):  # {{{
     # }}}
 
     @api
-    def init(self):
+    def init(self, preload_fields=()):
         """
-        Initialize this cache with data from the backend.
+        Initialize this cache with data from the backend. To make opening
+        large libraries fast, the data for a field is only read from the
+        backend when it is first used, except for the fields in
+        ``preload_fields``, which are read immediately. Pass None to read all
+        fields immediately.
         """
         with self.write_lock:
-            self.backend.read_tables()
+            self.backend.read_tables(preload=None if preload_fields is None else frozenset(preload_fields))
             bools_are_tristate = self.backend.prefs['bools_are_tristate']
 
             for field, table in self.backend.tables.items():
@@ -907,16 +1028,22 @@ def search_notes(
     # Cache Layer API {{{
 
     @write_api
-    def add_listener(self, event_callback_function, check_already_added=False):
+    def add_listener(self, event_callback_function, check_already_added=False, coalesce=False):
         """
         Register a callback function that will be called after certain actions are
         taken on this database. The function must take three arguments:
         (:class:`EventType`, library_id, event_type_specific_data)
+
+        If coalesce is True, the function is instead called at most a few
+        times a second, on a separate thread, with all the events since the
+        last call, which is much cheaper for listeners that only need to know
+        what changed during bulk operations. It must then take two arguments:
+        (library_id, mapping of :class:`EventType` to :class:`calibre.db.listeners.CoalescedEvent`)
         """
         self.event_dispatcher.library_id = getattr(self, 'server_library_id', self.library_id)
         if check_already_added and event_callback_function in self.event_dispatcher:
             return False
-        self.event_dispatcher.add_listener(event_callback_function)
+        self.event_dispatcher.add_listener(event_callback_function, coalesce=coalesce)
         return True
 
     _add_listener = add_listener
@@ -927,6 +1054,18 @@ def remove_listener(self, event_callback_function):
 
     _remove_listener = remove_listener
 
+    @api
+    def snapshot(self):
+        """
+        Return a :class:`calibre.db.versions.Snapshot` of the values of fields
+        for all books. Reading field values from the snapshot never waits for
+        writers, and the values do not change when the db is changed. Call this
+        method again to get a snapshot reflecting the changes. If a write is in
+        progress, the most recent snapshot is returned without waiting for the
+        write to finish.
+        """
+        return self.versions.snapshot()
+
     @read_api
     def field_for(self, name, book_id, default_value=None):
         """
@@ -1713,14 +1852,19 @@ def multisort(self, fields, ids_to_sort=None, virtual_fields=None):
         2-tuple.
         """
         ids_to_sort = self._all_book_ids() if ids_to_sort is None else ids_to_sort
+        if not isinstance(ids_to_sort, Sized):
+            ids_to_sort = tuple(ids_to_sort)
         get_metadata = self._get_proxy_metadata
-        lang_map = self.fields['languages'].book_value_map
         virtual_fields = virtual_fields or {}
+        lang_map = None
 
         fm = {'title': 'sort', 'authors': 'author_sort'}
 
         def sort_key_func(field):
             "Handle series type fields, virtual fields and the id field"
+            nonlocal lang_map
+            if lang_map is None:
+                lang_map = self.fields['languages'].book_value_map
             idx = field + '_index'
             is_series = idx in self.fields
             try:
@@ -1742,6 +1886,18 @@ def skf(book_id):
         # Sort only once on any given field
         fields = uniq(fields, operator.itemgetter(0))
 
+        field_ranks = self._sort_ranks_for_fields(fields, sort_key_func, len(ids_to_sort))
+        if field_ranks is not None:
+            try:
+                return sort_using_ranks(ids_to_sort, fields, field_ranks)
+            except KeyError:
+                pass  # Some of the books are not in the library, use sort keys
+
+        f = self.fields.get(fields[0][0])
+        if f is not None and f.is_composite:
+            # Render all the values at once rather than one by one while sorting
+            f.values_for_books(ids_to_sort, get_metadata)
+
         if len(fields) == 1:
             keyfunc = sort_key_func(fields[0][0])
             reverse = not fields[0][1]
@@ -1799,6 +1955,38 @@ def __ge__(self, other):
 
     _multisort = multisort
 
+    def _sort_ranks_for_fields(self, fields, sort_key_func, num_to_sort):
+        """
+        Return a list of mappings of book id to rank for the specified sort
+        fields, using cached sort indexes. None is used for the id field. If
+        any of the fields cannot be cached, for example, composite and virtual
+        fields, or if num_to_sort books are too few to be worth rebuilding an
+        index for, returns None.
+        """
+        ans = []
+        all_book_ids = None
+        for field, ascending in fields:
+            if field == 'id':
+                ans.append(None)
+                continue
+            name = {'title': 'sort', 'authors': 'author_sort'}.get(field, field)
+            f = self.fields.get(name)
+            if f is None or f.is_composite or name == 'ondevice':
+                return None
+            sort_index = self.sort_indexes.get(field)
+            if sort_index is None:
+                depends_on = {field, name} | set(RELATED_FIELDS.get(name, ()))
+                if field + '_index' in self.fields:
+                    depends_on |= {field + '_index', 'languages'}
+                sort_index = self.sort_indexes[field] = SortIndex(depends_on)
+            if all_book_ids is None:
+                all_book_ids = self._all_book_ids()
+            ranks = sort_index.ranks_for(all_book_ids, partial(sort_key_func, field), num_to_sort)
+            if ranks is None:
+                return None
+            ans.append(ranks)
+        return ans
+
     @read_api
     def search(self, query, restriction='', virtual_fields=None, book_ids=None, allow_templates=True):
         """
@@ -1858,26 +2046,33 @@ def get_categories(self, sort='name', book_ids=None, already_fixed=None, first_l
                 raise
             with self.write_lock:
                 self.fields[bad_field].table.fix_link_table(self.backend)
+                # The cached category stats still refer to the removed items
+                self.fields[bad_field].invalidate_category_stats()
             return self.get_categories(sort=sort, book_ids=book_ids, already_fixed=bad_field)
 
     _get_categories = get_categories
 
     @write_api
-    def update_last_modified(self, book_ids, now=None):
+    def update_last_modified(self, book_ids, now=None, changed_fields=None):
         if book_ids:
             if now is None:
                 now = nowf()
             f = self.fields['last_modified']
             f.writer.set_books({book_id: now for book_id in book_ids}, self.backend)
+            if changed_fields is not None:
+                changed_fields = frozenset(changed_fields) | {'last_modified'}
             if self.composites:
-                self._clear_composite_caches(book_ids)
-            self._clear_search_caches(book_ids)
+                self._clear_composite_caches(book_ids, changed_fields)
+            self._clear_search_caches(book_ids, changed_fields)
+            self._clear_sort_caches(book_ids, changed_fields)
+            self._clear_category_caches(book_ids, changed_fields)
+            self.identical_books_index.invalidate(book_ids, changed_fields)
 
     _update_last_modified = update_last_modified
 
     @write_api
-    def mark_as_dirty(self, book_ids):
-        self._update_last_modified(book_ids)
+    def mark_as_dirty(self, book_ids, changed_fields=None):
+        self._update_last_modified(book_ids, changed_fields=changed_fields)
         already_dirtied = set(self.dirtied_cache).intersection(book_ids)
         new_dirtied = book_ids - already_dirtied
         already_dirtied = {book_id: self.dirtied_sequence + i for i, book_id in enumerate(already_dirtied)}
@@ -1954,9 +2149,11 @@ def set_field(self, name, book_id_to_val_map, allow_case_change=True, do_path_up
             dirtied |= sf.writer.set_books(simap, self.backend, allow_case_change=False)
 
         if dirtied:
+            changed_fields = (name,)
             if update_path and do_path_update:
                 self._update_path(dirtied, mark_as_dirtied=False)
-            self._mark_as_dirty(dirtied)
+                changed_fields += ('path',)
+            self._mark_as_dirty(dirtied, changed_fields=changed_fields)
             self._clear_link_map_cache(dirtied)
             self.event_dispatcher(EventType.metadata_changed, name, dirtied)
         return dirtied
@@ -2022,6 +2219,7 @@ def queue_pages_scan(self, book_id: int = 0, force: bool = False, by_user: bool
             if force:
                 self.backend.execute('DELETE FROM books_pages_link')
                 self.fields['pages'].table.book_col_map.clear()
+                self._clear_sort_caches(changed_fields=('pages',))
             if len(self.fields['pages'].table.book_col_map) < len(self.fields['uuid'].table.book_col_map):
                 self.backend.execute('INSERT OR IGNORE INTO books_pages_link(book,needs_scan) SELECT id,1 FROM books')
             if by_user:
@@ -2029,6 +2227,7 @@ def queue_pages_scan(self, book_id: int = 0, force: bool = False, by_user: bool
         elif force:
             self.backend.execute(f'DELETE FROM books_pages_link WHERE book={book_id}')
             self.fields['pages'].table.book_col_map.pop(book_id, None)
+            self._clear_sort_caches((book_id,), ('pages',))
             self.backend.execute(f'INSERT INTO books_pages_link(book,needs_scan) VALUES ({book_id},1)')
         else:
             self.backend.execute(f'UPDATE books_pages_link SET needs_scan=1 WHERE book={book_id}')
@@ -2065,7 +2264,8 @@ def set_pages(
             (book_id, int(pages), int(algorithm), format, int(format_size), now),
         )
         self.fields['pages'].table.book_col_map[book_id] = pages
-        self._clear_composite_caches((book_id,))
+        self._clear_composite_caches((book_id,), ('pages',))
+        self._clear_sort_caches((book_id,), ('pages',))
 
     _set_pages = set_pages
 
@@ -2125,6 +2325,22 @@ def get_metadata_for_dump(self, book_id):
 
     _get_metadata_for_dump = get_metadata_for_dump
 
+    @read_api
+    def least_recently_dirtied_books(self, count):
+        """Return a list of (book_id, sequence) for up to count dirtied books,
+        least recently dirtied first."""
+        return heapq.nsmallest(count, self.dirtied_cache.items(), key=operator.itemgetter(1))
+
+    _least_recently_dirtied_books = least_recently_dirtied_books
+
+    @read_api
+    def get_metadata_for_dump_batch(self, count):
+        """Return a list of (book_id, mi, sequence) for up to count dirtied
+        books, least recently dirtied first. See get_metadata_for_dump()."""
+        return [(book_id, *self._get_metadata_for_dump(book_id)) for book_id, sequence in self._least_recently_dirtied_books(count)]
+
+    _get_metadata_for_dump_batch = get_metadata_for_dump_batch
+
     @write_api
     def clear_dirtied(self, book_id, sequence):
         # Clear the dirtied indicator for the books. This is used when fetching
@@ -2137,6 +2353,22 @@ def clear_dirtied(self, book_id, sequence):
 
     _clear_dirtied = clear_dirtied
 
+    @write_api
+    def clear_dirtied_books(self, book_id_to_sequence_map):
+        """Same as clear_dirtied() for many books at once, using a single
+        transaction"""
+        book_ids = []
+        for book_id, sequence in book_id_to_sequence_map.items():
+            dc_sequence = self.dirtied_cache.get(book_id, None)
+            if dc_sequence is None or sequence is None or dc_sequence == sequence:
+                book_ids.append(book_id)
+        if book_ids:
+            self.backend.mark_books_as_clean(book_ids)
+            for book_id in book_ids:
+                self.dirtied_cache.pop(book_id, None)
+
+    _clear_dirtied_books = clear_dirtied_books
+
     @write_api
     def write_backup(self, book_id, raw):
         try:
@@ -2148,6 +2380,32 @@ def write_backup(self, book_id, raw):
 
     _write_backup = write_backup
 
+    def write_backups(self, book_id_to_raw_map):
+        """Same as write_backup() for many books at once. The files are written
+        without holding the lock, so this must not be called with the lock
+        held. Returns a mapping of book id to error message for the books
+        whose backups could not be written."""
+        paths = {}
+        with self.safe_read_lock:
+            for book_id in book_id_to_raw_map:
+                try:
+                    paths[book_id] = self._get_book_path(book_id)
+                except Exception:
+                    continue
+        failures = {}
+        for book_id, path in paths.items():
+            raw = book_id_to_raw_map[book_id]
+            try:
+                try:
+                    self.backend.write_backup(path, raw, create_dirs=False)
+                except OSError:
+                    # The book folder was moved or removed after its path was
+                    # read, write_backup() reads the path again under the lock
+                    self.write_backup(book_id, raw)
+            except Exception:
+                failures[book_id] = traceback.format_exc()
+        return failures
+
     @read_api
     def dirty_queue_length(self):
         return len(self.dirtied_cache)
@@ -2262,107 +2520,186 @@ def set_metadata(
         provided, but are never deleted. Also note that force_changes has no
         effect on setting title or authors.
         """
+        return self._set_metadata_bulk(
+            {book_id: mi},
+            ignore_errors=ignore_errors,
+            force_changes=force_changes,
+            set_title=set_title,
+            set_authors=set_authors,
+            allow_case_change=allow_case_change,
+        )
+
+    _set_metadata = set_metadata
+
+    @write_api
+    def set_metadata_bulk(
+        self,
+        book_id_to_mi_map,
+        ignore_errors=False,
+        force_changes=False,
+        set_title=True,
+        set_authors=True,
+        allow_case_change=False,
+    ):
+        """
+        Set metadata for many books at once from a mapping of book id to
+        `Metadata` object. The result is the same as calling
+        :meth:`set_metadata` for every book, with the same arguments, but the
+        values are grouped by field and each field is written for all books at
+        once, the book folders are updated in a single pass and everything
+        other than the title, authors and cover is written in a single
+        transaction. Listeners get one change event per field, rather than one
+        per field per book. Returns the set of all book ids that were affected.
+        """
         dirtied = set()
+        mi_map = {}
+        for book_id, mi in book_id_to_mi_map.items():
+            try:
+                # Handle code passing in an OPF object instead of a Metadata object
+                mi = mi.to_book_metadata()
+            except AttributeError, TypeError:
+                pass
+            mi_map[book_id] = mi
 
-        try:
-            # Handle code passing in an OPF object instead of a Metadata object
-            mi = mi.to_book_metadata()
-        except AttributeError, TypeError:
-            pass
-
-        def set_field(name, val):
-            dirtied.update(self._set_field(name, {book_id: val}, do_path_update=False, allow_case_change=allow_case_change))
-
-        path_changed = False
-        if set_title and mi.title:
-            path_changed = True
-            set_field('title', mi.title)
-        authors_changed = False
+        def set_field(name, book_id_to_val_map):
+            dirtied.update(self._set_field(name, book_id_to_val_map, do_path_update=False, allow_case_change=allow_case_change))
+
+        def protected_set_field(name, book_id_to_val_map):
+            try:
+                set_field(name, book_id_to_val_map)
+            except Exception:
+                if not ignore_errors:
+                    raise
+                if len(book_id_to_val_map) == 1:
+                    traceback.print_exc()
+                else:
+                    # Dont let a bad value for one book prevent the others from being set
+                    for book_id, val in book_id_to_val_map.items():
+                        protected_set_field(name, {book_id: val})
+
+        path_changed = set()
+        if set_title:
+            titles = {book_id: mi.title for book_id, mi in mi_map.items() if mi.title}
+            if titles:
+                set_field('title', titles)
+                path_changed |= set(titles)
+        authors_changed = set()
         if set_authors:
-            path_changed = True
-            if not mi.authors:
-                mi.authors = [_('Unknown')]
-            authors = []
-            for a in mi.authors:
-                authors += string_to_authors(a)
-            set_field('authors', authors)
-            authors_changed = True
+            author_map = {}
+            for book_id, mi in mi_map.items():
+                if not mi.authors:
+                    mi.authors = [_('Unknown')]
+                authors = []
+                for a in mi.authors:
+                    authors += string_to_authors(a)
+                author_map[book_id] = authors
+            if author_map:
+                set_field('authors', author_map)
+                authors_changed = path_changed = path_changed | set(author_map)
 
         if path_changed:
-            self._update_path({book_id})
+            self._update_path(path_changed)
 
-        def protected_set_field(name, val):
+        # force_changes has no effect on cover manipulation
+        covers = {}
+        for book_id, mi in mi_map.items():
             try:
-                set_field(name, val)
+                cdata = mi.cover_data[1]
+                if cdata is None and isinstance(mi.cover, (str, bytes)) and mi.cover and os.access(mi.cover, os.R_OK):
+                    with open(mi.cover, 'rb') as f:
+                        cdata = f.read() or None
+                if cdata is not None:
+                    covers[book_id] = cdata
             except Exception:
                 if ignore_errors:
                     traceback.print_exc()
                 else:
                     raise
-
-        # force_changes has no effect on cover manipulation
-        try:
-            cdata = mi.cover_data[1]
-            if cdata is None and isinstance(mi.cover, (str, bytes)) and mi.cover and os.access(mi.cover, os.R_OK):
-                with open(mi.cover, 'rb') as f:
-                    cdata = f.read() or None
-            if cdata is not None:
-                self._set_cover({book_id: cdata})
-        except Exception:
-            if ignore_errors:
-                traceback.print_exc()
-            else:
-                raise
+        if covers:
+            try:
+                self._set_cover(covers)
+            except Exception:
+                if not ignore_errors:
+                    raise
+                if len(covers) == 1:
+                    traceback.print_exc()
+                else:
+                    # Dont let a bad cover for one book prevent the others from being set
+                    for book_id, cdata in covers.items():
+                        try:
+                            self._set_cover({book_id: cdata})
+                        except Exception:
+                            traceback.print_exc()
+
+        builtin_fields = (
+            'rating',
+            'series_index',
+            'timestamp',
+            'author_sort',
+            'publisher',
+            'series',
+            'tags',
+            'comments',
+            'languages',
+            'pubdate',
+            'sort',
+            'identifiers',
+        )
+        changes = {field: {} for field in builtin_fields}
+        fm = self.field_metadata
+        for book_id, mi in mi_map.items():
+            for field in ('rating', 'series_index', 'timestamp'):
+                val = getattr(mi, field)
+                if val is not None:
+                    changes[field][book_id] = val
+
+            val = mi.get('author_sort', None)
+            if book_id in authors_changed and (not val or mi.is_null('author_sort')):
+                val = self._author_sort_from_authors(mi.authors)
+            if book_id in authors_changed or (force_changes and val is not None) or not mi.is_null('author_sort'):
+                changes['author_sort'][book_id] = val
+
+            for field in ('publisher', 'series', 'tags', 'comments', 'languages', 'pubdate'):
+                val = mi.get(field, None)
+                if (force_changes and val is not None) or not mi.is_null(field):
+                    changes[field][book_id] = val
+
+            val = mi.get('title_sort', None)
+            if (force_changes and val is not None) or not mi.is_null('title_sort'):
+                changes['sort'][book_id] = val
+
+            # identifiers will always be replaced if force_changes is True
+            mi_idents = mi.get_identifiers()
+            if force_changes:
+                changes['identifiers'][book_id] = mi_idents
+            elif mi_idents:
+                identifiers = self._field_for('identifiers', book_id, default_value={})
+                for key, val in mi_idents.items():
+                    if val and val.strip():  # Don't delete an existing identifier
+                        identifiers[icu_lower(key)] = val
+                changes['identifiers'][book_id] = identifiers
+
+            user_mi = mi.get_all_user_metadata(make_copy=False)
+            for key in user_mi:
+                if (
+                    key in fm
+                    and user_mi[key]['datatype'] == fm[key]['datatype']
+                    and (user_mi[key]['datatype'] != 'text' or (user_mi[key]['is_multiple'] == fm[key]['is_multiple']))
+                ):
+                    val = mi.get(key, None)
+                    if force_changes or val is not None:
+                        changes.setdefault(key, {})[book_id] = val
+                        idx = key + '_index'
+                        if idx in self.fields:
+                            extra = mi.get_extra(key)
+                            if extra is not None or force_changes:
+                                changes.setdefault(idx, {})[book_id] = extra
 
         try:
             with self.backend.conn:  # Speed up set_metadata by not operating in autocommit mode
-                for field in ('rating', 'series_index', 'timestamp'):
-                    val = getattr(mi, field)
-                    if val is not None:
-                        protected_set_field(field, val)
-
-                val = mi.get('author_sort', None)
-                if authors_changed and (not val or mi.is_null('author_sort')):
-                    val = self._author_sort_from_authors(mi.authors)
-                if authors_changed or (force_changes and val is not None) or not mi.is_null('author_sort'):
-                    protected_set_field('author_sort', val)
-
-                for field in ('publisher', 'series', 'tags', 'comments', 'languages', 'pubdate'):
-                    val = mi.get(field, None)
-                    if (force_changes and val is not None) or not mi.is_null(field):
-                        protected_set_field(field, val)
-
-                val = mi.get('title_sort', None)
-                if (force_changes and val is not None) or not mi.is_null('title_sort'):
-                    protected_set_field('sort', val)
-
-                # identifiers will always be replaced if force_changes is True
-                mi_idents = mi.get_identifiers()
-                if force_changes:
-                    protected_set_field('identifiers', mi_idents)
-                elif mi_idents:
-                    identifiers = self._field_for('identifiers', book_id, default_value={})
-                    for key, val in mi_idents.items():
-                        if val and val.strip():  # Don't delete an existing identifier
-                            identifiers[icu_lower(key)] = val
-                    protected_set_field('identifiers', identifiers)
-
-                user_mi = mi.get_all_user_metadata(make_copy=False)
-                fm = self.field_metadata
-                for key in user_mi:
-                    if (
-                        key in fm
-                        and user_mi[key]['datatype'] == fm[key]['datatype']
-                        and (user_mi[key]['datatype'] != 'text' or (user_mi[key]['is_multiple'] == fm[key]['is_multiple']))
-                    ):
-                        val = mi.get(key, None)
-                        if force_changes or val is not None:
-                            protected_set_field(key, val)
-                            idx = key + '_index'
-                            if idx in self.fields:
-                                extra = mi.get_extra(key)
-                                if extra is not None or force_changes:
-                                    protected_set_field(idx, extra)
+                for field, book_id_to_val_map in changes.items():
+                    if book_id_to_val_map:
+                        protected_set_field(field, book_id_to_val_map)
         except Exception:
             # sqlite will rollback the entire transaction, thanks to the with
             # statement, so we have to re-read everything form the db to ensure
@@ -2371,7 +2708,7 @@ def protected_set_field(name, val):
             raise
         return dirtied
 
-    _set_metadata = set_metadata
+    _set_metadata_bulk = set_metadata_bulk
 
     def _do_add_format(self, book_id, fmt, stream, name=None, mtime=None):
         path = self._get_book_path(book_id, unsafe=True)
@@ -2645,6 +2982,8 @@ def create_book_entry(self, mi, cover=None, add_duplicates=True, force_id=None,
             elif field == 'uuid':
                 self.fields[field].table.uuid_to_id_map[val] = book_id
             self.fields[field].table.book_col_map[book_id] = val
+        self.versions.mark_stale((book_id,))
+        self.identical_books_index.invalidate((book_id,))
 
         return book_id
 
@@ -2698,6 +3037,9 @@ def remove_books(self, book_ids, permanent=False):
                     self.backend.write_backup(path, raw)
                 except Exception:
                     traceback.print_exc()
+        # Tables must be read before the books are removed from the db so that
+        # they can clean up items that are no longer used by any book
+        self.backend.load_tables()
         self.backend.remove_books(path_map, permanent=permanent)
         for field in self.fields.values():
             try:
@@ -2815,19 +3157,21 @@ def rename_items(self, field, item_id_to_new_name_map, change_index=True, restri
                 self._set_field(field, {book_id: self._fast_field_for(f, book_id) + extra for book_id in books})
 
         if affected_books:
+            changed_fields = (field,)
             if field == 'authors':
                 self._set_field(
                     'author_sort',
                     {k: ' & '.join(v) for k, v in self._author_sort_strings_for_books(affected_books).items()},
                 )
                 self._update_path(affected_books, mark_as_dirtied=False)
+                changed_fields += ('author_sort', 'path')
             elif change_index and hasattr(f, 'index_field') and tweaks['series_index_auto_increment'] != 'no_change':
                 for book_id in moved_books:
                     self._set_field(
                         f.index_field.name,
                         {book_id: self._get_next_series_num_for(self._fast_field_for(f, book_id), field=field)},
                     )
-            self._mark_as_dirty(affected_books)
+            self._mark_as_dirty(affected_books, changed_fields=changed_fields)
             self._clear_link_map_cache(affected_books)
         self.event_dispatcher(EventType.items_renamed, field, affected_books, id_map)
         return affected_books, id_map
@@ -2847,8 +3191,11 @@ def remove_items(self, field, item_ids, restrict_to_book_ids=None):
         if affected_books:
             if hasattr(field, 'index_field'):
                 self._set_field(field.index_field.name, {bid: 1.0 for bid in affected_books})
+                # Setting the index is a no-op for books whose index is
+                # already 1.0 and in any case reports only the index field
+                self._mark_as_dirty(affected_books, changed_fields=(field.name, field.index_field.name))
             else:
-                self._mark_as_dirty(affected_books)
+                self._mark_as_dirty(affected_books, changed_fields=(field.name,))
             self._clear_link_map_cache(affected_books)
         self.event_dispatcher(EventType.items_removed, field, affected_books, item_ids)
         return affected_books
@@ -3249,41 +3596,29 @@ def update_data_for_find_identical_books(self, book_id, data):
     def find_identical_books(self, mi, search_restriction='', book_ids=None):
         """Finds books that have a superset of the authors in mi and the same
         title (title is fuzzy matched). See also :meth:`data_for_find_identical_books`."""
-        from calibre.db.utils import fuzzy_title
-
         identical_book_ids = set()
-        langq = tuple(x for x in map(canonicalize_lang, mi.languages or ()) if x and x != 'und')
-        if mi.authors:
-            try:
-                quathors = mi.authors[:20]  # Too many authors causes parsing of the search expression to fail
-                query = ' and '.join('authors:"={}"'.format(a.replace('"', '')) for a in quathors)
-                qauthors = mi.authors[20:]
-            except ValueError:
-                return identical_book_ids
+        if not mi.authors:
+            return identical_book_ids
+
+        def keys_for(book_ids):
+            tf, af = self.fields['title'], self.fields['authors']
+            for book_id in book_ids:
+                yield book_id, tf.for_book(book_id, default_value=''), af.for_book(book_id, default_value=())
+
+        candidates = self.identical_books_index.find(mi.title, mi.authors, self._all_book_ids(), keys_for)
+        if book_ids is not None:
+            candidates &= set(book_ids)
+        if candidates and search_restriction:
             try:
-                book_ids = self._search(query, restriction=search_restriction, book_ids=book_ids)
+                candidates = self._search('', restriction=search_restriction, book_ids=candidates)
             except Exception:
                 traceback.print_exc()
                 return identical_book_ids
-            if qauthors and book_ids:
-                matches = set()
-                qauthors = {icu_lower(x) for x in qauthors}
-                for book_id in book_ids:
-                    aut = self._field_for('authors', book_id)
-                    if aut:
-                        aut = {icu_lower(x) for x in aut}
-                        if aut.issuperset(qauthors):
-                            matches.add(book_id)
-                book_ids = matches
-
-            for book_id in book_ids:
-                fbook_title = self._field_for('title', book_id)
-                fbook_title = fuzzy_title(fbook_title)
-                mbook_title = fuzzy_title(mi.title)
-                if fbook_title == mbook_title:
-                    bl = self._field_for('languages', book_id)
-                    if not langq or not bl or bl == langq:
-                        identical_book_ids.add(book_id)
+        langq = tuple(x for x in map(canonicalize_lang, mi.languages or ()) if x and x != 'und')
+        for book_id in candidates:
+            bl = self._field_for('languages', book_id)
+            if not langq or not bl or bl == langq:
+                identical_book_ids.add(book_id)
         return identical_book_ids
 
     _find_identical_books = find_identical_books
@@ -3420,7 +3755,10 @@ def close(self):
         if m is not None:
             m.wait_for_worker_shutdown()
         with self.write_lock:
+            snapshot = self.backend.prepare_snapshot()
             self.backend.close()
+            if snapshot is not None:
+                self.backend.write_snapshot(*snapshot)
 
     _close = close
 
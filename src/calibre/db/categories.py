@@ -215,8 +215,8 @@ def get_categories(dbcache, sort='name', book_ids=None, first_letter_sort=False,
 
     hierarchical_categories = frozenset(dbcache.pref('categories_using_hierarchy', ()))
     fm = dbcache.field_metadata
-    book_rating_map = dbcache.fields['rating'].book_value_map
-    lang_map = dbcache.fields['languages'].book_value_map
+    book_rating_map = dbcache.fields['rating'].book_value_lookup
+    lang_map = dbcache.fields['languages'].book_value_lookup
 
     categories = OrderedDict()
     book_ids = frozenset(book_ids) if book_ids else book_ids
@@ -247,7 +247,7 @@ def get_metadata(book_id):
             dt = cat['datatype']
             if dt == 'rating':
                 if category != 'rating':
-                    brm = dbcache.fields[category].book_value_map
+                    brm = dbcache.fields[category].book_value_lookup
                 if sort_on == 'name':
                     sort_on, reverse = 'rating', True
             cats = dbcache.fields[category].get_categories(tag_class, brm, lang_map, book_ids)
@@ -265,7 +265,7 @@ def get_metadata(book_id):
     for r in categories['rating']:
         for x in tuple(categories['rating']):
             if r.name == x.name and r.id != x.id:
-                r.id_set |= x.id_set
+                r.id_set = r.id_set | x.id_set
                 r.count = len(r.id_set)
                 categories['rating'].remove(x)
                 break
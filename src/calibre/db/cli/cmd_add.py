@@ -5,11 +5,17 @@
 import sys
 from contextlib import contextmanager
 from optparse import OptionGroup, OptionValueError
-from typing import Any
 
 from calibre import prints
-from calibre.db.adding import cdb_find_in_dir, cdb_recursive_find, compile_rule, create_format_map, run_import_plugins, run_import_plugins_before_metadata
-from calibre.db.utils import find_identical_books
+from calibre.db.adding import (
+    cdb_find_in_dir,
+    cdb_recursive_find,
+    compile_rule,
+    create_format_map,
+    read_metadata_in_pool,
+    run_import_plugins,
+    run_import_plugins_before_metadata,
+)
 from calibre.ebooks.metadata import MetaInformation, string_to_authors
 from calibre.ebooks.metadata.book.serialize import read_cover, serialize_cover
 from calibre.ebooks.metadata.meta import get_metadata, metadata_from_formats
@@ -32,21 +38,9 @@ def empty(db, notify_changes, is_remote, args):
     return ids, bool(duplicates)
 
 
-_cache: tuple[tuple[str, str], Any] = (('', ''), None)
-
-
-def cached_identical_book_data(db, request_id: str):
-    global _cache
-    key = db.library_id, request_id
-    if _cache[0] != key:
-        _cache = key, db.data_for_find_identical_books()
-    return _cache[1]
-
-
-def do_adding(db, request_id, notify_changes, is_remote, mi, format_map, add_duplicates, oautomerge):
+def do_adding(db, notify_changes, is_remote, mi, format_map, add_duplicates, oautomerge):
     identical_book_list, added_ids, updated_ids = set(), set(), set()
     duplicates = []
-    identical_books_data = None
     if is_remote:
         for fmt in format_map:
             if is_recipe_fmt(fmt):
@@ -63,8 +57,7 @@ def add_book():
         duplicates.extend(duplicates_)
 
     if oautomerge != 'disabled' or not add_duplicates:
-        identical_books_data = cached_identical_book_data(db, request_id)
-        identical_book_list = find_identical_books(mi, identical_books_data)
+        identical_book_list = db.find_identical_books(mi)
 
     if oautomerge != 'disabled':
         if identical_book_list:
@@ -100,10 +93,6 @@ def add_book():
         duplicates.append((mi, format_map))
     else:
         add_book()
-    if added_ids and identical_books_data is not None:
-        for book_id in added_ids:
-            db.update_data_for_find_identical_books(book_id, identical_books_data)
-
     if is_remote:
         notify_changes(books_added(added_ids))
         if updated_ids:
@@ -164,8 +153,7 @@ def book(db, notify_changes, is_remote, args):
 
         identical_book_list, added_ids, updated_ids = set(), set(), set()
         duplicates = []
-        identical_books_data = None
-        added_ids, updated_ids, duplicates = do_adding(db, request_id, notify_changes, is_remote, mi, {fmt: path}, add_duplicates, oautomerge)
+        added_ids, updated_ids, duplicates = do_adding(db, notify_changes, is_remote, mi, {fmt: path}, add_duplicates, oautomerge)
 
     return added_ids, updated_ids, bool(duplicates), mi.title
 
@@ -189,7 +177,20 @@ def format_group(db, notify_changes, is_remote, args):
         if cover_data and (not mi.cover_data or not mi.cover_data[1]):
             mi.cover_data = 'jpeg', cover_data
         format_map = create_format_map(paths)
-        added_ids, updated_ids, duplicates = do_adding(db, request_id, notify_changes, is_remote, mi, format_map, add_duplicates, oautomerge)
+        added_ids, updated_ids, duplicates = do_adding(db, notify_changes, is_remote, mi, format_map, add_duplicates, oautomerge)
+        return mi.title, set(added_ids), set(updated_ids), bool(duplicates)
+
+
+def metadata_group(db, notify_changes, is_remote, args):
+    # Used for local libraries, where the metadata has already been read in a
+    # worker process
+    if is_remote:
+        raise ValueError('Adding books with pre-read metadata is not supported for remote libraries')
+    paths, mi, add_duplicates, oautomerge, cover_data = args
+    with add_ctx():
+        if cover_data and (not mi.cover_data or not mi.cover_data[1]):
+            mi.cover_data = 'jpeg', cover_data
+        added_ids, updated_ids, duplicates = do_adding(db, notify_changes, is_remote, mi, create_format_map(paths), add_duplicates, oautomerge)
         return mi.title, set(added_ids), set(updated_ids), bool(duplicates)
 
 
@@ -228,6 +229,23 @@ def add_ctx():
     sys.stdout = orig
 
 
+def cover_data_from_opf(formats):
+    cover_data = None
+    for fmt in formats:
+        if fmt.lower().endswith('.opf'):
+            with open(fmt, 'rb') as f:
+                mi = get_metadata(f, stream_type='opf')
+                if mi.cover_data and mi.cover_data[1]:
+                    cover_data = mi.cover_data[1]
+                elif mi.cover:
+                    try:
+                        with open(mi.cover, 'rb') as f:
+                            cover_data = f.read()
+                    except OSError:
+                        pass
+    return cover_data
+
+
 def do_add(
     dbctx,
     paths,
@@ -291,36 +309,40 @@ def do_add(
 
         dir_dups = []
         scanner = cdb_recursive_find if recurse else cdb_find_in_dir
-        for dpath in dirs:
-            for formats in scanner(dpath, one_book_per_directory, compiled_rules):
-                cover_data = None
-                for fmt in formats:
-                    if fmt.lower().endswith('.opf'):
-                        with open(fmt, 'rb') as f:
-                            mi = get_metadata(f, stream_type='opf')
-                            if mi.cover_data and mi.cover_data[1]:
-                                cover_data = mi.cover_data[1]
-                            elif mi.cover:
-                                try:
-                                    with open(mi.cover, 'rb') as f:
-                                        cover_data = f.read()
-                                except OSError:
-                                    pass
-
-                book_title, ids, mids, dups = dbctx.run(
-                    'add',
-                    'format_group',
-                    tuple(map(dbctx.path, formats)),
-                    add_duplicates,
-                    oautomerge,
-                    request_id,
-                    cover_data,
+
+        def format_groups():
+            for dpath in dirs:
+                yield from scanner(dpath, one_book_per_directory, compiled_rules)
+
+        def add_result(formats, book_title, ids, mids, dups):
+            nonlocal added_ids, merged_ids
+            if book_title is not None:
+                added_ids |= set(ids)
+                merged_ids |= set(mids)
+                if dups:
+                    dir_dups.append((book_title, formats))
+
+        if dbctx.is_remote:
+            for formats in format_groups():
+                add_result(
+                    formats,
+                    *dbctx.run(
+                        'add',
+                        'format_group',
+                        tuple(map(dbctx.path, formats)),
+                        add_duplicates,
+                        oautomerge,
+                        request_id,
+                        cover_data_from_opf(formats),
+                    ),
                 )
-                if book_title is not None:
-                    added_ids |= set(ids)
-                    merged_ids |= set(mids)
-                    if dups:
-                        dir_dups.append((book_title, formats))
+        else:
+            # Read metadata in parallel in worker processes, adding the books
+            # in the order they were found
+            with TemporaryDirectory('add-multiple') as tdir:
+                for formats, paths, mi in read_metadata_in_pool(((f, f) for f in format_groups()), tdir, run_plugins=True):
+                    if mi is not None and mi.title is not None:
+                        add_result(formats, *dbctx.run('add', 'metadata_group', paths, mi, add_duplicates, oautomerge, cover_data_from_opf(formats)))
 
         sys.stdout = sys.__stdout__
 
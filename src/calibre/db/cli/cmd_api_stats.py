@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+# License: GPLv3 Copyright: 2026, Kovid Goyal <kovid at kovidgoyal.net>
+
+import json
+
+from calibre import prints
+from calibre.utils.localization import _
+
+readonly = False
+version = 0  # change this if you change signature of implementation()
+
+SORT_KEYS = {'hold': 'hold_time', 'wait': 'wait_time', 'calls': 'calls', 'max_hold': 'max_hold', 'max_wait': 'max_wait'}
+
+
+def implementation(db, notify_changes, reset=False):
+    return db.api_stats(reset)
+
+
+def option_parser(get_parser, args):
+    parser = get_parser(
+        _(
+            '''\
+%prog api_stats [options]
+
+Show how many times each database API method was called, and how long the
+calls spent waiting for the database lock and holding it. This is most
+useful with a library on a calibre Content server, to find out what is slowing
+down the server. Recording has to be enabled by starting the server with the
+environment variable CALIBRE_DB_API_STATS=1.
+    '''
+        )
+    )
+    parser.add_option(
+        '-s',
+        '--sort-by',
+        default='hold',
+        choices=sorted(SORT_KEYS),
+        help=_('What to sort the methods by. One of: {0}. Default: %default').format(', '.join(sorted(SORT_KEYS))),
+    )
+    parser.add_option('-l', '--limit', default=20, type=int, help=_('The maximum number of methods to show. Default: %default'))
+    parser.add_option('--callers', default=False, action='store_true', help=_('Also show the slowest callers of each method.'))
+    parser.add_option('--reset', default=False, action='store_true', help=_('Discard the recorded data after showing it.'))
+    parser.add_option('--for-machine', default=False, action='store_true', help=_('Generate output in JSON format.'))
+    return parser
+
+
+def main(opts, args, dbctx):
+    data = dbctx.run('api_stats', opts.reset)
+    if data is None:
+        raise SystemExit(_('Recording of API statistics is not enabled. Set the environment variable CALIBRE_DB_API_STATS=1 to enable it.'))
+    if opts.for_machine:
+        print(json.dumps(data, indent=2, sort_keys=True))
+        return 0
+    key = SORT_KEYS[opts.sort_by]
+    methods = sorted(data['methods'].items(), key=lambda x: x[1][key], reverse=True)[: max(0, opts.limit)]
+    prints(_('Recorded over {:.1f} seconds').format(data['duration']))
+    print()
+    headings = (_('Method'), _('Calls'), _('Wait'), _('Hold'), _('Max wait'), _('Max hold'))
+    rows = [(name, str(s['calls']), f"{s['wait_time']:.3f}", f"{s['hold_time']:.3f}", f"{s['max_wait']:.3f}", f"{s['max_hold']:.3f}") for name, s in methods]
+    widths = [max(len(x) for x in col) for col in zip(headings, *rows)]
+
+    def fmt(row):
+        return '  '.join(x.ljust(w) if i == 0 else x.rjust(w) for i, (x, w) in enumerate(zip(row, widths)))
+
+    prints(fmt(headings))
+    for (name, s), row in zip(methods, rows):
+        prints(fmt(row))
+        if opts.callers:
+            for total, wait, hold, caller in s['slowest_callers']:
+                prints(f'    {total:.3f} ({wait:.3f} + {hold:.3f})', caller)
+    return 0
@@ -1,6 +1,7 @@
 #!/usr/bin/env python
 # License: GPLv3 Copyright: 2017, Kovid Goyal <kovid at kovidgoyal.net>
 
+import csv
 import json
 import os
 import sys
@@ -13,7 +14,9 @@
 from polyglot.builtins import as_bytes
 
 readonly = True
-version = 0  # change this if you change signature of implementation()
+version = 1  # change this if you change signature of implementation()
+# The number of books whose metadata is fetched at a time when streaming output
+CHUNK_SIZE = 1000
 FIELDS = {
     'title',
     'authors',
@@ -49,7 +52,7 @@ def cover(db, book_id):
     return db.format_abspath(book_id, '__COVER_INTERNAL__')
 
 
-def implementation(db, notify_changes, fields, sort_by, ascending, search_text, limit, template=None):
+def implementation(db, notify_changes, fields, sort_by, ascending, search_text, limit, template=None, book_ids=None, template_globals=None):
     is_remote = notify_changes is not None
     if is_remote:
         # templates allow arbitrary code execution via python templates. We
@@ -73,7 +76,12 @@ def implementation(db, notify_changes, fields, sort_by, ascending, search_text,
         sort_spec = [((sf if not sf.startswith('*') else '#' + sf[1:]), ascending) for sf in sort_fields]
         if not set(fields).issubset(afields):
             return 'Unknown fields: {}'.format(', '.join(set(fields) - afields))
-        if search_text:
+        if book_ids is not None:
+            # A chunk of an already sorted list, some books may have been
+            # deleted since it was made
+            all_ids = db.all_book_ids()
+            book_ids = [book_id for book_id in book_ids if book_id in all_ids]
+        elif search_text:
             book_ids = db.multisort(sort_spec, ids_to_sort=db.search(search_text, allow_templates=not is_remote))
         else:
             book_ids = db.multisort(sort_spec)
@@ -95,7 +103,8 @@ def implementation(db, notify_changes, fields, sort_by, ascending, search_text,
                     data['template'] = _('Template not allowed') if is_remote else _('No template specified')
                     continue
                 vals = {}
-                global_vars = {}
+                # Template global variables persist across the chunks of a single run
+                global_vars = {} if template_globals is None else template_globals
                 if formatter is None:
                     from calibre.ebooks.metadata.book.formatter import SafeFormat
 
@@ -161,6 +170,65 @@ def prepare_output_table(fields, book_ids, data, metadata):
     return ans
 
 
+def list_in_chunks(dbctx, fields, sort_by, ascending, search_text, limit, template):
+    """Sort the books once, then fetch and yield their metadata CHUNK_SIZE books at a time"""
+    ans = dbctx.run('list', ['id'], sort_by, ascending, search_text, limit)
+    try:
+        all_book_ids = ans['book_ids']
+    except TypeError:
+        raise SystemExit(ans)
+    template_globals = {}
+    # An empty result still yields one empty chunk so that callers get the fields
+    for i in range(0, max(1, len(all_book_ids)), CHUNK_SIZE):
+        ans = dbctx.run('list', fields, sort_by, ascending, search_text, -1, template, all_book_ids[i : i + CHUNK_SIZE], template_globals)
+        try:
+            yield ans['book_ids'], ans['data'], ans['metadata'], ans['fields']
+        except TypeError:
+            raise SystemExit(ans)
+
+
+def write_output(raw):
+    buf = getattr(sys.stdout, 'buffer', None)
+    if buf is not None:
+        buf.write(raw.encode('utf-8'))
+    else:
+        sys.stdout.write(raw)
+
+
+def stream_machine_data(chunks):
+    # Produces the same output as json.dumps(all_data, indent=2, sort_keys=True)
+    # one book at a time
+    first = True
+    for book_ids, data, metadata, fields in chunks:
+        stringify(data, metadata, True)
+        for entry in as_machine_data(book_ids, data, metadata):
+            entry = json.dumps(entry, indent=2, sort_keys=True).replace('\n', '\n  ')
+            write_output(('[\n  ' if first else ',\n  ') + entry)
+            first = False
+    write_output('[]' if first else '\n]')
+
+
+def stream_csv(chunks, template_title):
+    class Writer:
+        def write(self, x):
+            write_output(x)
+
+    writer = csv.writer(Writer())
+    header = None
+    for book_ids, data, metadata, fields in chunks:
+        if header is None:
+            header = fields = ['id'] + [f for f in fields if f != 'id']
+            writer.writerow([template_title if f == 'template' else f for f in fields])
+        fields = header
+        stringify(data, metadata, False)
+        for book_id in book_ids:
+            row = []
+            for field in fields:
+                val = book_id if field == 'id' else data.get(field.replace('*', '#'), {}).get(book_id)
+                row.append('' if val is None else str(val))
+            writer.writerow(row)
+
+
 def do_list(
     dbctx,
     fields,
@@ -176,9 +244,12 @@ def do_list(
     template_file,
     template_title,
     for_machine=False,
+    as_csv=False,
 ):
     if sort_by is None:
         ascending = True
+    if for_machine and as_csv:
+        raise SystemExit(_('The {0} and {1} options cannot be used together').format('--for-machine', '--csv'))
     if dbctx.is_remote and (template or template_file):
         raise SystemExit(_('The use of templates is disallowed when connecting to remote servers for security reasons'))
     if 'template' in (f.strip() for f in fields):
@@ -187,6 +258,15 @@ def do_list(
                 template = f.read().decode('utf-8')
         if not template:
             raise SystemExit(_('You must provide a template'))
+    if for_machine or as_csv:
+        # Stream the output so that memory use does not grow with the size of the library
+        chunks = list_in_chunks(dbctx, fields, sort_by, ascending, search_text, limit, template)
+        if for_machine:
+            stream_machine_data(chunks)
+        else:
+            stream_csv(chunks, template_title)
+        return
+    if template:
         ans = dbctx.run('list', fields, sort_by, ascending, search_text, limit, template)
     else:
         ans = dbctx.run('list', fields, sort_by, ascending, search_text, limit)
@@ -201,16 +281,6 @@ def do_list(
         pass
     fields = ['id'] + fields
     stringify(data, metadata, for_machine)
-    if for_machine:
-        raw = json.dumps(list(as_machine_data(book_ids, data, metadata)), indent=2, sort_keys=True)
-        if not isinstance(raw, bytes):
-            raw = raw.encode('utf-8')
-        buf = getattr(sys.stdout, 'buffer', None)
-        if buf is not None:
-            buf.write(raw)
-        else:
-            sys.stdout.write(raw.decode('utf-8'))
-        return
     from calibre.utils.terminal import ColoredStream, geometry
 
     output_table = prepare_output_table(fields, book_ids, data, metadata)
@@ -338,6 +408,12 @@ def option_parser(get_parser, args):
         action='store_true',
         help=_('Generate output in JSON format, which is more suitable for machine parsing. Causes the line width and separator options to be ignored.'),
     )
+    parser.add_option(
+        '--csv',
+        default=False,
+        action='store_true',
+        help=_('Generate output in CSV format. Causes the line width and separator options to be ignored.'),
+    )
     parser.add_option(
         '--template',
         default=None,
@@ -381,5 +457,6 @@ def main(opts, args, dbctx):
         opts.template_file,
         opts.template_heading,
         for_machine=opts.for_machine,
+        as_csv=opts.csv,
     )
     return 0
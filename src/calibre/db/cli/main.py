@@ -40,6 +40,7 @@
     'search',
     'fts_index',
     'fts_search',
+    'api_stats',
 )
 
 
@@ -185,7 +186,8 @@ def __exit__(self, *a):
     @property
     def db(self):
         if self._db is None:
-            self._db = LibraryDatabase(self.library_path)
+            # calibredb runs a single command, so only read the fields it uses
+            self._db = LibraryDatabase(self.library_path, preload_fields=())
         return self._db
 
     def path(self, path):
@@ -2,7 +2,7 @@
 # License: GPLv3 Copyright: 2011, Kovid Goyal <kovid@kovidgoyal.net>
 
 import sys
-from collections import Counter, defaultdict
+from collections import Counter, OrderedDict, defaultdict
 from collections.abc import Iterable
 from functools import partial
 from threading import Lock
@@ -11,6 +11,7 @@
 from calibre.db.utils import atof, force_to_bool
 from calibre.db.write import Writer
 from calibre.ebooks.metadata import author_to_author_sort, rating_to_stars, title_sort
+from calibre.ebooks.metadata.book.formatter import SafeFormat
 from calibre.utils.config_base import tweaks
 from calibre.utils.date import UNDEFINED_DATE, clean_date_for_sort, parse_date
 from calibre.utils.formatter import TEMPLATE_ERROR
@@ -57,6 +58,7 @@ class Field:
     is_many = False
     is_many_many = False
     is_composite = False
+    cache_category_sort_values = False
 
     def __init__(self, name, table, bools_are_tristate, get_template_functions, db_weakref):
         self.name, self.table = name, table
@@ -109,6 +111,8 @@ def __init__(self, name, table, bools_are_tristate, get_template_functions, db_w
         self.writer = Writer(self)
         self.series_field = None
         self.get_template_functions = get_template_functions
+        self.category_stats = OrderedDict()
+        self.category_stats_lock = Lock()
 
     @property
     def metadata(self):
@@ -162,19 +166,23 @@ def iter_searchable_values(self, get_metadata, candidates, default_value=None):
         """
         raise NotImplementedError()
 
+    @property
+    def book_value_lookup(self):
+        return BookValueLookup(self)
+
     def get_categories(self, tag_class, book_rating_map, lang_map, book_ids=None):
         ans = []
-        if not self.is_many:
+        if not self.is_many or (book_ids is not None and not book_ids):
             return ans
 
         id_map = self.table.id_map
+        cbm = self.table.col_book_map
         sort_fn = getattr(self, 'category_sort_value', None)
-        for item_id, item_book_ids in self.table.col_book_map.items():
-            if book_ids is not None:
-                item_book_ids = item_book_ids.intersection(book_ids)
-            if item_book_ids:
-                ratings = tuple(r for r in (book_rating_map.get(book_id, 0) for book_id in item_book_ids) if r > 0)
-                avg = sum(ratings) / len(ratings) if ratings else 0
+        cache_sort_values = self.cache_category_sort_values
+        with self.category_stats_lock:
+            stats = self.category_stats_for(book_ids, book_rating_map)
+            for item_id, item in stats.items.items():
+                item_book_ids = cbm[item_id] if item.book_ids is None else item.book_ids
                 try:
                     name = self.category_formatter(id_map[item_id])
                 except KeyError:
@@ -182,11 +190,47 @@ def get_categories(self, tag_class, book_rating_map, lang_map, book_ids=None):
                     # id table, for example, see
                     # https://bugs.launchpad.net/bugs/1218783
                     raise InvalidLinkTable(self.name)
-                sval = sort_fn(item_id, item_book_ids, lang_map) if sort_fn is not None else name
-                c = tag_class(name, id=item_id, sort=sval, avg=avg, id_set=item_book_ids, count=len(item_book_ids))
+                if sort_fn is None:
+                    sval = name
+                elif cache_sort_values:
+                    if item.sort_value is None:
+                        item.sort_value = sort_fn(item_id, item_book_ids, lang_map)
+                    sval = item.sort_value
+                else:
+                    sval = sort_fn(item_id, item_book_ids, lang_map)
+                if item.book_ids is not None:
+                    # The cached set is updated in place as books change, do
+                    # not share it with the caller
+                    item_book_ids = frozenset(item_book_ids)
+                c = tag_class(name, id=item_id, sort=sval, avg=item.average_rating, id_set=item_book_ids, count=item.count)
                 ans.append(c)
         return ans
 
+    def category_stats_for(self, book_ids, book_rating_map):
+        # Must be called with category_stats_lock held
+        key = None if book_ids is None else frozenset(book_ids)
+        stats = self.category_stats.get(key)
+        if stats is None:
+            stats = self.category_stats[key] = CategoryStats(key)
+            # Keep the stats for all books and for a few recently used sets
+            # of books, such as virtual libraries
+            while len(self.category_stats) > MAX_CACHED_CATEGORY_RESTRICTIONS + (None in self.category_stats):
+                for k in self.category_stats:
+                    if k is not None:
+                        del self.category_stats[k]
+                        break
+        else:
+            self.category_stats.move_to_end(key)
+        stats.update(self.table, self.is_many_many, book_rating_map)
+        return stats
+
+    def invalidate_category_stats(self, book_ids=None, changed_fields=None):
+        if changed_fields is not None and self.name not in changed_fields and changed_fields.isdisjoint(CATEGORY_STATS_DEPENDENCIES):
+            return
+        with self.category_stats_lock:
+            for stats in self.category_stats.values():
+                stats.mark_dirty(book_ids)
+
 
 class OneToOneField(Field):
     def for_book(self, book_id, default_value=None):
@@ -331,6 +375,39 @@ def get_value_with_cache(self, book_id, get_metadata):
             return self.__render_composite(book_id, mi, mi.formatter, mi.template_cache)
         return ans
 
+    def values_for_books(self, book_ids, get_metadata):
+        """Return a dict mapping book id to the value of this column. The values
+        that are not cached are rendered together, with the template parsed and
+        the formatter set up only once."""
+        with self._lock:
+            rc = self._render_cache
+            ans = {book_id: rc.get(book_id) for book_id in book_ids}
+        missing = [book_id for book_id, val in ans.items() if val is None]
+        if not missing:
+            return ans
+        db = self.db_weakref()
+        if db is None:
+            for book_id in missing:
+                ans[book_id] = self.get_value_with_cache(book_id, get_metadata)
+            return ans
+        formatter = SafeFormat()
+        formatter.allow_python_templates = True
+        rendered = formatter.safe_format_books(
+            self.metadata['display']['composite_template'],
+            ((book_id, get_metadata(book_id)) for book_id in missing),
+            TEMPLATE_ERROR,
+            column_name=self._composite_name,
+            template_cache=db.formatter_template_cache,
+            template_functions=self.get_template_functions(),
+            global_vars={rendering_composite_name: '1'},
+            database=db,
+        )
+        rendered = {book_id: val.strip() for book_id, val in rendered.items()}
+        with self._lock:
+            self._render_cache.update(rendered)
+        ans.update(rendered)
+        return ans
+
     def sort_keys_for_books(self, get_metadata, lang_map):
         gv = self.get_value_with_cache
         sk = self._sort_key
@@ -341,8 +418,7 @@ def sort_keys_for_books(self, get_metadata, lang_map):
     def iter_searchable_values(self, get_metadata, candidates, default_value=None):
         val_map = defaultdict(set)
         splitter = self.splitter
-        for book_id in candidates:
-            vals = self.get_value_with_cache(book_id, get_metadata)
+        for book_id, vals in self.values_for_books(candidates, get_metadata).items():
             vals = (vv.strip() for vv in vals.split(splitter)) if splitter else (vals,)
             found = False
             for v in vals:
@@ -359,8 +435,7 @@ def iter_searchable_values(self, get_metadata, candidates, default_value=None):
     def iter_counts(self, candidates, get_metadata=None):
         val_map = defaultdict(set)
         splitter = self.splitter
-        for book_id in candidates:
-            vals = self.get_value_with_cache(book_id, get_metadata)
+        for book_id, vals in self.values_for_books(candidates, get_metadata).items():
             if splitter:
                 length = len([vv.strip() for vv in vals.split(splitter) if vv.strip()])
             elif vals.strip():
@@ -373,8 +448,7 @@ def iter_counts(self, candidates, get_metadata=None):
     def get_composite_categories(self, tag_class, book_rating_map, book_ids, is_multiple, get_metadata):
         ans = []
         id_map = defaultdict(set)
-        for book_id in book_ids:
-            val = self.get_value_with_cache(book_id, get_metadata)
+        for book_id, val in self.values_for_books(book_ids, get_metadata).items():
             vals = [x.strip() for x in val.split(is_multiple)] if is_multiple else [val]
             for val in vals:
                 if val:
@@ -389,8 +463,7 @@ def get_composite_categories(self, tag_class, book_rating_map, book_ids, is_mult
     def get_books_for_val(self, value, get_metadata, book_ids):
         is_multiple = self.table.metadata['is_multiple'].get('cache_to_list', None)
         ans = set()
-        for book_id in book_ids:
-            val = self.get_value_with_cache(book_id, get_metadata)
+        for book_id, val in self.values_for_books(book_ids, get_metadata).items():
             vals = {x.strip() for x in val.split(is_multiple)} if is_multiple else [val]
             if value in vals:
                 ans.add(book_id)
@@ -470,6 +543,114 @@ def iter_searchable_values(self, get_metadata, candidates, default_value=None):
         yield from val_map.items()
 
 
+MAX_CACHED_CATEGORY_RESTRICTIONS = 4
+CATEGORY_STATS_DEPENDENCIES = frozenset(('rating', 'languages'))
+
+
+class CategoryItem:
+    __slots__ = ('book_ids', 'count', 'rated', 'rating_total', 'sort_value')
+
+    def __init__(self, book_ids=None):
+        self.count = self.rated = self.rating_total = 0
+        self.sort_value = None
+        self.book_ids = book_ids
+
+    @property
+    def average_rating(self):
+        return self.rating_total / self.rated if self.rated else 0
+
+
+class CategoryStats:
+    """
+    The number of books and their average rating for every item in a many-one
+    or many-many field, for either all books or only the books in a
+    restriction. Once built, it is kept up to date by recounting only the
+    books that have changed. For restrictions, the ids of the books for each
+    item are also stored.
+    """
+
+    __slots__ = ('book_items', 'dirty', 'items', 'restriction')
+
+    def __init__(self, restriction=None):
+        self.restriction = restriction
+        self.dirty = None  # None means everything must be recounted
+        self.items = {}
+        self.book_items = {}
+
+    def mark_dirty(self, book_ids=None):
+        if self.dirty is not None:
+            if book_ids is None:
+                self.dirty = None
+            else:
+                self.dirty.update(book_ids)
+
+    def update(self, table, is_many_many, book_rating_map):
+        bcm = table.book_col_map
+        if self.dirty is None:
+            self.items, self.book_items = {}, {}
+            for book_id in bcm if self.restriction is None else self.restriction:
+                self.add_book(book_id, bcm, is_many_many, book_rating_map)
+        else:
+            for book_id in self.dirty:
+                if self.restriction is None or book_id in self.restriction:
+                    self.remove_book(book_id)
+                    self.add_book(book_id, bcm, is_many_many, book_rating_map)
+        self.dirty = set()
+
+    def add_book(self, book_id, bcm, is_many_many, book_rating_map):
+        item_ids = bcm.get(book_id)
+        if not item_ids and item_ids != 0:
+            return
+        if not is_many_many:
+            item_ids = (item_ids,)
+        rating = book_rating_map.get(book_id, 0)
+        self.book_items[book_id] = item_ids, rating
+        for item_id in item_ids:
+            item = self.items.get(item_id)
+            if item is None:
+                item = self.items[item_id] = CategoryItem(None if self.restriction is None else set())
+            item.count += 1
+            if rating > 0:
+                item.rated += 1
+                item.rating_total += rating
+            if item.book_ids is not None:
+                item.book_ids.add(book_id)
+            item.sort_value = None
+
+    def remove_book(self, book_id):
+        x = self.book_items.pop(book_id, None)
+        if x is None:
+            return
+        item_ids, rating = x
+        for item_id in item_ids:
+            item = self.items[item_id]
+            item.count -= 1
+            if item.count < 1:
+                del self.items[item_id]
+                continue
+            if rating > 0:
+                item.rated -= 1
+                item.rating_total -= rating
+            if item.book_ids is not None:
+                item.book_ids.discard(book_id)
+            item.sort_value = None
+
+
+class BookValueLookup:
+    """Provides the get() method of book_value_map, without building the map"""
+
+    __slots__ = ('field',)
+
+    def __init__(self, field):
+        self.field = field
+
+    def get(self, book_id, default=None):
+        try:
+            return self.field.for_book(book_id, default)
+        except KeyError:
+            raise InvalidLinkTable(self.field.name)
+
+
 class LazySortMap:
     __slots__ = ('cache', 'default_sort_key', 'id_map', 'sort_key_func')
 
@@ -720,6 +901,8 @@ def __call__(self, item_id, lang):
 
 
 class SeriesField(ManyToOneField):
+    cache_category_sort_values = True
+
     def sort_keys_for_books(self, get_metadata, lang_map):
         sso = tweaks['title_series_sorting']
         ssk = self._sort_key
@@ -277,6 +277,7 @@ def __init__(
         restore_all_prefs=False,
         row_factory=False,
         temp_db_path=None,
+        preload_fields=None,
     ):
 
         self.is_second_db = is_second_db
@@ -297,7 +298,9 @@ def progress_callback(x, y):
             temp_db_path=temp_db_path,
         )
         cache = self.new_api = Cache(backend, library_database_instance=self)
-        cache.init()
+        # Read all fields by default, so that the view is a consistent
+        # snapshot of the db until the next call to refresh()
+        cache.init(preload_fields=preload_fields)
         self.data = View(cache)
         self.id = self.data.index_to_id
         self.row = self.data.id_to_index
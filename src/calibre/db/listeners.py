@@ -4,8 +4,9 @@
 import weakref
 from contextlib import suppress
 from enum import Enum, auto
-from queue import Queue
+from queue import Empty, Queue
 from threading import Thread
+from time import monotonic
 
 
 class EventType(Enum):
@@ -50,6 +51,99 @@ class EventType(Enum):
     links_changed = auto()
 
 
+#: How long, in seconds, events are collected before being delivered to
+#: listeners that asked for coalesced events
+COALESCE_WINDOW = 0.25
+
+
+class CoalescedEvent:
+    """
+    All the events of one type that happened in a window of time. book_ids is
+    the set of affected books and fields is the set of affected fields. Item
+    level events such as notes_changed affect only fields. count is the
+    number of events that were coalesced.
+    """
+
+    __slots__ = ('book_ids', 'count', 'fields')
+
+    def __init__(self):
+        self.count = 0
+        self.book_ids = set()
+        self.fields = set()
+
+    def __repr__(self):
+        return f'CoalescedEvent(count={self.count}, book_ids={self.book_ids}, fields={self.fields})'
+
+
+def affected_books_and_fields(event_type, args):
+    if event_type in (EventType.metadata_changed, EventType.items_renamed, EventType.items_removed):
+        # items_removed is dispatched with the Field object, not its name
+        return args[1], (getattr(args[0], 'name', args[0]),)
+    if event_type in (EventType.format_added, EventType.book_edited):
+        return (args[0],), ('formats',)
+    if event_type is EventType.formats_removed:
+        return args[0], ('formats',)
+    if event_type is EventType.book_created:
+        return (args[0],), ()
+    if event_type is EventType.books_removed:
+        return args[0], ()
+    if event_type in (EventType.notes_changed, EventType.links_changed):
+        return (), (args[0],)
+    return (), ()
+
+
+class EventCoalescer(Thread):
+    """
+    Collects events for COALESCE_WINDOW seconds after the first one arrives
+    and then calls the listeners once with all of them, as (library_id,
+    {EventType: CoalescedEvent}).
+    """
+
+    def __init__(self, window=COALESCE_WINDOW):
+        Thread.__init__(self, name='DBListenerCoalescer', daemon=True)
+        self.refs = []
+        self.queue = Queue()
+        self.window = window
+
+    def run(self):
+        keep_going = True
+        while keep_going:
+            val = self.queue.get()
+            if val is None:
+                break
+            batches = {}
+            deadline = monotonic() + self.window
+            while True:
+                event_type, library_id, args = val
+                ce = batches.setdefault(library_id, {}).get(event_type)
+                if ce is None:
+                    ce = batches[library_id][event_type] = CoalescedEvent()
+                ce.count += 1
+                book_ids, fields = affected_books_and_fields(event_type, args)
+                ce.book_ids.update(book_ids)
+                ce.fields.update(fields)
+                timeout = deadline - monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    val = self.queue.get(timeout=timeout)
+                except Empty:
+                    break
+                if val is None:
+                    keep_going = False
+                    break
+            for library_id, events in batches.items():
+                for ref in self.refs:
+                    listener = ref()
+                    if listener is not None:
+                        listener(library_id, events)
+
+    def close(self):
+        self.queue.put(None)
+        self.join()
+        self.refs = []
+
+
 class EventDispatcher(Thread):
     def __init__(self):
         Thread.__init__(self, name='DBListener', daemon=True)
@@ -57,15 +151,22 @@ def __init__(self):
         self.queue = Queue()
         self.activated = False
         self.library_id = ''
+        self.coalescer = None
 
-    def add_listener(self, callback):
+    def add_listener(self, callback, coalesce=False):
         # note that we intentionally leak dead weakrefs. To not do so would
         # require using a lock to serialize access to self.refs. Given that
         # currently the use case for listeners is register one and leave it
         # forever, this is a worthwhile tradeoff
         self.remove_listener(callback)
         ref = weakref.ref(callback)
-        self.refs.append(ref)
+        if coalesce:
+            if self.coalescer is None:
+                self.coalescer = EventCoalescer()
+                self.coalescer.start()
+            self.coalescer.refs.append(ref)
+        else:
+            self.refs.append(ref)
         if not self.activated:
             self.activated = True
             self.start()
@@ -74,10 +175,13 @@ def remove_listener(self, callback):
         ref = weakref.ref(callback)
         with suppress(ValueError):
             self.refs.remove(ref)
+        if self.coalescer is not None:
+            with suppress(ValueError):
+                self.coalescer.refs.remove(ref)
 
     def __contains__(self, callback):
         ref = weakref.ref(callback)
-        return ref in self.refs
+        return ref in self.refs or (self.coalescer is not None and ref in self.coalescer.refs)
 
     def __call__(self, event_name, *args):
         if self.activated:
@@ -88,6 +192,8 @@ def close(self):
             self.queue.put(None)
             self.join()
             self.refs = []
+            if self.coalescer is not None:
+                self.coalescer.close()
 
     def run(self):
         while True:
@@ -98,3 +204,5 @@ def run(self):
                 listener = ref()
                 if listener is not None:
                     listener(*val)
+            if self.coalescer is not None:
+                self.coalescer.queue.put(val)
@@ -224,8 +224,8 @@ def __init__(self, shlock, is_shared=True):
         self._shlock = shlock
         self._is_shared = is_shared
 
-    def acquire(self):
-        self._shlock.acquire(shared=self._is_shared)
+    def acquire(self, blocking=True):
+        return self._shlock.acquire(blocking=blocking, shared=self._is_shared)
 
     def release(self, *args):
         self._shlock.release()
@@ -243,7 +243,7 @@ def __init__(self, *args, **kwargs):
         self.print_lock = Lock()
         self.st = monotonic()
 
-    def acquire(self):
+    def acquire(self, blocking=True):
         t = current_thread()
         tid = f'{os.getpid()} - {t.name} - {t.native_id}'
         at = monotonic() - self.st
@@ -251,11 +251,12 @@ def acquire(self):
             print('#' * 120, file=sys.stderr)
             print(f'acquire called at {at:.4f}: thread id:', tid, 'shared:', self._is_shared, file=sys.stderr)
             traceback.print_stack()
-        RWLockWrapper.acquire(self)
+        ans = RWLockWrapper.acquire(self, blocking)
         at = monotonic() - self.st
         with self.print_lock:
-            print(f'acquire done at {at:.4f}: thread id:', tid, file=sys.stderr)
+            print(f'acquire done at {at:.4f}: thread id:', tid, 'acquired:', ans, file=sys.stderr)
             print('_' * 120, file=sys.stderr)
+        return ans
 
     def release(self, *args):
         t = current_thread()
@@ -4,7 +4,7 @@
 import operator
 import unicodedata
 import weakref
-from collections import OrderedDict, deque
+from collections import OrderedDict, defaultdict, deque
 from collections.abc import Callable
 from datetime import timedelta
 from functools import partial
@@ -12,8 +12,9 @@
 import regex
 
 from calibre.constants import DEBUG, preferred_encoding
+from calibre.db.tables import ONE_ONE
 from calibre.db.utils import force_to_bool
-from calibre.utils.config_base import prefs
+from calibre.utils.config_base import prefs, tweaks
 from calibre.utils.date import UNDEFINED_DATE, dt_as_local, now, parse_date
 from calibre.utils.icu import lower as icu_lower
 from calibre.utils.icu import primary_contains, primary_no_punc_contains, sort_key
@@ -150,6 +151,15 @@ def lt(self, dbdate, query, field_count):
     def ge(self, *args):
         return not self.lt(*args)
 
+    def is_relative(self, query):
+        "Return True if the result of the query depends on the current date"
+        query = icu_lower(query.strip())
+        for k in self.operators:
+            if query.startswith(k):
+                query = query[len(k) :]
+                break
+        return query in self.local_today or query in self.local_yesterday or query in self.local_thismonth or self.daysago_pat.search(query) is not None
+
     def __call__(self, query, field_iter):
         matches = set()
         if len(query) < 2:
@@ -522,6 +532,165 @@ def names(self):
 # }}}
 
 
+def normalize_for_text_index(text):
+    """
+    Normalize text so that if text A contains text B as per the primary
+    strength, punctuation insensitive ICU comparison used for searching, then
+    normalize(A) contains normalize(B). Returns None when this cannot be
+    guaranteed, which is the case for text containing non-ASCII letters and
+    digits, since ICU can consider those equal to ASCII ones.
+    """
+    text = nfkd(text.casefold())
+    text = ''.join(c for c in text if c.isalnum())
+    return text if text.isascii() else None
+
+
+def trigrams(text):
+    return {text[i : i + 3] for i in range(len(text) - 2)}
+
+
+class TextIndex:
+    """
+    An inverted index from trigrams of normalized values to keys. Keys are
+    book ids for one-one fields and item ids for other fields. Used to narrow
+    down the set of values that need to be checked for a contains match.
+    Values that cannot be normalized are not indexed and are always checked.
+    """
+
+    def __init__(self, field):
+        self.is_one_one = field.table_type == ONE_ONE
+        self.postings = defaultdict(set)
+        self.normalized_values = {}
+        self.unindexed = set()
+        source = field.table.book_col_map if self.is_one_one else field.table.id_map
+        for key, val in source.items():
+            self.add(key, val)
+
+    def add(self, key, val):
+        norm = normalize_for_text_index(val) if isinstance(val, str) else ''
+        self.normalized_values[key] = norm
+        if norm is None:
+            self.unindexed.add(key)
+        else:
+            for t in trigrams(norm):
+                self.postings[t].add(key)
+
+    def remove(self, key):
+        norm = self.normalized_values.pop(key, '')
+        if norm is None:
+            self.unindexed.discard(key)
+        else:
+            for t in trigrams(norm):
+                p = self.postings.get(t)
+                if p is not None:
+                    p.discard(key)
+                    if not p:
+                        del self.postings[t]
+
+    def update_books(self, field, book_ids):
+        bcm = field.table.book_col_map
+        for book_id in book_ids:
+            self.remove(book_id)
+            if book_id in bcm:
+                self.add(book_id, bcm[book_id])
+
+    def discard_books(self, book_ids):
+        for book_id in book_ids:
+            self.remove(book_id)
+
+    def matching_keys(self, norm):
+        ans = None
+        for t in sorted(trigrams(norm), key=lambda t: len(self.postings.get(t, ()))):
+            p = self.postings.get(t)
+            if not p:
+                ans = set()
+                break
+            ans = set(p) if ans is None else ans.intersection(p)
+            if not ans:
+                break
+        return ans | self.unindexed
+
+    def iter_searchable_values(self, field, norm, candidates):
+        keys = self.matching_keys(norm)
+        if self.is_one_one:
+            bcm = field.table.book_col_map
+            keys &= candidates
+            # Books not present in the index, should never happen, but be
+            # safe and check them as well
+            keys |= candidates.difference(self.normalized_values)
+            for book_id in keys:
+                yield bcm.get(book_id), {book_id}
+        else:
+            id_map, cbm = field.table.id_map, field.table.col_book_map
+            empty = set()
+            for item_id in keys:
+                val = id_map.get(item_id)
+                if val is not None:
+                    book_ids = cbm.get(item_id, empty).intersection(candidates)
+                    if book_ids:
+                        yield val, book_ids
+
+
+class TextIndexes:
+    """
+    Lazily built text indexes for the text fields of a library. Indexes are
+    only built for fields that have at least minimum_size values, as
+    controlled by the search_index_minimum_size tweak, zero disables them.
+    """
+
+    EXCLUDED_FIELDS = frozenset({'sort', 'author_sort', 'uuid', 'path', 'languages', 'identifiers', 'formats', 'ondevice'})
+
+    def __init__(self, minimum_size=None):
+        self.minimum_size = tweaks['search_index_minimum_size'] if minimum_size is None else minimum_size
+        self.indexes = {}
+
+    def can_index(self, field):
+        # Comments are not indexed as the trigrams of long texts use more
+        # memory than is reasonable
+        return field.has_text_data and field.metadata['datatype'] != 'comments' and field.name not in self.EXCLUDED_FIELDS
+
+    def index_for(self, field):
+        ans = self.indexes.get(field.name)
+        if ans is None and self.minimum_size > 0 and self.can_index(field):
+            source = field.table.book_col_map if field.table_type == ONE_ONE else field.table.id_map
+            if len(source) >= self.minimum_size:
+                ans = self.indexes[field.name] = TextIndex(field)
+        return ans
+
+    def iter_searchable_values(self, field, query, candidates):
+        """
+        Return an iterator over the values of field that could possibly
+        contain query, or None if the index cannot be used for this query.
+        """
+        norm = normalize_for_text_index(query)
+        if not norm or len(norm) < 3:
+            return None
+        idx = self.index_for(field)
+        if idx is None:
+            return None
+        return idx.iter_searchable_values(field, norm, candidates)
+
+    def update(self, dbcache, book_ids=None, changed_fields=None):
+        for name in tuple(self.indexes):
+            if changed_fields is not None and name not in changed_fields:
+                continue
+            idx = self.indexes[name]
+            if book_ids and idx.is_one_one and name in dbcache.fields:
+                idx.update_books(dbcache.fields[name], book_ids)
+            else:
+                # Item values can be created, renamed or merged, simply
+                # rebuild on next use
+                del self.indexes[name]
+
+    def discard_books(self, book_ids):
+        for idx in self.indexes.values():
+            if idx.is_one_one:
+                idx.discard_books(book_ids)
+
+    def clear(self):
+        self.indexes.clear()
+
+
 class Parser(SearchQueryParser):  # {{{
     def __init__(
         self,
@@ -539,8 +708,10 @@ def __init__(
         lookup_saved_search,
         parse_cache,
         allow_templates=True,
+        text_indexes=None,
     ):
         self.allow_templates = allow_templates
+        self.text_indexes = text_indexes
         self.dbcache, self.all_book_ids = dbcache, all_book_ids
         self.all_search_locations = frozenset(locations)
         self.grouped_search_terms = gst
@@ -574,10 +745,99 @@ def iter_searchable_values(self, *args, **kwargs):
         for x in ():
             yield x, set()
 
+    def text_index_iter(self, name, query, candidates):
+        if self.text_indexes is None or name not in self.dbcache.fields:
+            return None
+        return self.text_indexes.iter_searchable_values(self.dbcache.fields[name], query, candidates)
+
     def parse(self, *args, **kwargs):
         self.virtual_field_used = False
         return SearchQueryParser.parse(self, *args, **kwargs)
 
+    # Query planning {{{
+    # Relative costs of evaluating a term per candidate book
+    CHEAP_TERM_COST = 1  # values from in-memory maps, items of many fields
+    SCAN_TERM_COST = 4  # text matching of every book's value
+    MULTI_FIELD_TERM_COST = 16  # searches over several fields
+    COMPOSITE_TERM_COST = 64  # composite columns, rendered per book
+    TEMPLATE_TERM_COST = 256  # search templates, run per book
+
+    def evaluate_and(self, argument, candidates):
+        # Evaluate the terms of a chain of ANDs in order of increasing
+        # estimated cost and selectivity, so that expensive terms are only
+        # evaluated on the books that survive the cheaper, more selective ones
+        terms = []
+        self.collect_and_terms(argument, terms)
+        for tree in sorted(terms, key=self.evaluation_rank):
+            candidates = candidates.intersection(self.evaluate(tree, candidates))
+            if not candidates:
+                break
+        return candidates
+
+    def collect_and_terms(self, argument, terms):
+        for tree in argument:
+            if tree[0] == 'and':
+                self.collect_and_terms(tree[1:], terms)
+            else:
+                terms.append(tree)
+
+    def evaluation_rank(self, tree):
+        # The optimal order of evaluation for independent filters is by
+        # increasing cost / (1 - selectivity)
+        cost, selectivity = self.estimate_cost(tree)
+        return cost / max(1e-6, 1 - selectivity)
+
+    def estimate_cost(self, tree):
+        """
+        Return an estimate of (cost, selectivity) for the specified parse tree,
+        where selectivity is the fraction of candidates expected to match.
+        """
+        kind = tree[0]
+        if kind == 'and':
+            (lc, ls), (rc, rs) = self.estimate_cost(tree[1]), self.estimate_cost(tree[2])
+            return lc + rc, ls * rs
+        if kind == 'or':
+            (lc, ls), (rc, rs) = self.estimate_cost(tree[1]), self.estimate_cost(tree[2])
+            return lc + rc, min(1, ls + rs)
+        if kind == 'not':
+            cost, selectivity = self.estimate_cost(tree[1])
+            return cost, 1 - selectivity
+        return self.estimate_token_cost(tree[1], tree[2])
+
+    def estimate_token_cost(self, location, query):
+        default_selectivity = 0.5
+        location = icu_lower(location.strip())
+        if location == 'template':
+            return self.TEMPLATE_TERM_COST, default_selectivity
+        if location == 'vl':
+            # Virtual libraries are usually cached
+            return self.CHEAP_TERM_COST, default_selectivity
+        if location in ('search', 'all') or location.startswith('@'):
+            return self.MULTI_FIELD_TERM_COST, default_selectivity
+        key = self.field_metadata.search_term_to_field_key(location)
+        if isinstance(key, list):
+            return self.MULTI_FIELD_TERM_COST, default_selectivity
+        key = 'timestamp' if key == 'date' else key
+        field = self.dbcache.fields.get(key)
+        if field is None:
+            return (self.CHEAP_TERM_COST if key == 'id' or key in self.virtual_fields else self.SCAN_TERM_COST), default_selectivity
+        if field.is_composite:
+            return self.COMPOSITE_TERM_COST, default_selectivity
+        is_equals = query.startswith('=') and len(query) > 1 and query.lower() != '=false'
+        if field.is_many:
+            table = field.table
+            selectivity = default_selectivity
+            if is_equals and table.col_book_map:
+                # The number of books linked to an average item
+                num_books = max(1, len(self.dbcache.fields['uuid'].table.book_col_map))
+                selectivity = min(1, len(table.book_col_map) / len(table.col_book_map) / num_books)
+            return self.CHEAP_TERM_COST, selectivity
+        if field.has_text_data:
+            return self.SCAN_TERM_COST, (0.1 if is_equals else default_selectivity)
+        return self.CHEAP_TERM_COST, default_selectivity
+
+    # }}}
+
     def get_matches(self, location, query, candidates=None, allow_recursion=True):
         # If candidates is not None, it must not be modified. Changing its
         # value will break query optimization in the search parser
@@ -877,7 +1137,12 @@ def fi(default_value=None):
                 continue
 
             if location in text_fields:
-                for val, book_ids in self.field_iter(location, current_candidates):
+                field_iter = None
+                if matchkind == CONTAINS_MATCH and upf and not case_sensitive:
+                    field_iter = self.text_index_iter(location, q, current_candidates)
+                if field_iter is None:
+                    field_iter = self.field_iter(location, current_candidates)
+                for val, book_ids in field_iter:
                     if val is not None:
                         if isinstance(val, (str, bytes)):
                             val = (val,)
@@ -980,6 +1245,21 @@ def __iter__(self):
 # }}}
 
 
+def time_bucket():
+    "The period of time for which the results of relative date searches remain valid"
+    return now().date()
+
+
+# Fields whose values change together with, or are searched via, other fields
+RELATED_FIELDS = {
+    'title': ('sort',),
+    'sort': ('title',),
+    'authors': ('author_sort',),
+    'author_sort': ('authors',),
+    'series_sort': ('series', 'languages'),
+}
+
+
 class Search:
     MAX_CACHE_UPDATE = 50
 
@@ -991,7 +1271,14 @@ def __init__(self, db, opt_name, all_search_locations=()):
         self.keypair_search = KeyPairSearch()
         self.saved_searches = SavedSearchQueries(db, opt_name)
         self.cache = LRUCache()
+        # Map of cached query to the set of fields its result depends on, None
+        # means the query could depend on any field
+        self.query_dependencies = {}
+        # Map of cached query to the time bucket in which its result was
+        # computed, for queries that use relative dates such as today
+        self.query_time_buckets = {}
         self.parse_cache = LRUCache(limit=100)
+        self.text_indexes = TextIndexes()
 
     def get_saved_searches(self):
         return self.saved_searches
@@ -1002,19 +1289,104 @@ def change_locations(self, newlocs):
             self.parse_cache.clear()
         self.all_search_locations = newlocs
 
-    def update_or_clear(self, dbcache, book_ids=None):
-        if book_ids and (len(book_ids) * len(self.cache)) <= self.MAX_CACHE_UPDATE:
-            self.update_caches(dbcache, book_ids)
+    def update_or_clear(self, dbcache, book_ids=None, changed_fields=None):
+        """
+        Update or remove cached search results after the specified books were
+        changed. If changed_fields is not None only cached queries that depend
+        on the changed fields are affected.
+        """
+        self.text_indexes.update(dbcache, book_ids, changed_fields)
+        if changed_fields is None or not book_ids:
+            queries = None
+            num = len(self.cache)
         else:
+            changed_fields = frozenset(changed_fields)
+            queries = tuple(query for query, result in self.cache if self.query_depends_on(query, changed_fields))
+            num = len(queries)
+            if not num:
+                return
+        if book_ids and (len(book_ids) * num) <= self.MAX_CACHE_UPDATE:
+            self.update_caches(dbcache, book_ids, queries)
+        elif queries is None:
             self.clear_caches()
+        else:
+            for query in queries:
+                self.remove_from_cache(query)
 
     def clear_caches(self):
         self.cache.clear()
+        self.query_dependencies.clear()
+        self.query_time_buckets.clear()
+
+    def query_depends_on(self, query, changed_fields):
+        deps = self.query_dependencies.get(query)
+        return deps is None or not deps.isdisjoint(changed_fields)
+
+    def fields_for_query(self, sqp, dbcache, query):
+        """
+        Return the set of fields the result of query depends on, or None if
+        it cannot be determined, for example, for searches on all fields,
+        user categories, virtual libraries or composite columns.
+        """
+        fm = dbcache.field_metadata
+        ans = set()
 
-    def update_caches(self, dbcache, book_ids):
+        def resolve(location):
+            location = fm.search_term_to_field_key(icu_lower(location.strip()))
+            return 'timestamp' if location == 'date' else location
+
+        try:
+            for location, value in sqp.get_queried_fields(query):
+                if len(location) > 2 and location.startswith('@') and location[1:] in sqp.grouped_search_terms:
+                    location = location[1:]
+                key = resolve(location)
+                keys = tuple(map(resolve, key)) if isinstance(key, list) else (key,)
+                for key in keys:
+                    if isinstance(key, list):
+                        return None
+                    if key == 'series_sort':
+                        ans.update(RELATED_FIELDS[key])
+                        continue
+                    if key not in dbcache.fields or key not in fm or fm[key]['datatype'] == 'composite':
+                        return None
+                    ans.add(key)
+                    ans.update(RELATED_FIELDS.get(key, ()))
+                    if key + '_index' in dbcache.fields:
+                        ans.add(key + '_index')
+                    elif key.endswith('_index'):
+                        ans.add(key[: -len('_index')])
+        except ParseException:
+            return None
+        return frozenset(ans)
+
+    def add_to_cache(self, sqp, dbcache, query, result):
+        self.cache.add(query, result)
+        self.query_dependencies[query] = self.fields_for_query(sqp, dbcache, query)
+        if self.query_uses_relative_dates(sqp, dbcache, query):
+            self.query_time_buckets[query] = time_bucket()
+        if len(self.query_dependencies) > len(self.cache):
+            # Forget metadata of queries that were expired from the cache
+            for q in tuple(self.query_dependencies):
+                if q not in self.cache:
+                    del self.query_dependencies[q]
+                    self.query_time_buckets.pop(q, None)
+
+    def get_from_cache(self, query):
+        bucket = self.query_time_buckets.get(query)
+        if bucket is not None and bucket != time_bucket():
+            self.remove_from_cache(query)
+            return None
+        return self.cache.get(query)
+
+    def remove_from_cache(self, query):
+        self.cache.pop(query)
+        self.query_dependencies.pop(query, None)
+        self.query_time_buckets.pop(query, None)
+
+    def update_caches(self, dbcache, book_ids, queries=None):
         sqp = self.create_parser(dbcache)
         try:
-            return self._update_caches(sqp, book_ids)
+            return self._update_caches(sqp, book_ids, queries)
         finally:
             sqp.dbcache = sqp.lookup_saved_search = None
 
@@ -1022,11 +1394,13 @@ def discard_books(self, book_ids):
         book_ids = set(book_ids)
         for query, result in self.cache:
             result.difference_update(book_ids)
+        self.text_indexes.discard_books(book_ids)
 
-    def _update_caches(self, sqp, book_ids):
+    def _update_caches(self, sqp, book_ids, queries=None):
         book_ids = sqp.all_book_ids = set(book_ids)
         remove = set()
-        for query, result in tuple(self.cache):
+        items = tuple(self.cache) if queries is None else tuple((q, self.cache.item_map[q]) for q in queries if q in self.cache)
+        for query, result in items:
             try:
                 matches = sqp.parse(query)
             except ParseException:
@@ -1037,7 +1411,7 @@ def _update_caches(self, sqp, book_ids):
                 # add books that now match but did not before
                 result.update(matches)
         for query in remove:
-            self.cache.pop(query)
+            self.remove_from_cache(query)
 
     def create_parser(self, dbcache, virtual_fields=None, allow_templates=True):
         return Parser(
@@ -1055,6 +1429,7 @@ def create_parser(self, dbcache, virtual_fields=None, allow_templates=True):
             self.saved_searches.lookup,
             self.parse_cache,
             allow_templates=allow_templates,
+            text_indexes=self.text_indexes,
         )
 
     def __call__(self, dbcache, query, search_restriction, virtual_fields=None, book_ids=None, allow_templates=True):
@@ -1075,15 +1450,28 @@ def query_is_cacheable(self, sqp, dbcache, query):
             for name, value in sqp.get_queried_fields(query):
                 if name == 'template':
                     return False
-                elif name in dbcache.field_metadata.all_field_keys():
-                    fm = dbcache.field_metadata[name]
-                    if fm['datatype'] == 'datetime':
-                        return False
-                    if fm['datatype'] == 'composite':
-                        if fm.get('display', {}).get('composite_sort', '') == 'date':
-                            return False
         return True
 
+    def query_uses_relative_dates(self, sqp, dbcache, query):
+        """
+        Return True if the query searches a date field with a date relative to
+        the current date, such as today or 7daysago. The results of such
+        queries are cached only until the current time bucket rolls over.
+        """
+        fm = dbcache.field_metadata
+        all_field_keys = fm.all_field_keys()
+        for name, value in sqp.get_queried_fields(query):
+            key = fm.search_term_to_field_key(icu_lower(name.strip()))
+            keys = key if isinstance(key, list) else (key,)
+            for key in keys:
+                key = 'timestamp' if key == 'date' else key
+                if key in all_field_keys:
+                    m = fm[key]
+                    if m['datatype'] == 'datetime' or (m['datatype'] == 'composite' and m.get('display', {}).get('composite_sort', '') == 'date'):
+                        if self.date_search.is_relative(value):
+                            return True
+        return False
+
     def _do_search(self, sqp, query, search_restriction, dbcache, book_ids=None):
         """Do the search, caching the results. Results are cached only if the
         search is on the full library and no virtual field is searched on"""
@@ -1096,7 +1484,7 @@ def _do_search(self, sqp, query, search_restriction, dbcache, book_ids=None):
         use_cache = self.query_is_cacheable(sqp, dbcache, query)
 
         if use_cache and book_ids is None and query and not search_restriction:
-            cached = self.cache.get(query)
+            cached = self.get_from_cache(query)
             if cached is not None:
                 return cached
 
@@ -1105,11 +1493,11 @@ def _do_search(self, sqp, query, search_restriction, dbcache, book_ids=None):
             sr = search_restriction.strip()
             sqp.all_book_ids = all_book_ids if book_ids is None else book_ids
             if self.query_is_cacheable(sqp, dbcache, sr):
-                cached = self.cache.get(sr)
+                cached = self.get_from_cache(sr)
                 if cached is None:
                     restricted_ids = sqp.parse(sr)
                     if not sqp.virtual_field_used and sqp.all_book_ids is all_book_ids:
-                        self.cache.add(sr, restricted_ids)
+                        self.add_to_cache(sqp, dbcache, sr, restricted_ids)
                 else:
                     restricted_ids = cached
                     if book_ids is not None:
@@ -1123,7 +1511,7 @@ def _do_search(self, sqp, query, search_restriction, dbcache, book_ids=None):
             return restricted_ids
 
         if use_cache and restricted_ids is all_book_ids:
-            cached = self.cache.get(query)
+            cached = self.get_from_cache(query)
             if cached is not None:
                 return cached
 
@@ -1131,6 +1519,6 @@ def _do_search(self, sqp, query, search_restriction, dbcache, book_ids=None):
         result = sqp.parse(query)
 
         if not sqp.virtual_field_used and sqp.all_book_ids is all_book_ids:
-            self.cache.add(query, result)
+            self.add_to_cache(sqp, dbcache, query, result)
 
         return result
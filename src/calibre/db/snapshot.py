@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+# License: GPLv3 Copyright: 2026, Kovid Goyal <kovid at kovidgoyal.net>
+
+"""
+Snapshots of the in-memory tables of a library. A snapshot is written when
+the library is closed and is used instead of reading the tables from the db
+the next time the library is opened, provided the db has not changed in the
+meantime.
+"""
+
+import os
+import pickle
+from contextlib import suppress
+
+from calibre import prints
+from calibre.constants import cache_dir
+from calibre.db.utils import atomic_write
+
+# Increase this whenever the data stored in the tables changes
+VERSION = 1
+
+
+def snapshot_path(library_id):
+    return os.path.join(cache_dir(), 'library-snapshots', f'{library_id}.pickle')
+
+
+def db_file_state(dbpath):
+    """
+    Return a value that changes whenever the db file is modified, or None if
+    the db file cannot be read. In addition to the size and modification time
+    it includes the file change counter from the SQLite header, which is
+    incremented by every transaction, as modification times have limited
+    resolution.
+    """
+    try:
+        st = os.stat(dbpath)
+        with open(dbpath, 'rb') as f:
+            header = f.read(100)
+    except OSError:
+        return None
+    return os.path.abspath(dbpath), st.st_size, st.st_mtime_ns, header[24:28]
+
+
+def read_snapshot(path, file_state, get_schema_state):
+    """
+    Return a mapping of table names to the data for those tables from the
+    snapshot at path. An empty mapping is returned if there is no snapshot or
+    if it does not match the db, in which case it is also deleted.
+    """
+    try:
+        f = open(path, 'rb')
+    except OSError:
+        return {}
+    with f:
+        try:
+            header = pickle.load(f)
+            if (
+                file_state is not None
+                and header.get('version') == VERSION
+                and header.get('file_state') == file_state
+                and header.get('schema_state') == get_schema_state()
+            ):
+                return pickle.load(f)
+        except Exception as err:
+            prints('Failed to read library snapshot:', err)
+    with suppress(OSError):
+        os.remove(path)
+    return {}
+
+
+def write_snapshot(path, file_state, schema_state, tables):
+    header = {'version': VERSION, 'file_state': file_state, 'schema_state': schema_state}
+    data = pickle.dumps(header, protocol=pickle.HIGHEST_PROTOCOL) + pickle.dumps(tables, protocol=pickle.HIGHEST_PROTOCOL)
+    atomic_write(path, data)
@@ -2,12 +2,14 @@
 # License: GPLv3 Copyright: 2011, Kovid Goyal <kovid@kovidgoyal.net>
 
 import numbers
+from array import array
 from collections import defaultdict
-from collections.abc import Callable, Iterable
+from collections.abc import Callable, Iterable, MutableMapping
 from datetime import datetime, timedelta
 from typing import cast
 
 from calibre.ebooks.metadata import author_to_author_sort
+from calibre.utils.config_base import tweaks
 from calibre.utils.date import UNDEFINED_DATE, parse_date, utc_tz
 from calibre.utils.icu import lower as icu_lower
 from calibre_extensions.speedup import parse_date as _c_speedup
@@ -46,10 +48,158 @@ def c_parse(val):
 ONE_ONE, MANY_ONE, MANY_MANY = range(3)
 
 null = object()
+EPOCH = datetime(1970, 1, 1, tzinfo=utc_tz)
+ONE_MICROSECOND = timedelta(microseconds=1)
+UNDEFINED_MICROSECONDS = (UNDEFINED_DATE - EPOCH) // ONE_MICROSECOND
+
+
+class CompactMap(MutableMapping):
+    """
+    A mapping of book_id -> value for one-one columns that stores the values
+    in a typed array indexed by book id, with a bitmap recording which books
+    have a value. Values that cannot be stored in the array, such as None or
+    values of an unexpected type, are kept in an ordinary dict. Used in
+    place of a dict to reduce memory consumption in large libraries.
+    """
+
+    __slots__ = ('count', 'kind', 'others', 'packed', 'present')
+
+    def __init__(self, kind, typecode, items=()):
+        self.kind, self.packed, self.present, self.count, self.others = kind, array(typecode), bytearray(), 0, {}
+        for book_id, val in items:
+            self[book_id] = val
+
+    def accepts(self, book_id, val):
+        if type(book_id) is not int or book_id < 0:
+            return False
+        if self.kind is datetime:
+            return type(val) is datetime and val.tzinfo is utc_tz
+        if type(val) is not self.kind:
+            return False
+        if self.kind is int:
+            limit = 1 << (8 * self.packed.itemsize - 1)
+            return -limit <= val < limit
+        return True
+
+    def pack(self, val):
+        if self.kind is datetime:
+            return (val - EPOCH) // ONE_MICROSECOND
+        return val
+
+    def unpack(self, val):
+        if self.kind is datetime:
+            return UNDEFINED_DATE if val == UNDEFINED_MICROSECONDS else EPOCH + timedelta(microseconds=val)
+        if self.kind is bool:
+            return bool(val)
+        return val
+
+    def has_packed(self, book_id):
+        try:
+            return book_id >= 0 and bool(self.present[book_id >> 3] & (1 << (book_id & 7)))
+        except IndexError, TypeError:
+            return False
+
+    def get(self, book_id, default=None):
+        if self.has_packed(book_id):
+            return self.unpack(self.packed[book_id])
+        return self.others.get(book_id, default)
+
+    def __getitem__(self, book_id):
+        if self.has_packed(book_id):
+            return self.unpack(self.packed[book_id])
+        return self.others[book_id]
+
+    def __setitem__(self, book_id, val):
+        if self.accepts(book_id, val):
+            if book_id >= len(self.packed):
+                size = max(book_id + 1, len(self.packed) + (len(self.packed) >> 2))
+                self.packed.extend(array(self.packed.typecode, bytes(self.packed.itemsize * (size - len(self.packed)))))
+                self.present.extend(bytes((size >> 3) + 1 - len(self.present)))
+            self.packed[book_id] = self.pack(val)
+            if not self.has_packed(book_id):
+                self.present[book_id >> 3] |= 1 << (book_id & 7)
+                self.count += 1
+                self.others.pop(book_id, None)
+        else:
+            if self.has_packed(book_id):
+                self.present[book_id >> 3] &= ~(1 << (book_id & 7))
+                self.count -= 1
+            self.others[book_id] = val
+
+    def __delitem__(self, book_id):
+        if self.has_packed(book_id):
+            self.present[book_id >> 3] &= ~(1 << (book_id & 7))
+            self.count -= 1
+        else:
+            del self.others[book_id]
+
+    def __contains__(self, book_id):
+        return self.has_packed(book_id) or book_id in self.others
+
+    def __iter__(self):
+        for i, byte in enumerate(self.present):
+            if byte:
+                base = i << 3
+                for bit in range(8):
+                    if byte & (1 << bit):
+                        yield base + bit
+        yield from self.others
+
+    def __len__(self):
+        return self.count + len(self.others)
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}({dict(self)!r})'
+
+    def clear(self):
+        self.packed, self.present, self.count, self.others = array(self.packed.typecode), bytearray(), 0, {}
+
+    def copy(self):
+        return dict(self.items())
+
+
+def compact_book_col_map(book_col_map):
+    """
+    Return a version of book_col_map that uses less memory. Numeric, boolean
+    and date values are stored in a :class:`CompactMap`, repeated strings are
+    replaced by a single shared string. Which representation to use is decided
+    based on the type of the first value that is not None.
+    """
+    kind = next((type(val) for val in book_col_map.values() if val is not None), None)
+    if kind is int:
+        vals = tuple(val for val in book_col_map.values() if type(val) is int)
+        lo, hi = min(vals), max(vals)
+        # Values too large for any typecode are stored separately by CompactMap
+        typecode = 'q'
+        for q in 'bhi':
+            try:
+                array(q, (lo, hi))
+            except OverflowError:
+                continue
+            typecode = q
+            break
+        return CompactMap(int, typecode, book_col_map.items())
+    elif kind is float:
+        return CompactMap(float, 'd', book_col_map.items())
+    elif kind is bool:
+        return CompactMap(bool, 'b', book_col_map.items())
+    elif kind is datetime:
+        return CompactMap(datetime, 'q', book_col_map.items())
+    elif kind is str:
+        shared = {}
+        for val in book_col_map.values():
+            shared.setdefault(val, val)
+        if len(shared) < len(book_col_map):
+            for book_id, val in book_col_map.items():
+                book_col_map[book_id] = shared[val]
+    return book_col_map
 
 
 class Table:
     supports_notes = False
+    # Set by DB.read_tables() when reading the data for this table from the db
+    # is deferred until it is first used
+    loader = None
 
     def __init__(self, name, metadata, link_table=None):
         self.name, self.metadata = name, metadata
@@ -67,6 +217,15 @@ def __init__(self, name, metadata, link_table=None):
         if self.supports_notes and dt == 'rating':  # custom ratings table
             self.supports_notes = False
 
+    def __getattr__(self, name):
+        # Only called for attributes that do not exist, such as the data
+        # attributes created by read() when reading has been deferred
+        loader = self.loader
+        if loader is None or name.startswith('__'):
+            raise AttributeError(f'{self.__class__.__name__!r} object has no attribute {name!r}')
+        loader(self)
+        return object.__getattribute__(self, name)
+
     def remove_books(self, book_ids, db):
         return set()
 
@@ -100,6 +259,8 @@ class OneToOneTable(Table):
     """
 
     table_type = ONE_ONE
+    # Whether values are stored in less memory in large libraries, see compact_book_col_map()
+    compactable = True
 
     def read(self, db):
         idcol = 'id' if self.metadata['table'] == 'books' else 'book'
@@ -115,6 +276,12 @@ def read(self, db):
         else:
             us = self.unserialize
             self.book_col_map = {book_id: us(val) for book_id, val in query}
+        self.compact()
+
+    def compact(self):
+        minimum_size = tweaks['compact_storage_minimum_size']
+        if self.compactable and minimum_size > 0 and len(self.book_col_map) >= minimum_size:
+            self.book_col_map = compact_book_col_map(self.book_col_map)
 
     def remove_books(self, book_ids, db):
         clean = set()
@@ -126,6 +293,8 @@ def remove_books(self, book_ids, db):
 
 
 class PathTable(OneToOneTable):
+    compactable = False
+
     def set_path(self, book_id, path, db):
         self.book_col_map[book_id] = path
         db.execute('UPDATE books SET path=? WHERE id=?', (path, book_id))
@@ -135,12 +304,15 @@ class SizeTable(OneToOneTable):
     def read(self, db):
         query = db.execute('SELECT books.id, (SELECT MAX(uncompressed_size) FROM data WHERE data.book=books.id) FROM books')
         self.book_col_map = dict(query)
+        self.compact()
 
     def update_sizes(self, size_map):
         self.book_col_map.update(size_map)
 
 
 class UUIDTable(OneToOneTable):
+    compactable = False
+
     def read(self, db):
         OneToOneTable.read(self, db)
         self.uuid_to_id_map = {v: k for k, v in self.book_col_map.items()}
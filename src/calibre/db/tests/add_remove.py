@@ -235,6 +235,59 @@ def test_add_books(self):  # {{{
 
     # }}}
 
+    def test_recursive_import(self):  # {{{
+        "Test adding books from a directory tree, with metadata read in worker processes"
+        from unittest.mock import patch
+
+        from calibre.db.adding import read_metadata_in_pool, recursive_import
+        from calibre.ptempfile import TemporaryDirectory
+
+        legacy = self.init_legacy(self.cloned_library)
+        with TemporaryDirectory('recursive-import-test') as tdir:
+            titles = []
+            for i in range(5):
+                dpath = os.path.join(tdir, str(i), 'sub')
+                os.makedirs(dpath)
+                os.makedirs(os.path.join(tdir, str(i), 'empty', 'deeper'))
+                titles.append(f'Title {i}')
+                with open(os.path.join(dpath, titles[-1] + '.txt'), 'wb') as f:
+                    f.write(b'some text')
+            # The callback is called with the title of every book added and
+            # with an empty string after every directory
+            expected_progress = []
+            for dirpath, dirnames, filenames in os.walk(tdir):
+                expected_progress.extend(os.path.splitext(x)[0] for x in filenames)
+                expected_progress.append('')
+            # Returning True from the callback cancels the import, even in a
+            # directory with no books
+            ticks = []
+
+            def cancel_once(x):
+                ticks.append(x)
+                return len(ticks) == 1
+
+            self.assertFalse(recursive_import(legacy, tdir, callback=cancel_once))
+            self.assertEqual(ticks, [''])
+            self.assertEqual(legacy.new_api.all_book_ids(), {1, 2, 3})
+            added_ids = set()
+            progress = []
+            # A few books are read in process, without starting worker processes
+            with patch('calibre.utils.ipc.pool.Pool', side_effect=AssertionError('Pool used')):
+                duplicates = recursive_import(legacy, tdir, callback=progress.append, added_ids=added_ids)
+            self.assertFalse(duplicates)
+            self.assertEqual(progress, expected_progress)
+            cache = legacy.new_api
+            self.assertEqual({cache.field_for('title', book_id) for book_id in added_ids}, set(titles))
+            self.assertEqual([x for x in progress if x], [cache.field_for('title', book_id) for book_id in sorted(added_ids)])
+            for book_id in added_ids:
+                self.assertEqual(cache.formats(book_id), ('TXT',))
+            duplicates = recursive_import(legacy, tdir)
+            self.assertEqual(sorted(mi.title for mi, formats in duplicates), titles)
+            groups = [(i, [os.path.join(tdir, str(i), 'sub', title + '.txt')]) for i, title in enumerate(titles)]
+            self.assertEqual([(i, mi.title) for i, paths, mi in read_metadata_in_pool(groups, tdir, in_process_threshold=0)], list(enumerate(titles)))
+
+    # }}}
+
     def test_remove_books(self):  # {{{
         "Test removal of books"
         cl = self.cloned_library
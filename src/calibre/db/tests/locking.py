@@ -191,6 +191,37 @@ def lots_of_acquires():
         self.assertFalse(lock.is_shared)
         self.assertFalse(lock.is_exclusive)
 
+    def test_api_stats(self):
+        from calibre.db.api_stats import NUM_SLOWEST_CALLERS, ApiStats
+        from calibre.db.locking import create_locks
+
+        read_lock, write_lock = create_locks()
+        stats = ApiStats()
+
+        def read(period):
+            wait_for(period)
+            return period
+
+        def write():
+            return read_api(0)
+
+        read_api, write_api = stats.wrap(read_lock, read), stats.wrap(write_lock, write)
+        self.assertEqual(read_api.__name__, 'read')
+        for i in range(10):
+            self.assertEqual(read_api(i * 0.001), i * 0.001)
+        self.assertEqual(write_api(), 0)
+        self.assertFalse(read_lock.owns_lock() or write_lock.owns_lock())
+        data = stats.as_dict(reset=True)
+        r, w = data['methods']['read'], data['methods']['write']
+        self.assertEqual(r['calls'], 11)
+        self.assertEqual(w['calls'], 1)
+        self.assertGreaterEqual(r['hold_time'], 0.045)
+        self.assertGreaterEqual(r['max_hold'], 0.009)
+        self.assertEqual(len(r['slowest_callers']), NUM_SLOWEST_CALLERS)
+        self.assertGreaterEqual(r['slowest_callers'][0][0], r['slowest_callers'][-1][0])
+        self.assertIn('test_api_stats', r['slowest_callers'][0][3])
+        self.assertFalse(stats.as_dict()['methods'])
+
 
 def find_tests():
     import unittest
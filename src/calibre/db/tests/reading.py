@@ -209,6 +209,34 @@ def test_sorting(self):  # {{{
             cache.multisort([('#one', True), ('#two', False), ('#three', False)], ids_to_sort=sorted(cache.all_book_ids())),
         )
 
+        # Test that cached sort indexes are updated when books change
+        self.assertIn('#three', cache.sort_indexes)
+        cache.set_field('#three', {1: 100})
+        ae([1, 10, 9], cache.multisort([('#three', False)])[:3])
+        ae([1, 5, 4], cache.multisort([('#one', True), ('#three', False)])[:3])
+        cache.set_field('#one', {1: 1})
+        ae([1, 10, 9, 8, 7, 6, 5, 4, 3, 2], cache.multisort([('#one', False), ('#three', False)]))
+        cache.remove_books((1,))
+        ae([10, 9, 8], cache.multisort([('#three', False)])[:3])
+        ae([2, 3], cache.multisort([('#three', True), ('id', False)], ids_to_sort=(3, 2)))
+        # Sorting a few books does not rebuild the index after a change
+        si = cache.sort_indexes['#three']
+        cache.set_field('#three', {2: 200})
+        ae([2, 10], cache.multisort([('#three', False)], ids_to_sort=(10, 2)))
+        self.assertIsNone(si.ranks)
+        ae([2, 10, 9], cache.multisort([('#three', False)])[:3])
+        self.assertIsNotNone(si.ranks)
+        # Keys that cannot be compared are not sorted again until they change
+        si.keys[3] = 'not comparable'
+        si.ranks = None
+        self.assertIsNone(si.ranks_for(cache.all_book_ids(), None))
+        self.assertFalse(si.sortable)
+        si.keys[3] = 3
+        self.assertIsNone(si.ranks_for(cache.all_book_ids(), None))
+        si.invalidate((3,))
+        ae([2, 10, 9], cache.multisort([('#three', False)])[:3])
+        self.assertTrue(si.sortable)
+
     # }}}
 
     def test_get_metadata(self):  # {{{
@@ -421,6 +449,49 @@ def test_searching(self):  # {{{
         # Note that the old db searched uuid for un-prefixed searches, the new
         # db does not, for performance
 
+        # Test that AND terms are evaluated cheapest and most selective first
+        q = 'template:"{title}#@#:t:rain" and (title:gravity and tags:"=News")'
+        self.assertEqual(cache.search(q), {1})
+        sqp = cache._search_api.create_parser(cache)
+        terms = []
+        sqp.collect_and_terms(sqp._get_tree(q)[1:], terms)
+        self.assertEqual([t[1] for t in sorted(terms, key=sqp.evaluation_rank)], ['tags', 'title', 'template'])
+        self.assertEqual(cache.search('not tags:"=News" and title:gravity'), set())
+
+        # Test the text index returns the same results as a full scan
+        queries = (
+            'title:rainbow',
+            'title:"ty\'s rai"',
+            'title:gravityS',
+            'title:ñbo',
+            'title:one',
+            'title:xyz',
+            'title:t',
+            'tags:tag',
+            'tags:"g o"',
+            'authors:thor',
+            'series:"a series"',
+            '#enum:tw',
+            'publisher:"her on"',
+            'one',
+            '"ag on"',
+        )
+        unindexed = {q: cache.search(q) for q in queries}
+        cache._search_api.clear_caches()
+        cache._search_api.text_indexes.minimum_size = 1
+        for q, expected in unindexed.items():
+            self.assertEqual(cache.search(q), expected, f'Indexed search for {q} failed')
+        self.assertIn('title', cache._search_api.text_indexes.indexes)
+        cache.set_field('title', {2: 'A new rainbow', 3: 'Æsop'})
+        cache.set_field('tags', {3: ('A new tag',)})
+        self.assertEqual(cache.search('title:rainbow'), {1, 2})
+        self.assertEqual(cache.search('title:æsop'), {3})
+        self.assertIn(3, cache._search_api.text_indexes.indexes['title'].unindexed)
+        self.assertEqual(cache.search('tags:"new tag"'), {3})
+        cache.remove_books((2,))
+        self.assertEqual(cache.search('title:rainbow'), {1})
+        self.assertNotIn(2, cache._search_api.text_indexes.indexes['title'].normalized_values)
+
     # }}}
 
     def test_get_categories(self):  # {{{
@@ -611,6 +682,177 @@ def test_datetime(self):  # {{{
 
     # }}}
 
+    def test_lazy_loading(self):  # {{{
+        "Test that tables are read from the db when first used"
+        from calibre.db.backend import DB
+        from calibre.db.cache import Cache
+
+        cache = self.init_cache()
+        tables = cache.backend.tables
+        self.assertIsNotNone(tables['#comments'].loader)
+        self.assertEqual(cache.field_for('#comments', 1), '<div>My Comments Two<p></p></div>')
+        self.assertIsNone(tables['#comments'].loader)
+        self.assertIsNotNone(tables['publisher'].loader)
+        self.assertEqual(cache.search('publisher:"=Publisher One"'), {2})
+        self.assertIsNone(tables['publisher'].loader)
+        self.assertFalse(hasattr(tables['#comments'], 'no_such_attribute'))
+        cache.remove_books((2,))
+        self.assertFalse([t for t in tables.values() if t.loader is not None])
+        self.assertNotIn('Publisher One', cache.all_field_names('publisher'))
+
+        cache = Cache(DB(self.cloned_library))
+        self.objects_to_close.append(cache)
+        cache.init(preload_fields=('title', 'tags'))
+        tables = cache.backend.tables
+        self.assertIsNone(tables['title'].loader)
+        self.assertIsNone(tables['tags'].loader)
+        self.assertIsNotNone(tables['comments'].loader)
+        cache = Cache(DB(self.cloned_library))
+        self.objects_to_close.append(cache)
+        cache.init(preload_fields=None)
+        self.assertFalse([t for t in cache.backend.tables.values() if t.loader is not None])
+
+    # }}}
+
+    def test_library_snapshot(self):  # {{{
+        "Test loading tables from a snapshot written when the library was closed"
+        from unittest.mock import patch
+
+        import apsw
+
+        from calibre.utils.config_base import Tweak
+
+        def all_values(cache):
+            return {f: {book_id: cache.field_for(f, book_id) for book_id in (1, 2, 3)} for f in cache.fields}
+
+        tdir = self.mkdtemp()
+        with Tweak('library_snapshot_minimum_size', 1), patch('calibre.db.snapshot.cache_dir', lambda: tdir):
+            cache = self.init_cache()
+            expected = all_values(cache)
+            cache.close()
+            self.assertEqual(len(os.listdir(os.path.join(tdir, 'library-snapshots'))), 1)
+            cache = self.init_cache()
+            self.assertIn('#comments', cache.backend.snapshot_tables)
+            self.assertIsNone(cache.backend.tables['#comments'].loader)
+            self.assertEqual(expected, all_values(cache))
+            cache.set_field('title', {1: 'changed'})
+            cache.close()
+            cache = self.init_cache()
+            self.assertTrue(cache.backend.snapshot_tables)
+            self.assertEqual(cache.field_for('title', 1), 'changed')
+            cache.close()
+
+            # Changes made to the db outside calibre must invalidate the snapshot
+            conn = apsw.Connection(os.path.join(self.library_path, 'metadata.db'))
+            conn.execute("UPDATE comments SET text='outside' WHERE book=2")
+            conn.close()
+            cache = self.init_cache()
+            self.assertFalse(cache.backend.snapshot_tables)
+            self.assertEqual(cache.field_for('comments', 2), 'outside')
+
+    # }}}
+
+    def test_compact_storage(self):  # {{{
+        "Test that compactly stored columns behave like ordinary ones"
+        from calibre.db.tables import ONE_ONE, CompactMap
+        from calibre.utils.config_base import Tweak
+
+        cache = self.init_cache(self.cloned_library)
+        with Tweak('compact_storage_minimum_size', 1):
+            ccache = self.init_cache(self.cloned_library)
+            # Tables are read lazily, so read them while the tweak is active
+            ccache.backend.load_tables()
+        fields = [f for f, field in cache.fields.items() if f != 'ondevice' and field.table_type == ONE_ONE and not field.is_composite]
+        for f in ('timestamp', 'series_index', 'size', '#date', '#yesno'):
+            self.assertIsInstance(ccache.fields[f].table.book_col_map, CompactMap, f)
+        for f in fields:
+            self.assertEqual(dict(cache.fields[f].table.book_col_map), dict(ccache.fields[f].table.book_col_map), f)
+            self.assertEqual(cache.multisort([(f, True)]), ccache.multisort([(f, True)]), f)
+        for q in ('#yesno:true', '#yesno:false', '#date:<2011-09-03', 'timestamp:>2011-09-06', 'series_index:>1', 'size:>0'):
+            self.assertEqual(cache.search(q), ccache.search(q), q)
+        for c in (cache, ccache):
+            c.set_field('#yesno', {1: None, 2: True, 3: False})
+            c.set_field('#date', {1: datetime.datetime(2020, 1, 1, tzinfo=utc_tz), 3: None})
+            c.set_field('series_index', {1: 7.5})
+            c.remove_books((2,))
+        fields.remove('last_modified')
+        for f in fields:
+            self.assertEqual(dict(cache.fields[f].table.book_col_map), dict(ccache.fields[f].table.book_col_map), f)
+            for book_id in (1, 2, 3):
+                self.assertEqual(cache.field_for(f, book_id), ccache.field_for(f, book_id), f)
+
+    # }}}
+
+    def test_snapshot_reads(self):  # {{{
+        "Test reading field values from published snapshots"
+        from calibre.ebooks.metadata.book.base import Metadata
+
+        cache = self.init_cache(self.cloned_library)
+        fields = ('title', 'sort', 'authors', 'tags', 'series', 'series_index', 'identifiers', '#yesno', '#tags')
+        s = cache.snapshot()
+        for f in fields:
+            for book_id in (1, 2, 3, 4):
+                self.assertEqual(s.field_for(f, book_id), cache.field_for(f, book_id), f)
+        s = cache.snapshot()
+        self.assertEqual(set(s.maps), set(fields))
+        for f in fields:
+            self.assertEqual(s.all_field_for(f, (1, 2, 3)), cache.all_field_for(f, (1, 2, 3)), f)
+        self.assertIs(s, cache.snapshot())
+        s.field_for('path', 1)
+        s = cache.snapshot()
+        self.assertIn('path', s.maps)
+
+        # Changes are only visible in snapshots published after them
+        cache.set_field('title', {1: 'changed'})
+        cache.set_field('series', {2: 'new series'})
+        self.assertNotEqual(s.field_for('title', 1), 'changed')
+        ns = cache.snapshot()
+        self.assertGreater(ns.version, s.version)
+        self.assertEqual(ns.field_for('title', 1), 'changed')
+        self.assertEqual(ns.field_for('sort', 1), cache.field_for('sort', 1))
+        self.assertEqual(ns.field_for('series', 2), 'new series')
+        self.assertEqual(ns.field_for('series_index', 2), cache.field_for('series_index', 2))
+        self.assertEqual(ns.field_for('tags', 1), s.field_for('tags', 1))
+        # Title and author changes move the book folder
+        self.assertNotEqual(ns.field_for('path', 1), s.field_for('path', 1))
+        self.assertEqual(ns.field_for('path', 1), cache.field_for('path', 1))
+        cache.rename_items('authors', {cache.get_item_id('authors', cache.field_for('authors', 2)[0]): 'Renamed Author'})
+        ns = cache.snapshot()
+        for f in ('authors', 'author_sort', 'path'):
+            self.assertEqual(ns.field_for(f, 2), cache.field_for(f, 2), f)
+        cache.remove_books((3,))
+        self.assertTrue(ns.has_id(3))
+        ns = cache.snapshot()
+        self.assertFalse(ns.has_id(3))
+        self.assertEqual(ns.all_book_ids(), cache.all_book_ids())
+        self.assertEqual(ns.field_for('tags', 3), ())
+        book_id = cache.create_book_entry(Metadata('new book', ['An Author']))
+        ns = cache.snapshot()
+        self.assertEqual(ns.field_for('title', book_id), 'new book')
+        self.assertEqual(ns.field_for('authors', book_id), ('An Author',))
+
+        # Readers do not wait for writers, they get the last published snapshot
+        with cache.write_lock:
+            cache._set_field('title', {1: 'changed again'})
+            self.assertIs(cache.snapshot(), ns)
+        self.assertEqual(cache.snapshot().field_for('title', 1), 'changed again')
+
+        # Callers cannot change the values of a published snapshot
+        s = cache.snapshot()
+        s.field_for('identifiers', 1), s.field_for('identifiers', book_id)
+        s = cache.snapshot()
+        self.assertIn('identifiers', s.maps)
+        expected = dict(s.field_for('identifiers', 1))
+        self.assertTrue(expected)
+        s.field_for('identifiers', 1)['changed'] = 'x'
+        s.all_field_for('identifiers', (1,))[1]['changed'] = 'x'
+        s.field_for('identifiers', book_id)['changed'] = 'x'
+        self.assertEqual(s.field_for('identifiers', 1), expected)
+        self.assertEqual(s.field_for('identifiers', book_id), {})
+        self.assertEqual(cache.field_for('identifiers', book_id), {})
+
+    # }}}
+
     def test_restrictions(self):  # {{{
         "Test searching with and without restrictions"
         cache = self.init_cache()
@@ -687,6 +929,39 @@ def test(hit, result, *args, **kw):
         # Test cache update worked
         test(True, {2, 3}, 'title:=xxx or title:"=Title One"')
 
+        # Test that only queries depending on the changed fields are affected
+        cache._search_api.MAX_CACHE_UPDATE = 0
+        test(False, {3}, 'publisher:=ppppp')
+        test(True, {3}, 'publisher:=ppppp')
+        cache.set_field('tags', {3: ('newtag',)})
+        test(True, {2, 3}, 'title:=xxx or title:"=Title One"')
+        test(True, {3}, 'publisher:=ppppp')
+        test(False, {3}, 'tags:=newtag')
+        cache.set_field('publisher', {2: 'ppppp'})
+        test(True, {2, 3}, 'title:=xxx or title:"=Title One"')
+        test(True, {3}, 'tags:=newtag')
+        test(False, {2, 3}, 'publisher:=ppppp')
+        cache._search_api.MAX_CACHE_UPDATE = 100
+        cache.set_field('publisher', {3: 'other'})
+        test(True, {2}, 'publisher:=ppppp')
+        sqp = cache._search_api.create_parser(cache)
+        ae(cache._search_api.fields_for_query(sqp, cache, 'title:x and #series:y'), {'title', 'sort', '#series', '#series_index'})
+        self.assertIsNone(cache._search_api.fields_for_query(sqp, cache, 'x'))
+
+        # Test caching of date searches
+        from unittest.mock import patch
+
+        test(False, {2}, '#date:>2011-09-03')
+        test(True, {2}, '#date:>2011-09-03')
+        with patch('calibre.db.search.time_bucket', return_value=datetime.date(2020, 1, 1)):
+            test(False, {1, 2}, '#date:<10daysago')
+            test(True, {1, 2}, '#date:<10daysago')
+        with patch('calibre.db.search.time_bucket', return_value=datetime.date(2020, 1, 2)):
+            # The first lookup finds the expired entry and discards it
+            test(False, {1, 2}, '#date:<10daysago', num=1)
+            test(True, {1, 2}, '#date:<10daysago')
+            test(True, {2}, '#date:>2011-09-03')
+
     # }}}
 
     def test_proxy_metadata(self):  # {{{
@@ -1193,6 +1468,134 @@ def evaluate(book, ctx):
 
     # }}}
 
+    def test_compiled_templates(self):  # {{{
+        "Test that compiled templates give the same results as the interpreter"
+        from calibre.ebooks.metadata.book.formatter import SafeFormat
+
+        formatter = SafeFormat()
+        db = self.init_cache(self.library_path)
+        templates = (
+            'program: $title',
+            "program: strcat($title, ' by ', $authors, ' - ', $$series_index, ' ', $$#rating)",
+            "program: if $series then strcat($series, ' [', $series_index, ']') elif $tags then 'tags' else 'none' fi",
+            'program: a = 1; b = a + 2 * 3; c = -b; d = 7 / 2; strcat(a, b, c, d)',
+            "program: if 2 ==# 2.0 && !(1 >#  2) || 'x' in 'y' then 'yes' else 'no' fi",
+            "program: if 'a' < 'b' && 'b' != 'c' && 'a' inlist 'x,a,b' then 'ok' fi",
+            "program: if '^one$' inlist_field 'tags' then 'found' else 'missing' fi",
+            "program: r = ''; for t in $tags: r = r & '|' & t rof; r",
+            "program: r = ''; for t in 'a:b:c' separator ':': if t == 'b' then continue fi; r = r & t rof; r",
+            "program: r = ''; for i in range(1, 10, 2): if i ==# 7 then break fi; r = r & i rof; r",
+            'program: for i in range(100): i rof',
+            'program: for i in range(10, 0, -1, 5): i rof',
+            "program: def f(x, y='def'): strcat(x, y) fed; f('a') & f('b', 'c')",
+            "program: def f(x): if x then return 'early' fi; 'late' fed; f('') & f('1')",
+            "program: first_non_empty('', $#notexist, 'x')",
+            "program: switch($title, 'title', 't', 'one', 'o', 'default')",
+            "program: switch_if('', 'a', '1', 'b', 'c')",
+            "program: contains($title, 'one', 'yes', 'no')",
+            "program: character('newline') & character('tab')",
+            "program: list_count_field('tags') & ':' & list_count_field('title')",
+            "program: globals(g='gd'); set_globals(h=strcat(g, '!')); g",
+            "program: f_string('title: {$title} rating: {$$#rating}')",
+            "program: uppercase(field('title')) & lowercase(raw_field('authors'))",
+            "program: raw_field('#rating', 'dflt') & raw_field('pubdate')",
+            'program: x',
+            "program: field('notafield')",
+            "program: 1 + 'a'",
+            "program: switch($title, '[', 'x', 'y')",
+            "program: return 'returned'; 'not returned'",
+        )
+        for book_id in (1, 2, 3):
+            mi = db.get_proxy_metadata(book_id)
+            for template in templates:
+                cache = {}
+                for i in range(2):
+                    interpreted = formatter.safe_format(template, mi, 'TEMPLATE ERROR', mi)
+                    compiled = formatter.safe_format(template, mi, 'TEMPLATE ERROR', mi, column_name='x', template_cache=cache)
+                    self.assertEqual(interpreted, compiled, f'{template!r} gave different results for book {book_id} on run {i}')
+                    self.assertIn('x::compiled', cache)
+
+    # }}}
+
+    def test_template_batches(self):  # {{{
+        "Test evaluating a template for many books at once"
+        from calibre.ebooks.metadata.book.formatter import SafeFormat
+        from calibre.utils.icu import sort_key
+
+        formatter = SafeFormat()
+        db = self.init_cache(self.library_path)
+        book_ids = sorted(db.all_book_ids())
+        for template in (
+            "program: set_globals(g=strcat(globals(g='x'), $title)); globals(g)",
+            "program: strcat($title, ' ', $#rating, ' ', list_count($tags, ','))",
+            "program: if $series then $series_index else throw_exception('no series') fi",
+            '{title} - {authors:sublist(0,1,&)}',
+        ):
+            expected = {book_id: formatter.safe_format(template, db.get_proxy_metadata(book_id), 'ERR', db.get_proxy_metadata(book_id)) for book_id in book_ids}
+            for max_workers in (1, 2):
+                books = ((book_id, db.get_proxy_metadata(book_id)) for book_id in book_ids)
+                self.assertEqual(expected, formatter.safe_format_books(template, books, 'ERR', max_workers=max_workers), template)
+
+        # Composite columns are searched, sorted and categorized by rendering
+        # the values for all books at once
+        db.create_custom_column('comp', 'Comp', 'composite', False, display={'composite_template': '{title}-{#rating}'})
+        db.close()
+        db = self.init_cache(self.library_path)
+        field = db.fields['#comp']
+        expected = {book_id: db.field_for('#comp', book_id) for book_id in book_ids}
+        field.clear_caches()
+        self.assertEqual(expected, field.values_for_books(book_ids, db.get_proxy_metadata))
+        self.assertEqual(expected, field._render_cache)
+        field.clear_caches()
+        self.assertEqual(db.multisort([('#comp', True)]), sorted(book_ids, key=lambda x: sort_key(expected[x])))
+        field.clear_caches()
+        self.assertEqual(db.search(f'#comp:"={expected[1]}"'), {book_id for book_id, v in expected.items() if v == expected[1]})
+
+    # }}}
+
+    def test_cli_list_streaming(self):  # {{{
+        "Test the chunked --for-machine and --csv output of calibredb list"
+        import csv
+        import json
+        from unittest.mock import patch
+
+        from calibre.db.cli import cmd_list
+
+        db = self.init_cache(self.library_path)
+
+        class DBCtx:
+            is_remote = False
+
+            def run(self, name, *args):
+                return cmd_list.implementation(db, None, *args)
+
+        def run(search_text=None, for_machine=False, as_csv=False, fields=('title', 'authors', 'tags'), template=None):
+            output = []
+            with patch.object(cmd_list, 'CHUNK_SIZE', 2), patch.object(cmd_list, 'write_output', output.append):
+                cmd_list.do_list(DBCtx(), list(fields), None, 'title', True, search_text, -1, ' ', None, -1, template, None, 'T', for_machine, as_csv)
+            return ''.join(output)
+
+        def expected_json(search_text=None):
+            ans = cmd_list.implementation(db, None, ['title', 'authors', 'tags'], 'title', True, search_text, -1)
+            cmd_list.stringify(ans['data'], ans['metadata'], True)
+            return json.dumps(list(cmd_list.as_machine_data(ans['book_ids'], ans['data'], ans['metadata'])), indent=2, sort_keys=True)
+
+        self.assertEqual(run(for_machine=True), expected_json())
+        self.assertEqual(run('title:=nosuchbook', for_machine=True), expected_json('title:=nosuchbook'))
+        rows = list(csv.reader(run(as_csv=True).splitlines()))
+        self.assertEqual(rows[0], ['id', 'title', 'authors', 'tags'])
+        self.assertEqual([int(r[0]) for r in rows[1:]], db.multisort([('title', True)]))
+        self.assertEqual([r[1] for r in rows[1:]], [db.field_for('title', int(r[0])) for r in rows[1:]])
+        self.assertEqual(list(csv.reader(run('title:=nosuchbook', as_csv=True).splitlines())), [['id', 'title', 'authors', 'tags']])
+        # Template globals are shared by all chunks
+        rows = list(csv.reader(run(as_csv=True, fields=('template',), template="program: globals(g=''); g = strcat(g, 'x'); set_globals(g); g").splitlines()))
+        self.assertEqual(rows[0], ['id', 'T'])
+        self.assertEqual([r[1] for r in rows[1:]], ['x', 'xx', 'xxx'])
+        with self.assertRaises(SystemExit):
+            run(for_machine=True, as_csv=True)
+
+    # }}}
+
     def test_cover_cache(self):
         from calibre.gui2.library.caches import test_cover_cache
 
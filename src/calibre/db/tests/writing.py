@@ -12,7 +12,7 @@
 from calibre.db.tests.base import IMG, BaseTest
 from calibre.ebooks.metadata import author_to_author_sort, title_sort
 from calibre.ebooks.metadata.book.base import Metadata
-from calibre.utils.date import UNDEFINED_DATE
+from calibre.utils.date import UNDEFINED_DATE, utcnow
 from calibre.utils.localization import _
 
 
@@ -458,6 +458,121 @@ def read_all_extra_files(book_id=1):
 
     # }}}
 
+    def test_batched_backup(self):  # {{{
+        "Test backing up the metadata of many changed books at a time"
+        from unittest.mock import patch
+
+        from calibre.db.backup import MetadataBackup
+        from calibre.ebooks.metadata.opf2 import OPF
+
+        cache = self.init_cache(self.cloned_library)
+        ae = self.assertEqual
+        cache.dump_metadata()
+        self.assertFalse(cache.dirtied_cache)
+        cache.set_field('title', {1: 'title1', 2: 'title2', 3: 'title3'})
+        cache.set_field('title', {2: 'title2 again'})
+        ae([x[0] for x in cache.get_metadata_for_dump_batch(2)], [1, 3])
+        mb = MetadataBackup(cache, scheduling_interval=0, batch_size=2, books_per_second=0)
+        ae(mb.do_batch(), 2)
+        ae(set(cache.dirtied_cache), {2})
+        ae(mb.do_batch(), 1)
+        ae(mb.do_batch(), 0)
+        self.assertFalse(cache.dirtied_cache)
+        self.assertFalse(set(cache.backend.dirtied_books()))
+        for book_id, title in {1: 'title1', 2: 'title2 again', 3: 'title3'}.items():
+            ae(OPF(BytesIO(cache.read_backup(book_id))).title, title)
+
+        # Books changed while their backup is in progress stay dirtied
+        cache.set_field('title', {1: 'changed'})
+        items = cache.get_metadata_for_dump_batch(10)
+        cache.set_field('title', {1: 'changed again'})
+        cache.clear_dirtied_books({book_id: sequence for book_id, mi, sequence in items})
+        ae(set(cache.dirtied_cache), {1})
+
+        # A book whose metadata cannot be read does not block the backup of
+        # the others
+        cache.set_field('title', {2: 'title2 changed', 3: 'title3 changed'})
+        get_metadata_for_dump = cache.get_metadata_for_dump
+
+        def bad_batch(count):
+            raise Exception('bad batch')
+
+        def bad_book(book_id):
+            if book_id == 1:
+                raise Exception('bad book')
+            return get_metadata_for_dump(book_id)
+
+        cache.get_metadata_for_dump_batch, cache.get_metadata_for_dump = bad_batch, bad_book
+        with patch('calibre.db.backup.prints'), patch('traceback.print_exc'):
+            ae(mb.do_batch(), 1)
+        del cache.get_metadata_for_dump_batch, cache.get_metadata_for_dump
+        ae(mb.do_batch(), 1)
+        self.assertFalse(cache.dirtied_cache)
+        ae(OPF(BytesIO(cache.read_backup(3))).title, 'title3 changed')
+
+    # }}}
+
+    def test_incremental_categories(self):  # {{{
+        "Test that category counts are kept up to date when books change"
+        cache = self.init_cache(self.cloned_library)
+
+        def as_data(categories):
+            return {k: [(t.name, t.id, t.count, t.avg_rating, t.sort, set(t.id_set)) for t in v] for k, v in categories.items()}
+
+        def check(book_ids=None):
+            ans = as_data(cache.get_categories(book_ids=book_ids))
+            for field in cache.fields.values():
+                if hasattr(field, 'category_stats'):
+                    field.category_stats.clear()
+            self.assertEqual(ans, as_data(cache.get_categories(book_ids=book_ids)))
+
+        restriction = frozenset((1, 2))
+        check(), check(restriction)
+        cache.get_categories()
+        stats = cache.fields['tags'].category_stats
+        self.assertEqual(set(stats), {None, restriction})
+        cache.set_field('tags', {1: ('one', 'News', 'new tag'), 3: ('News',)})
+        self.assertEqual(stats[None].dirty, {1, 3})
+        check(), check(restriction)
+        cache.set_field('rating', {2: 8, 3: 4})
+        cache.set_field('series', {1: 'series one', 3: 'A Series One'})
+        cache.set_field('languages', {1: ('fra',)})
+        cache.set_field('#rating', {1: 6})
+        check(), check(restriction)
+        cache.rename_items('tags', {cache.get_item_id('tags', 'one'): 'News'})
+        cache.rename_items('authors', {cache.get_item_id('authors', 'Author One'): 'Renamed Author'})
+        check(), check(restriction)
+        cache.remove_items('series', (cache.get_item_id('series', 'series one'),))
+        cache.remove_books((2,))
+        check(), check(restriction)
+        # Removing a series item from books whose series index is already 1.0
+        cache.set_field('series_index', {3: 1.0})
+        cache.get_categories()
+        cache.remove_items('series', (cache.get_item_id('series', 'A Series One'),))
+        self.assertNotIn('A Series One', {x.name for x in cache.get_categories()['series']})
+        check(), check(restriction)
+        self.assertEqual(as_data(cache.get_categories(book_ids=())), as_data(cache.get_categories(book_ids=set())))
+        # The book ids of restricted categories do not change under the caller
+        cache.set_field('tags', {1: ('News',), 3: ('News',)})
+        tag = next(t for t in cache.get_categories(book_ids=(1, 3))['tags'] if t.name == 'News')
+        self.assertEqual(tag.id_set, {1, 3})
+        cache.set_field('tags', {1: ()})
+        cache.get_categories(book_ids=(1, 3))
+        self.assertEqual(tag.id_set, {1, 3})
+        # Link table entries whose items do not exist are removed
+        library_path = cache.backend.library_path
+        cache.backend.execute('DROP TRIGGER fkc_insert_books_tags_link')
+        cache.backend.execute('INSERT INTO books_tags_link (book, tag) VALUES (1, 9999)')
+        cache.close()
+        cache = self.init_cache(library_path)
+        self.assertIn(9999, cache.fields['tags'].table.col_book_map)
+        self.assertNotIn(9999, {t.id for t in cache.get_categories()['tags']})
+        self.assertNotIn(9999, cache.fields['tags'].table.col_book_map)
+        self.assertFalse(cache.backend.execute('SELECT * FROM books_tags_link WHERE tag=9999').fetchall())
+        check(), check(restriction)
+
+    # }}}
+
     def test_set_cover(self):  # {{{
         "Test setting of cover"
         cache = self.init_cache()
@@ -546,6 +661,68 @@ def test_set_metadata(self):  # {{{
 
     # }}}
 
+    def test_set_metadata_bulk(self):  # {{{
+        "Test setting metadata for many books at once"
+        from calibre.db.listeners import EventType
+
+        cache = self.init_cache(self.cloned_library)
+        mi_map = {book_id: cache.get_metadata(book_id, get_cover=True, cover_as_data=True) for book_id in (1, 2, 3)}
+        mi_map = {1: mi_map[3], 2: mi_map[1], 3: mi_map[2]}
+        mi_map[1].authors = ['Bulk Author']
+        mi_map[2].title = 'Bulk Title'
+        mi_map[3].set('#tags', ['bulk one', 'bulk two'])
+        cache.close()
+        library_path = self.cloned_library
+        expected, bulk = self.init_cache(library_path), self.init_cache(self.clone_library(library_path))
+        events = []
+
+        def listener(*args):
+            events.append(args)
+
+        bulk.add_listener(listener)
+        for force_changes in (False, True):
+            dirtied = set()
+            for book_id, mi in mi_map.items():
+                dirtied |= expected.set_metadata(book_id, mi.deepcopy(), force_changes=force_changes)
+            self.assertTrue(dirtied)
+            self.assertEqual(bulk.set_metadata_bulk({k: v.deepcopy() for k, v in mi_map.items()}, force_changes=force_changes), dirtied)
+            for book_id in mi_map:
+                self.compare_metadata(
+                    expected.get_metadata(book_id, get_cover=True, cover_as_data=True),
+                    bulk.get_metadata(book_id, get_cover=True, cover_as_data=True),
+                    exclude={'last_modified', 'format_metadata', 'formats', 'pages'},
+                )
+            if not force_changes:
+                bulk.event_dispatcher.close()
+                changed_fields = [args[0] for event_type, library_id, args in events if event_type is EventType.metadata_changed]
+                self.assertTrue(changed_fields)
+                self.assertEqual(len(changed_fields), len(set(changed_fields)), 'each field should cause only one event')
+
+        # A bad value for one book must not stop the others being set when
+        # errors are ignored
+        timestamp = utcnow().replace(microsecond=0)
+        bad = Metadata('Bad', ['Author'])
+        bad.timestamp = 'not a date'
+        bad.cover_data = ('jpeg', b'not an image')
+        mi_map = {1: bad}
+        for book_id in (2, 3):
+            mi_map[book_id] = mi = Metadata(f'Good {book_id}', ['Author'])
+            mi.timestamp = timestamp
+            mi.cover_data = ('jpeg', IMG)
+        self.assertRaises(Exception, bulk.set_metadata_bulk, {1: bad})
+        bulk.set_cover({1: None, 2: None, 3: None})
+        old_timestamp = bulk.field_for('timestamp', 1)
+        bulk.set_metadata_bulk(mi_map, ignore_errors=True)
+        self.assertEqual(bulk.field_for('title', 1), 'Bad')
+        self.assertEqual(bulk.field_for('timestamp', 1), old_timestamp)
+        self.assertFalse(bulk.field_for('cover', 1))
+        for book_id in (2, 3):
+            self.assertEqual(bulk.field_for('title', book_id), f'Good {book_id}')
+            self.assertEqual(bulk.field_for('timestamp', book_id), timestamp)
+            self.assertTrue(bulk.field_for('cover', book_id))
+
+    # }}}
+
     def test_conversion_options(self):  # {{{
         "Test saving of conversion options"
         cache = self.init_cache()
@@ -786,6 +963,69 @@ def test_invalidate():
 
     # }}}
 
+    def test_composite_dependencies(self):  # {{{
+        "Test that composite caches are only invalidated when the fields they use change"
+        from calibre.utils.formatter import template_field_references as tfr
+
+        self.assertEqual(tfr('{title} - {#series:ifempty(x)}'), {'title', '#series'})
+        self.assertEqual(tfr('{tags:|[|]} {author_sort:0>5s}'), {'tags', 'author_sort'})
+        self.assertEqual(tfr("{:'uppercase($authors)'}"), {'authors'})
+        self.assertEqual(tfr("program: strcat(field('title'), raw_field('#rating'), $$pubdate)"), {'title', '#rating', 'pubdate'})
+        self.assertEqual(tfr('constant'), set())
+        for template in (
+            "program: field(strcat('ti', 'tle'))",
+            "program: book_count('tags:=a', 0)",
+            "program: for x in 'a,b': x rof",
+            "{:'virtual_libraries()'}",
+            'python:\ndef evaluate(book, ctx):\n    return book.title',
+            'program: (((',
+        ):
+            self.assertIsNone(tfr(template), template)
+
+        cache = self.init_cache()
+        cache.create_custom_column('tc', 'TC', 'composite', False, display={'composite_template': '{title}:{#tc2}'})
+        cache.create_custom_column('tc2', 'TC2', 'composite', False, display={'composite_template': '{series_index}'})
+        cache.create_custom_column('vl', 'VL', 'composite', False, display={'composite_template': "{:'virtual_libraries()'}"})
+        cache.create_custom_column('ts', 'TS', 'composite', False, display={'composite_template': '{series}'})
+        cache.close()
+        cache = self.init_cache()
+        deps = cache._composite_dependencies()
+        self.assertEqual(deps['#tc'], {'title', 'sort', 'series_index'})
+        self.assertEqual(deps['#tc2'], {'series_index'})
+        self.assertIsNone(deps['#vl'])
+        self.assertEqual(deps['#ts'], {'series', 'series_index'})
+        self.assertIs(deps, cache._composite_dependencies())
+
+        def cached(name):
+            return set(cache.fields[name]._render_cache)
+
+        def fill():
+            for name in ('#tc', '#tc2', '#vl'):
+                for book_id in (1, 2):
+                    cache.field_for(name, book_id)
+
+        fill()
+        cache.set_field('tags', {1: 'composite-deps-tag'})
+        self.assertEqual(cached('#tc'), {1, 2})
+        self.assertEqual(cached('#vl'), {2})
+        cache.set_field('series_index', {1: 7.5})
+        self.assertEqual(cached('#tc'), {2})
+        self.assertEqual(cached('#tc2'), {2})
+        self.assertEqual(cache.field_for('#tc', 1), '{}:{}'.format(cache.field_for('title', 1), cache.field_for('#tc2', 1)))
+        fill()
+        cache.set_field('title', {2: 'changed'})
+        self.assertEqual(cached('#tc'), {1})
+        self.assertEqual(cached('#tc2'), {1, 2})
+        self.assertEqual(cache.field_for('#tc', 2), 'changed:' + cache.field_for('#tc2', 2))
+        # Removing a series item from books whose series index is already 1.0
+        cache.set_field('series_index', {1: 1.0})
+        self.assertTrue(cache.field_for('#ts', 1))
+        cache.remove_items('series', (cache.get_item_id('series', cache.field_for('series', 1)),))
+        self.assertEqual(cache.field_for('#ts', 1), '')
+        cache.close()
+
+    # }}}
+
     def test_dump_and_restore(self):  # {{{
         "Test roundtripping the db through SQL"
         try:
@@ -1155,3 +1395,69 @@ def test_link_maps(self):
         self.assertEqual({}, cache.get_all_link_maps_for_book(1), 'Not all links for book were deleted')
 
     # }}}
+
+    def test_coalesced_events(self):  # {{{
+        "Test that listeners can receive events coalesced into batches"
+        from calibre.db.listeners import EventType
+
+        cache = self.init_cache(self.cloned_library)
+        batches = []
+
+        def listener(library_id, events):
+            batches.append(events)
+
+        self.assertTrue(cache.add_listener(listener, coalesce=True))
+        self.assertFalse(cache.add_listener(listener, check_already_added=True, coalesce=True))
+        cache.set_field('tags', {1: 'one'})
+        cache.set_field('tags', {2: 'two'})
+        cache.set_field('title', {3: 'three'})
+        cache.remove_books((2,))
+        cache.remove_items('tags', (cache.get_item_id('tags', 'one'),))
+        cache.event_dispatcher.close()
+        self.assertTrue(batches)
+        merged = {}
+        for events in batches:
+            for event_type, ce in events.items():
+                m = merged.setdefault(event_type, [0, set(), set()])
+                m[0] += ce.count
+                m[1] |= ce.book_ids
+                m[2] |= ce.fields
+        self.assertEqual(merged[EventType.metadata_changed], [3, {1, 2, 3}, {'tags', 'title'}])
+        self.assertEqual(merged[EventType.books_removed], [1, {2}, set()])
+        self.assertEqual(merged[EventType.items_removed], [1, {1}, {'tags'}])
+
+    # }}}
+
+    def test_identical_books_index(self):  # {{{
+        "Test that the index used by find_identical_books is kept up to date"
+        from calibre.db.utils import find_identical_books
+        from calibre.ebooks.metadata.book.base import Metadata
+
+        cache = self.init_cache(self.cloned_library)
+
+        def check(title, authors, books):
+            mi = Metadata(title, authors)
+            self.assertEqual(books, cache.find_identical_books(mi))
+            self.assertEqual(books, find_identical_books(mi, cache.data_for_find_identical_books()))
+
+        check('title one', ['author one'], {2})
+        cache.set_field('title', {2: 'The Title: One'})
+        check('title one', ['author one'], {2})
+        cache.set_field('title', {2: 'something else'})
+        check('title one', ['author one'], set())
+        check('Something Else', ['Author One'], {2})
+        cache.rename_items('authors', {cache.get_item_id('authors', 'Author One'): 'Author Renamed'})
+        check('something else', ['author one'], set())
+        check('something else', ['author renamed'], {2})
+        check('title two', ['author renamed', 'author two'], {1})
+        book_id = cache.add_books([(Metadata('Something Else', ['Author Renamed']), {})])[0][0]
+        check('something else', ['author renamed'], {2, book_id})
+        self.assertEqual(cache.find_identical_books(Metadata('something else', ['author renamed']), book_ids={book_id}), {book_id})
+        self.assertEqual(cache.find_identical_books(Metadata('something else', ['author renamed']), search_restriction='id:2'), {2})
+        cache.remove_books((2,))
+        check('something else', ['author renamed'], {book_id})
+        cache.set_field('authors', {book_id: ['Other Author']})
+        check('something else', ['author renamed'], set())
+        check('something else', ['other author'], {book_id})
+
+    # }}}
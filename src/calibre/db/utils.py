@@ -10,7 +10,7 @@
 from collections import OrderedDict, namedtuple
 from contextlib import suppress
 from locale import localeconv
-from threading import RLock
+from threading import Lock, RLock
 
 from calibre import as_unicode, prints
 from calibre.constants import cache_dir, get_windows_number_formats, iswindows, preferred_encoding
@@ -464,6 +464,142 @@ def key(x):
     return key
 
 
+class SortIndex:
+    """
+    The sort keys of all books for a field, along with the dense rank of every
+    book in sorted order, so that sorting on multiple fields reduces to
+    comparing tuples of integers. Sort keys are invalidated per book when the
+    fields they depend on change and the ranks are recomputed from the
+    remaining cached keys on demand. Recomputing the ranks means sorting all
+    books, so it is only done when a large share of the books is being
+    sorted, smaller sorts are cheaper without the index.
+    """
+
+    #: The smallest fraction of all books that must be sorted for the ranks to
+    #: be recomputed
+    min_share = 0.25
+
+    def __init__(self, depends_on):
+        self.depends_on = frozenset(depends_on)
+        self.keys = {}
+        self.ranks = None
+        self.sortable = True
+
+    def invalidate(self, book_ids=None):
+        if book_ids is None:
+            self.keys = {}
+        else:
+            for book_id in book_ids:
+                self.keys.pop(book_id, None)
+        self.ranks = None
+        self.sortable = True
+
+    def ranks_for(self, book_ids, create_keyfunc, num_to_sort=None):
+        """
+        Return a mapping of book id to rank for all the specified books or
+        None if the sort keys are not comparable with each other or if the
+        ranks would have to be recomputed to sort only num_to_sort books,
+        which is less than min_share of the specified books.
+        """
+        if not self.sortable:
+            return None
+        keys = self.keys
+        missing = set(book_ids).difference(keys)
+        if not missing and self.ranks is not None:
+            return self.ranks
+        if num_to_sort is not None and num_to_sort < self.min_share * len(book_ids):
+            return None
+        if missing:
+            keyfunc = create_keyfunc()
+            for book_id in missing:
+                keys[book_id] = keyfunc(book_id)
+        try:
+            ordered = sorted(keys.items(), key=lambda x: x[1])
+        except TypeError:
+            # Not retried until the keys change
+            self.sortable = False
+            return None
+        ranks = {}
+        rank, prev = -1, None
+        for book_id, key in ordered:
+            if rank < 0 or prev < key:
+                rank += 1
+                prev = key
+            ranks[book_id] = rank
+        self.ranks = ranks
+        return ranks
+
+
+class IdenticalBooksIndex:
+    """
+    Maps the fuzzy title and the lowercased author names of every book to the
+    books that have them, so that finding the possible duplicates of a book
+    does not require scanning the library. The index is built on first use and
+    then updated per book as titles and authors change.
+    """
+
+    depends_on = frozenset(('title', 'authors'))
+
+    def __init__(self):
+        self.lock = Lock()
+        self.book_keys = None
+        self.title_map = {}
+        self.author_map = {}
+        self.stale = set()
+
+    def invalidate(self, book_ids=None, changed_fields=None):
+        if changed_fields is not None and self.depends_on.isdisjoint(changed_fields):
+            return
+        with self.lock:
+            if book_ids is None:
+                self.book_keys = None
+            elif self.book_keys is not None:
+                self.stale.update(book_ids)
+
+    def _add(self, book_id, title, authors):
+        title = fuzzy_title(title or '')
+        authors = frozenset(icu_lower(a) for a in authors or ())
+        self.book_keys[book_id] = title, authors
+        self.title_map.setdefault(title, set()).add(book_id)
+        for a in authors:
+            self.author_map.setdefault(a, set()).add(book_id)
+
+    def _remove(self, book_id):
+        keys = self.book_keys.pop(book_id, None)
+        if keys is not None:
+            title, authors = keys
+            for m, key in ((self.title_map, title),) + tuple((self.author_map, a) for a in authors):
+                books = m.get(key)
+                if books is not None:
+                    books.discard(book_id)
+                    if not books:
+                        del m[key]
+
+    def find(self, title, authors, all_book_ids, keys_for):
+        """
+        Return the ids of all books having the fuzzy matched title and at least
+        the specified authors. keys_for(book_ids) must yield (book_id, title,
+        authors) for the specified books, it is used to (re)index books.
+        """
+        with self.lock:
+            if self.book_keys is None:
+                self.book_keys, self.title_map, self.author_map, self.stale = {}, {}, {}, set()
+                for book_id, btitle, bauthors in keys_for(all_book_ids):
+                    self._add(book_id, btitle, bauthors)
+            elif self.stale:
+                stale, self.stale = self.stale, set()
+                for book_id in stale:
+                    self._remove(book_id)
+                for book_id, btitle, bauthors in keys_for(stale.intersection(all_book_ids)):
+                    self._add(book_id, btitle, bauthors)
+            ans = set(self.title_map.get(fuzzy_title(title or ''), ()))
+            for a in authors:
+                if not ans:
+                    break
+                ans &= self.author_map.get(icu_lower(a), set())
+            return ans
+
+
 def human_readable_interval(secs):
     secs = int(secs)
     days = secs // 86400
@@ -0,0 +1,207 @@
+#!/usr/bin/env python
+# License: GPLv3 Copyright: 2026, Kovid Goyal <kovid at kovidgoyal.net>
+
+"""
+Read-only snapshots of the field values of all books in a library. Readers
+of a snapshot never wait for writers. Writers only record which values they
+changed. A new snapshot is then published by the first reader that finds
+no write in progress, so every snapshot is a consistent view of the library
+as it was between writes.
+"""
+
+import weakref
+from threading import Lock
+
+from calibre.db.locking import LockingError, try_lock
+from calibre.db.search import RELATED_FIELDS
+from calibre.db.tables import null
+
+CHUNK_BITS = 10
+EMPTY_CHUNK = {}
+
+
+def unshared(val):
+    # Values in a snapshot are shared by all its readers, so give each caller
+    # its own copy of mutable values, such as identifiers
+    return val.copy() if isinstance(val, (dict, list, set)) else val
+
+
+class ChunkedMap:
+    """
+    An immutable mapping of book id to value, split into chunks of
+    consecutive book ids, so that a modified copy can be made by copying only
+    the chunks that changed.
+    """
+
+    __slots__ = ('chunks',)
+
+    def __init__(self, chunks=()):
+        self.chunks = tuple(chunks)
+
+    @classmethod
+    def from_items(cls, items):
+        chunks = []
+        for book_id, val in items:
+            i = book_id >> CHUNK_BITS
+            if i >= len(chunks):
+                chunks.extend({} for _ in range(i + 1 - len(chunks)))
+            chunks[i][book_id] = val
+        return cls(chunks)
+
+    def get(self, book_id, default=None):
+        try:
+            return self.chunks[book_id >> CHUNK_BITS].get(book_id, default)
+        except IndexError, TypeError:
+            return default
+
+    def updated(self, changes):
+        """Return a copy of this map with the specified changes applied. A value of null means the book is removed from the map."""
+        chunks = list(self.chunks)
+        copied = set()
+        for book_id, val in changes.items():
+            i = book_id >> CHUNK_BITS
+            if i >= len(chunks):
+                chunks.extend(EMPTY_CHUNK for _ in range(i + 1 - len(chunks)))
+            if i not in copied:
+                chunks[i] = dict(chunks[i])
+                copied.add(i)
+            if val is null:
+                chunks[i].pop(book_id, None)
+            else:
+                chunks[i][book_id] = val
+        return ChunkedMap(chunks)
+
+
+class Snapshot:
+    """
+    The values of fields for all books, as they were at some point in time
+    when no write was in progress. Obtain one with
+    :meth:`calibre.db.cache.Cache.snapshot`. Values of fields that are not yet
+    part of the snapshot, as well as composite columns, are read from the
+    cache, waiting for any write in progress to finish. Such fields are added
+    to the next snapshot.
+    """
+
+    __slots__ = ('book_ids', 'cache_ref', 'defaults', 'maps', 'version')
+
+    def __init__(self, cache_ref, version=0, book_ids=frozenset(), maps=None, defaults=None):
+        self.cache_ref, self.version, self.book_ids = cache_ref, version, book_ids
+        self.maps, self.defaults = maps or {}, defaults or {}
+
+    def all_book_ids(self, type=frozenset):
+        return type(self.book_ids)
+
+    def has_id(self, book_id):
+        return book_id in self.book_ids
+
+    def field_for(self, name, book_id, default_value=None):
+        "Same as :meth:`calibre.db.cache.Cache.field_for`"
+        m = self.maps.get(name)
+        if m is None:
+            cache = self.cache_ref()
+            cache.versions.request(name)
+            with cache.safe_read_lock:
+                return cache._field_for(name, book_id, default_value=default_value)
+        default_value = self.defaults.get(name, default_value)
+        return unshared(m.get(book_id, default_value))
+
+    def all_field_for(self, name, book_ids, default_value=None):
+        "Same as :meth:`calibre.db.cache.Cache.all_field_for`"
+        m = self.maps.get(name)
+        if m is None:
+            cache = self.cache_ref()
+            cache.versions.request(name)
+            with cache.safe_read_lock:
+                return cache._all_field_for(name, book_ids, default_value=default_value)
+        default_value = self.defaults.get(name, default_value)
+        return {book_id: unshared(m.get(book_id, default_value)) for book_id in book_ids}
+
+
+class Versions:
+    """
+    Maintains the current :class:`Snapshot` for a cache. mark_stale() must be
+    called with the write lock held, everything else is thread safe.
+    """
+
+    def __init__(self, cache):
+        self.cache_ref = weakref.ref(cache)
+        self.publish_lock = Lock()
+        self.current = Snapshot(self.cache_ref)
+        self.all_stale = True
+        self.stale_fields = set()
+        self.stale_books = {}
+        self.requested = set()
+
+    def mark_stale(self, book_ids=None, changed_fields=None):
+        if changed_fields is not None:
+            changed_fields = set(changed_fields)
+            for name in tuple(changed_fields):
+                changed_fields.update(RELATED_FIELDS.get(name, ()))
+                changed_fields.add(name[: -len('_index')] if name.endswith('_index') else name + '_index')
+        if book_ids is None:
+            if changed_fields is None:
+                self.all_stale = True
+            else:
+                self.stale_fields |= changed_fields
+            return
+        for book_id in book_ids:
+            if changed_fields is None:
+                self.stale_books[book_id] = None
+            else:
+                existing = self.stale_books.get(book_id, null)
+                if existing is null:
+                    self.stale_books[book_id] = set(changed_fields)
+                elif existing is not None:
+                    existing |= changed_fields
+
+    def request(self, name):
+        cache = self.cache_ref()
+        field = cache.fields.get(name)
+        if field is not None and not field.is_composite and name != 'ondevice':
+            self.requested.add(name)
+
+    def snapshot(self):
+        """
+        Return the latest snapshot, first publishing a new one if there have
+        been changes since the last snapshot, provided that can be done without
+        waiting for a writer.
+        """
+        if self.all_stale or self.stale_fields or self.stale_books or self.requested:
+            try:
+                with try_lock(self.cache_ref().read_lock) as got_read_lock, try_lock(self.publish_lock) as got_publish_lock:
+                    if got_read_lock and got_publish_lock:
+                        self.publish()
+            except LockingError:
+                pass  # This thread holds the write lock, so it cannot publish
+        return self.current
+
+    def publish(self):
+        cache = self.cache_ref()
+        current = self.current
+        tracked = set(current.maps) | self.requested
+        if self.all_stale:
+            rebuild, changes = tracked, {}
+            book_ids = cache._all_book_ids()
+        else:
+            rebuild = (self.stale_fields & tracked) | self.requested
+            changes = {}
+            for book_id, fields in self.stale_books.items():
+                for name in tracked - rebuild if fields is None else (fields & tracked) - rebuild:
+                    changes.setdefault(name, {})[book_id] = self.value_for(cache, name, book_id)
+            book_ids = current.book_ids
+            if any(cache._has_id(book_id) != (book_id in book_ids) for book_id in self.stale_books):
+                book_ids = cache._all_book_ids()
+        maps = dict(current.maps)
+        for name in rebuild:
+            maps[name] = ChunkedMap.from_items((book_id, val) for book_id in book_ids if (val := self.value_for(cache, name, book_id)) is not null)
+        for name, field_changes in changes.items():
+            maps[name] = maps[name].updated(field_changes)
+        defaults = {name: cache.fields[name].default_value for name in maps if cache.fields[name].is_multiple}
+        self.all_stale, self.stale_fields, self.stale_books, self.requested = False, set(), {}, set()
+        self.current = Snapshot(self.cache_ref, current.version + 1, book_ids, maps, defaults)
+
+    def value_for(self, cache, name, book_id):
+        try:
+            return cache.fields[name].for_book(book_id, default_value=null)
+        except KeyError, IndexError:
+            return null
@@ -166,10 +166,7 @@ def doit(self):
 
         library_broker = get_gui(fail_if_absent=True).library_broker
         newdb = library_broker.get_library(self.loc)
-        self.find_identical_books_data = None
         try:
-            if self.check_for_duplicates:
-                self.find_identical_books_data = newdb.new_api.data_for_find_identical_books()
             self._doit(newdb)
         finally:
             library_broker.prune_loaded_dbs()
@@ -198,7 +195,6 @@ def do_one(self, num, book_id, newdb):
             preserve_date=gprefs['preserve_date_on_ctl'],
             duplicate_action=duplicate_action,
             automerge_action=gprefs['automerge'],
-            identical_books_data=self.find_identical_books_data,
             preserve_uuid=self.delete_after,
         )
         self.progress(num, rdata['title'])
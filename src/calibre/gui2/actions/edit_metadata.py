@@ -241,12 +241,17 @@ def do_paste(self, ignore_excluded_fields=False):
         book_ids = {db.id(r.row()) for r in rows}
         title_excluded = 'title' in exclude
         authors_excluded = 'authors' in exclude
+        mi_map = {}
         for book_id in book_ids:
+            bmi = mi
+            if title_excluded or authors_excluded:
+                bmi = mi.deepcopy_metadata()
             if title_excluded:
-                mi.title = db.new_api.field_for('title', book_id)
+                bmi.title = db.new_api.field_for('title', book_id)
             if authors_excluded:
-                mi.authors = db.new_api.field_for('authors', book_id)
-            db.new_api.set_metadata(book_id, mi, ignore_errors=True)
+                bmi.authors = db.new_api.field_for('authors', book_id)
+            mi_map[book_id] = bmi
+        db.new_api.set_metadata_bulk(mi_map, ignore_errors=True)
         if cover:
             db.new_api.set_cover({book_id: cover for book_id in book_ids})
         self.refresh_books_after_metadata_edit(book_ids)
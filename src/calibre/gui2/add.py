@@ -19,7 +19,6 @@
 from calibre.constants import DEBUG, filesystem_encoding, ismacos, iswindows
 from calibre.customize.ui import run_plugins_on_postadd, run_plugins_on_postimport
 from calibre.db.adding import compile_rule, find_books_in_directory
-from calibre.db.utils import find_identical_books
 from calibre.ebooks.metadata import authors_to_sort_string
 from calibre.ebooks.metadata.book.base import Metadata
 from calibre.ebooks.metadata.opf2 import OPF
@@ -156,9 +155,9 @@ def break_cycles(self):
             assert tdir is not None
             shutil.rmtree(tdir, ignore_errors=True)
         self.setParent(None)
-        self.find_identical_books_data = self.merged_books = self.added_duplicate_info = self.pool = self.items = self.duplicates = self.pd = self.db = (
-            self.dbref
-        ) = self.tdir = self.file_groups = self.scan_thread = None  # noqa: E501
+        self.merged_books = self.added_duplicate_info = self.pool = self.items = self.duplicates = self.pd = self.db = self.dbref = self.tdir = (
+            self.file_groups
+        ) = self.scan_thread = None  # noqa: E501
         self.deleteLater()
 
     def tick(self):
@@ -308,21 +307,18 @@ def monitor_scan(self):
         pd.msg = ''
         pd.value = 0
         self.pool = Pool(name='AddBooks') if self.pool is None else self.pool
-        if self.db is not None:
-            if self.add_formats_to_existing:
-                self.find_identical_books_data = self.db.data_for_find_identical_books()
-            else:
-                try:
-                    self.pool.set_common_data(self.db.data_for_has_book())
-                except Failure as err:
-                    error_dialog(
-                        pd,
-                        _('Cannot add books'),
-                        _('Failed to add any books, click "Show details" for more information.'),
-                        det_msg=as_unicode(err.failure_message) + '\n' + as_unicode(err.details),
-                        show=True,
-                    )
-                    pd.canceled = True
+        if self.db is not None and not self.add_formats_to_existing:
+            try:
+                self.pool.set_common_data(self.db.data_for_has_book())
+            except Failure as err:
+                error_dialog(
+                    pd,
+                    _('Cannot add books'),
+                    _('Failed to add any books, click "Show details" for more information.'),
+                    det_msg=as_unicode(err.failure_message) + '\n' + as_unicode(err.details),
+                    show=True,
+                )
+                pd.canceled = True
         self.groups_to_add = iter(self.file_groups)
         self.do_one = self.do_one_group
         self.do_one_signal.emit()
@@ -483,7 +479,7 @@ def process_result(self, group_id, result):
             return
 
         if self.add_formats_to_existing:
-            identical_book_ids = find_identical_books(mi, self.find_identical_books_data)
+            identical_book_ids = self.db.find_identical_books(mi)
             if identical_book_ids:
                 try:
                     self.merge_books(mi, cover_path, paths, identical_book_ids)
@@ -563,19 +559,15 @@ def add_book(self, mi, cover_path, paths):
             a(_('With error:')), a(traceback.format_exc())
             return
         self.add_formats(book_id, paths, mi, is_an_add=True)
-        try:
-            if self.add_formats_to_existing:
-                db = self.db
-                assert db is not None
-                db.update_data_for_find_identical_books(book_id, self.find_identical_books_data)
-            else:
+        if not self.add_formats_to_existing:
+            try:
                 added_duplicate_info = self.added_duplicate_info
                 assert added_duplicate_info is not None
                 added_duplicate_info.add(icu_lower(mi.title or _('Unknown')))
-        except Exception:
-            # Ignore this exception since all it means is that duplicate
-            # detection/automerge will fail for this book.
-            traceback.print_exc()
+            except Exception:
+                # Ignore this exception since all it means is that duplicate
+                # detection will fail for this book.
+                traceback.print_exc()
         if DEBUG:
             prints('Added', mi.title, f'to db in: {time.time() - st:.1f}')
 
@@ -202,13 +202,8 @@ class ListenerSignal(QObject):
 listener_object = ListenerSignal()
 
 
-def book_metatada_changed(event_type: EventType, library_id, event_data):
-    if event_type not in (
-        EventType.book_created,
-        EventType.books_removed,
-        EventType.book_edited,
-        EventType.indexing_progress_changed,
-    ):
+def book_metatada_changed(library_id, events):
+    if not frozenset(events).issubset((EventType.book_created, EventType.books_removed, EventType.book_edited, EventType.indexing_progress_changed)):
         listener_object.metadata_changed.emit()
 
 
@@ -346,7 +341,7 @@ def __init__(self, parent, view, row, link_delegate, dialog_number=None, library
             hl.addWidget(self.clabel)
         self.fit_cover.stateChanged.connect(self.toggle_cover_fit)
         if dialog_number == DialogNumbers.Locked:
-            get_gui(fail_if_absent=True).current_db.new_api.add_listener(book_metatada_changed, check_already_added=True)
+            get_gui(fail_if_absent=True).current_db.new_api.add_listener(book_metatada_changed, check_already_added=True, coalesce=True)
             listener_object.metadata_changed.connect(self.do_update_book_details_debounce, type=Qt.ConnectionType.QueuedConnection)
         self.restore_geometry(gprefs, self.geometry_string('book_info_dialog_geometry'))
         try:
@@ -137,6 +137,7 @@ class Main(
     book_converted = pyqtSignal(object, object)
     enter_key_pressed_in_book_list = pyqtSignal(object)  # used by action chains plugin
     event_in_db = pyqtSignal(object, object, object)  # (db, event_type, event_data)
+    events_in_db = pyqtSignal(object, object)  # (db, {event_type: CoalescedEvent})
     shutdown_started = pyqtSignal()
     shutdown_completed = pyqtSignal()
     shutting_down = False
@@ -236,12 +237,18 @@ def add_istore(self, st):
         else:
             stmap[st.name] = st
 
-    def add_db_listener(self, callback):
+    def add_db_listener(self, callback, coalesce=False):
+        """
+        Call callback with (db, event_type, event_data) for every change to
+        any open library. If coalesce is True, callback is instead called with
+        (db, {event_type: CoalescedEvent}) at most a few times a second, with
+        all the changes since the last call. See :meth:`calibre.db.cache.Cache.add_listener`.
+        """
         self.library_broker.start_listening_for_db_events()
-        self.event_in_db.connect(callback)
+        (self.events_in_db if coalesce else self.event_in_db).connect(callback)
 
-    def remove_db_listener(self, callback):
-        self.event_in_db.disconnect(callback)
+    def remove_db_listener(self, callback, coalesce=False):
+        (self.events_in_db if coalesce else self.event_in_db).disconnect(callback)
 
     def initialize(self, library_path, db, actions, show_gui=True):
         opts = self.opts
@@ -1434,10 +1441,11 @@ def shutdown(self, write_settings=True):
         timed_print('Shutdown message shown...')
         self.server_change_notification_timer.stop()
         self.extra_files_watcher.clear()
-        try:
-            self.event_in_db.disconnect()
-        except Exception:
-            pass
+        for signal in (self.event_in_db, self.events_in_db):
+            try:
+                signal.disconnect()
+            except Exception:
+                pass
 
         from calibre.customize.ui import has_library_closed_plugins
 
@@ -12,6 +12,7 @@
 from calibre.srv.content import get as get_content
 from calibre.srv.content import icon as get_icon
 from calibre.srv.errors import BookNotFound, HTTPBadRequest, HTTPNotFound
+from calibre.srv.pool import SLOW
 from calibre.srv.routes import endpoint, json
 from calibre.srv.utils import custom_fields_to_display, decode_name, encode_name, get_db, http_date
 from calibre.utils.config import prefs, tweaks
@@ -241,7 +242,7 @@ def books(ctx, rd, library_id):
 # Categories (Tag Browser) {{{
 
 
-@endpoint('/ajax/categories/{library_id=None}', postprocess=json)
+@endpoint('/ajax/categories/{library_id=None}', postprocess=json, job_class=SLOW)
 def categories(ctx, rd, library_id):
     """
     Return the list of top-level categories as a list of dictionaries. Each
@@ -517,12 +518,13 @@ def books_in(ctx, rd, encoded_category, encoded_item, library_id):
         get_additional_fields = rd.query.get('get_additional_fields')
         if get_additional_fields:
             additional_fields = {}
+            snapshot = db.snapshot()
             for field in get_additional_fields.split(','):
                 field = field.strip()
                 if field:
                     flist = additional_fields[field] = []
                     for id_ in ids:
-                        flist.append(db.field_for(field, id_, default_value=None))
+                        flist.append(snapshot.field_for(field, id_, default_value=None))
             if additional_fields:
                 result['additional_fields'] = additional_fields
         return result
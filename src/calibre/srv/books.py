@@ -6,9 +6,10 @@
 import os
 import tempfile
 import time
+from collections import OrderedDict
 from functools import partial
 from hashlib import sha256
-from threading import Lock, RLock
+from threading import Event, Lock, RLock, Thread
 
 from calibre.constants import cache_dir, iswindows
 from calibre.customize.ui import plugin_for_input_format
@@ -16,6 +17,7 @@
 from calibre.srv.errors import BookNotFound, HTTPNotFound
 from calibre.srv.last_read import last_read_cache
 from calibre.srv.metadata import book_as_json
+from calibre.srv.pool import BULK
 from calibre.srv.render_book import RENDER_VERSION
 from calibre.srv.routes import endpoint, json
 from calibre.srv.utils import get_db, get_library_data
@@ -75,44 +77,188 @@ def safe_remove(x, is_file=None):
 def queue_job(ctx, copy_format_to, bhash, fmt, book_id, size, mtime):
     global staging_cleaned
     tdir = os.path.join(books_cache_dir(), 's')
-    if not staging_cleaned:
-        staging_cleaned = True
-        for x in os.listdir(tdir):
-            safe_remove(os.path.join(tdir, x))
+    with cache_lock:
+        rendered_books.set_budget(ctx.opts.reader_cache_size)
+        if not staging_cleaned:
+            staging_cleaned = True
+            for x in os.listdir(tdir):
+                safe_remove(os.path.join(tdir, x))
     fd, pathtoebook = tempfile.mkstemp(prefix='', suffix=('.' + fmt.lower()), dir=tdir)
     with os.fdopen(fd, 'wb') as f:
         copy_format_to(f)
     tdir = tempfile.mkdtemp('', '', tdir)
-    job_id = ctx.start_job(
-        f'Render book {book_id} ({fmt})',
-        'calibre.srv.render_book',
-        'render',
-        args=(pathtoebook, tdir, {'size': size, 'mtime': mtime, 'hash': bhash}),
-        job_done_callback=job_done,
-        job_data=(bhash, pathtoebook, tdir),
-    )
-    queued_jobs[bhash] = job_id
+    with cache_lock:
+        job_id = ctx.start_job(
+            f'Render book {book_id} ({fmt})',
+            'calibre.srv.render_book',
+            'render',
+            args=(pathtoebook, tdir, {'size': size, 'mtime': mtime, 'hash': bhash}),
+            job_done_callback=job_done,
+            job_data=(bhash, pathtoebook, tdir),
+        )
+        if job_id is None:
+            queued_jobs.pop(bhash, None)
+        else:
+            queued_jobs[bhash] = job_id
     return job_id
 
 
-last_final_clean_time = 0
+def dir_size(path):
+    ans = 0
+    for dirpath, dirnames, filenames in os.walk(path):
+        for name in filenames:
+            try:
+                ans += os.lstat(os.path.join(dirpath, name)).st_size
+            except OSError:
+                pass
+    return ans
 
 
-def clean_final(interval=24 * 60 * 60):
-    global last_final_clean_time
-    now = time.time()
-    if now - last_final_clean_time < interval:
-        return
-    last_final_clean_time = now
-    fdir = os.path.join(books_cache_dir(), 'f')
-    for x in os.listdir(fdir):
+class RenderedBooks:
+    """
+    Index of the books rendered for the web reader in books_cache_dir()/f,
+    ordered from least to most recently accessed. When the total size of the
+    rendered books exceeds the budget, the least recently accessed ones are
+    removed. Books accessed within pin_time are never removed, as they are
+    likely being read. With no budget, books not accessed for max_age are
+    removed instead. Access times are recorded in memory and in the mtime of
+    the book manifest, which is used to rebuild the index after a restart.
+    That requires walking the whole cache, so it is done in a background
+    thread, books are only evicted once it is done.
+    """
+
+    pin_time = 30 * 60
+    max_age = 24 * 60 * 60
+
+    def __init__(self):
+        self.lock = RLock()
+        self.entries = OrderedDict()
+        self.total_size = self.budget = 0
+        self.loader = None
+        self.loaded = Event()
+        # Books removed while the index is being built, so that it does not
+        # add them back
+        self.removed_while_loading = set()
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.counters = {'hits': 0, 'misses': 0, 'added': 0, 'evicted': 0, 'evicted_size': 0}
+
+    def set_budget(self, size_in_mb):
+        with self.lock:
+            self.budget = max(0, int(size_in_mb * 1024 * 1024))
+
+    def ensure_loaded(self, wait=False):
+        with self.lock:
+            if self.loader is None:
+                self.loader = Thread(target=self.load, name='RenderedBooksIndexer', daemon=True)
+                self.loader.start()
+        if wait:
+            self.loaded.wait()
+
+    def load(self):
         try:
-            tm = os.path.getmtime(os.path.join(fdir, x, 'calibre-book-manifest.json'))
-        except OSError:
-            continue
-        if now - tm >= interval:
-            # This book has not been accessed for a long time, delete it
-            safe_remove(x)
+            fdir = os.path.join(books_cache_dir(), 'f')
+            found = []
+            for x in os.listdir(fdir):
+                try:
+                    tm = os.path.getmtime(os.path.join(fdir, x, 'calibre-book-manifest.json'))
+                except OSError:
+                    continue
+                found.append((tm, x, dir_size(os.path.join(fdir, x))))
+            found.sort()
+            with self.lock:
+                # Books added or accessed while the index was being built are
+                # the most recently accessed ones
+                entries = OrderedDict((bhash, [size, tm]) for tm, bhash, size in found if bhash not in self.entries and bhash not in self.removed_while_loading)
+                entries.update(self.entries)
+                self.entries = entries
+                self.total_size = sum(size for size, tm in entries.values())
+        except Exception:
+            import traceback
+
+            traceback.print_exc()
+        finally:
+            with self.lock:
+                self.removed_while_loading = set()
+                self.loaded.set()
+                self.evict()
+
+    def accessed(self, bhash, is_hit=False):
+        with self.lock:
+            self.ensure_loaded()
+            e = self.entries.get(bhash)
+            if e is not None:
+                e[1] = time.time()
+                self.entries.move_to_end(bhash)
+            if is_hit:
+                self.counters['hits'] += 1
+
+    def missed(self):
+        with self.lock:
+            self.counters['misses'] += 1
+
+    def add(self, bhash, path):
+        size = dir_size(path)
+        with self.lock:
+            self.ensure_loaded()
+            self.discard(bhash, remove_files=False)
+            self.entries[bhash] = [size, time.time()]
+            self.total_size += size
+            self.counters['added'] += 1
+            self.evict()
+
+    def discard(self, bhash, remove_files=True):
+        with self.lock:
+            e = self.entries.pop(bhash, None)
+            if e is not None:
+                self.total_size -= e[0]
+                if remove_files:
+                    safe_remove(os.path.join(books_cache_dir(), 'f', bhash), False)
+            if not self.loaded.is_set():
+                self.removed_while_loading.add(bhash)
+            return e
+
+    def evict(self):
+        with self.lock:
+            if not self.loaded.is_set():
+                return
+            now = time.time()
+            while self.entries:
+                bhash, (size, last_access) = next(iter(self.entries.items()))
+                if self.budget > 0:
+                    # All later entries were accessed more recently, so are pinned as well
+                    if self.total_size <= self.budget or now - last_access < self.pin_time:
+                        break
+                elif now - last_access < self.max_age:
+                    break
+                self.discard(bhash)
+                self.counters['evicted'] += 1
+                self.counters['evicted_size'] += size
+
+    def stats(self, reset=False):
+        """
+        Return the number and total size of the rendered books, the budget,
+        the number of books pinned, whether the index has been built, and
+        counters for cache hits and misses, renders added and books evicted,
+        as a dictionary. If reset is True the counters are reset after being
+        returned.
+        """
+        self.ensure_loaded()
+        with self.lock:
+            limit = time.time() - self.pin_time
+            pinned = 0
+            for size, last_access in reversed(self.entries.values()):
+                if last_access < limit:
+                    break
+                pinned += 1
+            ans = dict(self.counters, num_books=len(self.entries), size=self.total_size, budget=self.budget, pinned=pinned, loaded=self.loaded.is_set())
+            if reset:
+                self.reset_stats()
+        return ans
+
+
+rendered_books = RenderedBooks()
 
 
 def rename_with_retry(a, b, sleep_time=1):
@@ -136,16 +282,51 @@ def job_done(job):
             safe_remove(tdir, False)
         else:
             try:
-                clean_final()
                 dest = os.path.join(books_cache_dir(), 'f', bhash)
                 safe_remove(dest, False)
                 rename_with_retry(tdir, dest)
+                rendered_books.add(bhash, dest)
             except Exception:
                 import traceback
 
                 failed_jobs[bhash] = (False, traceback.format_exc())
 
 
+def render_key(db, book_id, fmt):
+    fm = db.format_metadata(book_id, fmt, allow_cache=False)
+    if not fm:
+        return
+    size, mtime = map(int, (fm['size'], time.mktime(fm['mtime'].utctimetuple()) * 10))
+    return book_hash(db.library_id, book_id, fmt, size, mtime), size, mtime
+
+
+def manifest_path(bhash):
+    return abspath(os.path.join(books_cache_dir(), 'f', bhash, 'calibre-book-manifest.json'))
+
+
+def prerender_book(ctx, db, book_id, fmt):
+    """
+    Queue a render of the specified format of the book for the web reader,
+    unless it has already been rendered, is being rendered or has failed to
+    render. Returns the id of the render job or None.
+    """
+    with db.safe_read_lock:
+        key = render_key(db, book_id, fmt)
+        if key is None:
+            return
+        bhash, size, mtime = key
+        with cache_lock:
+            if bhash in queued_jobs or bhash in failed_jobs or os.path.exists(manifest_path(bhash)):
+                return
+            queued_jobs[bhash] = None
+        try:
+            return queue_job(ctx, partial(db.copy_format_to, book_id, fmt), bhash, fmt, book_id, size, mtime)
+        except BaseException:
+            with cache_lock:
+                queued_jobs.pop(bhash, None)
+            raise
+
+
 @endpoint('/book-manifest/{book_id}/{fmt}', postprocess=json, types={'book_id': int})
 def book_manifest(ctx, rd, book_id, fmt):
     db, library_id = get_library_data(ctx, rd)[:2]
@@ -155,13 +336,12 @@ def book_manifest(ctx, rd, book_id, fmt):
     if not ctx.has_id(rd, db, book_id):
         raise BookNotFound(book_id, db)
     with db.safe_read_lock:
-        fm = db.format_metadata(book_id, fmt, allow_cache=False)
-        if not fm:
+        key = render_key(db, book_id, fmt)
+        if key is None:
             raise HTTPNotFound(f'No {fmt} format for the book (id:{book_id}) in the library: {library_id}')
-        size, mtime = map(int, (fm['size'], time.mktime(fm['mtime'].utctimetuple()) * 10))
-        bhash = book_hash(db.library_id, book_id, fmt, size, mtime)
+        bhash, size, mtime = key
         with cache_lock:
-            mpath = abspath(os.path.join(books_cache_dir(), 'f', bhash, 'calibre-book-manifest.json'))
+            mpath = manifest_path(bhash)
             if force_reload:
                 safe_remove(mpath, True)
             try:
@@ -172,6 +352,7 @@ def book_manifest(ctx, rd, book_id, fmt):
                 user = rd.username or None
                 ans['last_read_positions'] = db.get_last_read_positions(book_id, fmt, user) if user else []
                 ans['annotations_map'] = db.annotations_map_for_book(book_id, fmt, user_type='web', user=user or '*')
+                rendered_books.accessed(bhash, is_hit=True)
                 return ans
             except OSError as e:
                 if e.errno != errno.ENOENT:
@@ -179,14 +360,39 @@ def book_manifest(ctx, rd, book_id, fmt):
             x = failed_jobs.pop(bhash, None)
             if x is not None:
                 return {'aborted': x[0], 'traceback': x[1], 'job_status': 'finished'}
-            job_id = queued_jobs.get(bhash)
-            if job_id is None:
+            if bhash in queued_jobs:
+                job_id = queued_jobs[bhash]
+                if job_id is None:
+                    # Another request is copying the book to queue its render
+                    return {'aborted': False, 'traceback': None, 'job_status': 'waiting', 'job_id': None}
+            else:
+                rendered_books.missed()
+                # Reserve the render so that concurrent requests for this book
+                # do not queue it again, while the book is copied without
+                # holding the cache lock
+                queued_jobs[bhash] = job_id = None
+        if job_id is None:
+            try:
                 job_id = queue_job(ctx, partial(db.copy_format_to, book_id, fmt), bhash, fmt, book_id, size, mtime)
+            except BaseException:
+                with cache_lock:
+                    queued_jobs.pop(bhash, None)
+                raise
     status, result, tb, aborted = ctx.job_status(job_id)
     return {'aborted': aborted, 'traceback': tb, 'job_status': status, 'job_id': job_id}
 
 
-@endpoint('/book-file/{book_id}/{fmt}/{size}/{mtime}/{+name}', types={'book_id': int, 'size': int, 'mtime': int})
+@endpoint('/reader-cache-stats', postprocess=json, cache_control='no-cache')
+def reader_cache_stats(ctx, rd):
+    """
+    Statistics for the cache of books rendered for the web reader, see
+    RenderedBooks.stats(). Pass reset=1 to reset the counters.
+    """
+    ctx.check_for_write_access(rd)
+    return rendered_books.stats(rd.query.get('reset') == '1')
+
+
+@endpoint('/book-file/{book_id}/{fmt}/{size}/{mtime}/{+name}', types={'book_id': int, 'size': int, 'mtime': int}, job_class=BULK)
 def book_file(ctx, rd, book_id, fmt, size, mtime, name):
     db, library_id = get_library_data(ctx, rd)[:2]
     if not ctx.has_id(rd, db, book_id):
@@ -197,6 +403,7 @@ def book_file(ctx, rd, book_id, fmt, size, mtime, name):
         mpath = path_from_root(base, name)
     except ValueError:
         raise HTTPNotFound(f'No book file with hash: {bhash} and name: {name}')
+    rendered_books.accessed(bhash)
     try:
         return rd.filesystem_file_with_custom_etag(open(mpath, 'rb'), bhash, name)
     except OSError as e:
@@ -13,6 +13,7 @@
 from calibre.srv.changes import books_added, books_deleted, metadata
 from calibre.srv.errors import HTTPBadRequest, HTTPForbidden, HTTPNotFound
 from calibre.srv.metadata import book_as_json
+from calibre.srv.pool import SLOW
 from calibre.srv.routes import endpoint, json, msgpack_or_json
 from calibre.srv.utils import get_db, get_library_data
 from calibre.utils.imghdr import what
@@ -24,7 +25,7 @@
 receive_data_methods = {'GET', 'POST'}
 
 
-@endpoint('/cdb/cmd/{which}/{version=0}', postprocess=msgpack_or_json, methods=receive_data_methods, cache_control='no-cache')
+@endpoint('/cdb/cmd/{which}/{version=0}', postprocess=msgpack_or_json, methods=receive_data_methods, cache_control='no-cache', job_class=SLOW)
 def cdb_run(ctx, rd, which, version):
     try:
         m = module_for_cmd(which)
@@ -65,6 +66,13 @@ def cdb_run(ctx, rd, which, version):
     return {'result': result}
 
 
+@endpoint('/cdb/api-stats/{library_id=None}', postprocess=json, cache_control='no-cache')
+def cdb_api_stats(ctx, rd, library_id):
+    ctx.check_for_write_access(rd)
+    db = get_db(ctx, rd, library_id)
+    return {'result': db.api_stats(rd.query.get('reset') == '1')}
+
+
 def is_recipe_fmt(fmt: str) -> bool:
     fmt = fmt.lower().removeprefix('original_')
     return fmt in ('recipe', 'downloaded_recipe')
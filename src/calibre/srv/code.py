@@ -23,6 +23,7 @@
 from calibre.srv.http_response import RequestData
 from calibre.srv.last_read import last_read_cache
 from calibre.srv.metadata import book_as_json, categories_as_json, categories_settings, get_gpref, icon_map, web_search_link
+from calibre.srv.pool import SLOW
 from calibre.srv.routes import endpoint, json
 from calibre.srv.utils import get_library_data, get_use_roman
 from calibre.utils.config import prefs, tweaks
@@ -665,7 +666,7 @@ def web_search(ctx, rd, book_id, field, item_val):
     raise HTTPNotFound(f'No web search URL for {field} {item_val}')
 
 
-@endpoint('/interface-data/tag-browser')
+@endpoint('/interface-data/tag-browser', job_class=SLOW)
 def tag_browser(ctx, rd):
     """
     Get the Tag Browser serialized as JSON
@@ -24,6 +24,7 @@
 from calibre.library.save_to_disk import find_plugboard
 from calibre.srv.errors import BookNotFound, HTTPBadRequest, HTTPNotFound
 from calibre.srv.metadata import encode_stat_result
+from calibre.srv.pool import BULK, FAST
 from calibre.srv.routes import endpoint, json
 from calibre.srv.utils import get_db, get_use_roman, http_date
 from calibre.utils.config_base import tweaks
@@ -359,7 +360,12 @@ def save_reader_profile(ctx, rd):
     return True
 
 
-@endpoint('/get/{what}/{book_id}/{library_id=None}', android_workaround=True)
+def get_job_class(what, *args):
+    # Covers and metadata are cheap, formats are copied out of the library
+    return FAST if what in ('thumb', 'cover', 'opf', 'json') else BULK
+
+
+@endpoint('/get/{what}/{book_id}/{library_id=None}', android_workaround=True, job_class=get_job_class)
 def get(ctx, rd, what, book_id, library_id):
     book_id, rest = book_id.partition('_')[::2]
     try:
@@ -569,7 +575,7 @@ def get_db_for_data_file(ctx, rd, book_id, library_id):
     return db
 
 
-@endpoint('/data-files/get/{book_id}/{relpath}/{library_id=None}', types={'book_id': int})
+@endpoint('/data-files/get/{book_id}/{relpath}/{library_id=None}', types={'book_id': int}, job_class=BULK)
 def get_data_file(ctx, rd, book_id, relpath, library_id):
     db = get_db_for_data_file(ctx, rd, book_id, library_id)
     for ef in db.list_extra_files(book_id, pattern=DATA_FILE_PATTERN):
@@ -11,6 +11,7 @@
 from calibre.db.errors import NoSuchBook
 from calibre.srv.changes import formats_added
 from calibre.srv.errors import BookNotFound, HTTPNotFound
+from calibre.srv.pool import BULK, SLOW
 from calibre.srv.routes import endpoint, json
 from calibre.srv.utils import get_library_data
 from calibre.utils.localization import _
@@ -159,6 +160,7 @@ def queue_job(ctx, rd, library_id, db, fmt, book_id, conversion_data):
     needs_db_write=True,
     types={'book_id': int},
     methods=receive_data_methods,
+    job_class=BULK,
 )
 def start_conversion(ctx, rd, book_id):
     db, library_id = get_library_data(ctx, rd)[:2]
@@ -289,7 +291,7 @@ def desc(profile):
     return _profiles_cache
 
 
-@endpoint('/conversion/book-data/{book_id}', postprocess=json, types={'book_id': int})
+@endpoint('/conversion/book-data/{book_id}', postprocess=json, types={'book_id': int}, job_class=SLOW)
 def conversion_data(ctx, rd, book_id):
     from calibre.ebooks.conversion.config import NoSupportedInputFormats, get_input_format_for_book, get_sorted_output_formats
 
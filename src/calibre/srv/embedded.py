@@ -86,7 +86,7 @@ def start(self):
         if self.current_thread is None:
             try:
                 self.loop = ServerLoop(
-                    create_http_handler(self.handler.dispatch),
+                    create_http_handler(self.handler.dispatch, job_class_for=self.handler.router.job_class_for),
                     opts=self.opts,
                     log=self.log,
                     access_log=self.access_log,
@@ -24,6 +24,7 @@ class Context:
     log = None
     url_for: UrlForCallable = lambda route, **kwargs: ''
     jobs_manager = None
+    prerenderer = None
     CATEGORY_CACHE_SIZE = 25
     SEARCH_CACHE_SIZE = 100
 
@@ -38,6 +39,8 @@ def __init__(self, libraries, opts, testing=False, notify_changes=None):
         self._notify_changes = notify_changes
 
     def notify_changes(self, library_path, change_event):
+        if self.prerenderer is not None:
+            self.prerenderer.notify_changes(library_path, change_event)
         if self._notify_changes is not None:
             self._notify_changes(library_path, change_event)
 
@@ -216,6 +219,10 @@ def __init__(self, libraries, opts, testing=False, notify_changes=None):
         self.router.finalize()
         assert self.router.ctx is not None
         self.router.ctx.url_for = self.router.url_for
+        if opts.prerender_books > 0:
+            from calibre.srv.prerender import Prerenderer
+
+            ctx.prerenderer = Prerenderer(ctx)
         self.dispatch = self.router.dispatch
 
     def _load_content_server_plugin_routes(self):
@@ -243,10 +250,15 @@ def set_log(self, log):
     def set_jobs_manager(self, jobs_manager):
         assert self.router.ctx is not None
         self.router.ctx.jobs_manager = jobs_manager
+        p = self.router.ctx.prerenderer
+        if p is not None and p.ident is None:
+            p.start()
 
     def close(self):
         assert self.router is not None
         assert self.router.ctx is not None
+        if self.router.ctx.prerenderer is not None:
+            self.router.ctx.prerenderer.stop()
         self.router.ctx.library_broker.close()
 
     @property
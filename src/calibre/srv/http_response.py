@@ -23,6 +23,7 @@
 from calibre.srv.errors import HTTPSimpleResponse
 from calibre.srv.http_request import HTTPRequest, read_headers
 from calibre.srv.loop import WRITE
+from calibre.srv.pool import FAST
 from calibre.srv.utils import HTTP1, HTTP11, Cookie, MultiDict, get_translator_for_lang, http_date, socket_errors_socket_closed, sort_q_values
 from calibre.utils.monotonic import monotonic
 from calibre.utils.speedups import ReadOnlyFileBuffer
@@ -422,6 +423,9 @@ def __init__(self, data):
 
 class HTTPConnection(HTTPRequest):
     use_sendfile = False
+    # Maps the request path to the class of worker job (see srv.pool) used to
+    # run the request handler
+    job_class_for = None
 
     def write(self, buf, end=None):
         pos = buf.tell()
@@ -511,7 +515,8 @@ def prepare_response(self, inheaders, request_body_file):
             self.forwarded_for,
             self.request_original_uri,
         )
-        self.queue_job(self.run_request_handler, data)
+        job_class = FAST if self.job_class_for is None else self.job_class_for(data.path)
+        self.queue_job(self.run_request_handler, data, job_class=job_class)
 
     def run_request_handler(self, data):
         assert self.request_handler is not None
@@ -809,7 +814,7 @@ def finalize_output(self, output, request, is_http1):
         return output
 
 
-def create_http_handler(handler=None, websocket_handler=None):
+def create_http_handler(handler=None, websocket_handler=None, job_class_for=None):
     from calibre.srv.web_socket import WebSocketConnection
 
     static_cache = {}
@@ -826,6 +831,7 @@ def wrapper(*args, **kwargs):
         ans = WebSocketConnection(*args, **kwargs)
         ans.request_handler = handler
         ans.websocket_handler = websocket_handler
+        ans.job_class_for = job_class_for
         ans.static_cache = static_cache
         ans.translator_cache = translator_cache
         return ans
@@ -2,63 +2,250 @@
 # License: GPLv3 Copyright: 2016, Kovid Goyal <kovid at kovidgoyal.net>
 
 import os
+import sys
 import time
 from collections import deque, namedtuple
-from functools import partial
 from itertools import count
 from queue import Empty, Queue
 from threading import Event, RLock, Thread
 
 from calibre import detect_ncpus, force_unicode
-from calibre.utils.ipc.simple_worker import WorkerError, fork_job
+from calibre.utils.ipc import eintr_retry_call
+from calibre.utils.ipc.simple_worker import WorkerError, offload_worker
 from calibre.utils.monotonic import monotonic
 
 StartEvent = namedtuple('StartEvent', 'job_id name module function args kwargs callback data')
 DoneEvent = namedtuple('DoneEvent', 'job_id')
 
 
+class WarmWorker:
+    """
+    A long lived worker process that runs jobs one after another, so that
+    jobs do not pay the cost of starting a process and importing calibre.
+    Jobs are run via run_job() below, which reports the memory used by the
+    worker after each job. The output of the worker goes to a single log
+    file, the part of it written while a job was running is that job's log.
+    """
+
+    def __init__(self):
+        self.offload = offload_worker()
+        self.conn = self.offload.conn
+        self.log_path = self.offload.worker.log_path
+        self.num_jobs = self.rss = 0
+        self.pending_replies = 0
+        # Import calibre and the plugins while waiting for the first job
+        self.send(('calibre.srv.jobs', 'warm_up', (), {}))
+
+    def send(self, x):
+        eintr_retry_call(self.conn.send, x)
+        self.pending_replies += 1
+
+    def recv(self, abort=None, timeout=None):
+        # Returns the reply or None if aborted or timed out
+        st = monotonic()
+        while not eintr_retry_call(self.conn.poll, 0.1):
+            if abort is not None and abort.is_set():
+                return
+            if timeout is not None and monotonic() - st > timeout:
+                return
+            if not self.offload.worker.is_alive:
+                raise WorkerError('The worker process died')
+        ans = eintr_retry_call(self.conn.recv)
+        self.pending_replies -= 1
+        return ans
+
+    def log_size(self):
+        try:
+            return os.path.getsize(self.log_path)
+        except OSError:
+            return 0
+
+    def is_healthy(self, timeout=5):
+        # Check that the worker is still responding by sending it an empty
+        # job, which is replied to immediately
+        try:
+            while self.pending_replies:
+                if self.recv(timeout=timeout) is None:
+                    return False
+            self.send((None, None, (), {}))
+            return self.recv(timeout=timeout) is not None
+        except Exception:
+            return False
+
+    def __call__(self, module, func, args, kwargs, abort):
+        self.num_jobs += 1
+        while self.pending_replies:
+            if self.recv(abort) is None:
+                return
+        self.send(('calibre.srv.jobs', 'run_job', (module, func, args, kwargs), {}))
+        res = self.recv(abort)
+        if res is None:
+            return
+        if res['tb']:
+            raise WorkerError('Worker failed', res['tb'])
+        result, self.rss = res['result']
+        return result
+
+    def kill(self):
+        self.offload.worker.kill()
+        self.shutdown()
+
+    def shutdown(self):
+        if self.conn is not None:
+            self.conn = None
+            self.offload.shutdown()
+
+
+class WorkerPool:
+    """
+    Keeps idle WarmWorker processes around for reuse. Workers are recycled
+    once they have run max_jobs_per_worker jobs or are using more than
+    max_rss MB of memory, and are checked to be responding before being
+    reused. The most recently used worker is reused first, and a spare
+    worker is started in advance whenever the last idle worker is handed
+    out. Idle workers beyond the first exit after max_idle_time seconds.
+    """
+
+    max_jobs_per_worker = 50
+    max_rss = 512
+    health_check_interval = 60
+    max_idle_time = 300
+
+    def __init__(self, max_workers):
+        self.max_workers = max_workers
+        self.lock = RLock()
+        self.idle_workers = deque()
+        self.num_busy = 0
+        self.starting_spare = self.shutting_down = False
+
+    def create_worker(self):
+        w = WarmWorker()
+        w.last_used = monotonic()
+        return w
+
+    def get(self):
+        # The lock is held only to pick a worker, health checks and starting
+        # worker processes can take a while and are done without it
+        while True:
+            with self.lock:
+                self.prune_idle_workers()
+                w = self.idle_workers.pop() if self.idle_workers else None
+            if w is None or monotonic() - w.last_used < self.health_check_interval or w.is_healthy():
+                break
+            w.kill()
+        if w is None:
+            w = self.create_worker()
+        with self.lock:
+            self.num_busy += 1
+            # Keep one spare worker warming up, in addition to the busy ones
+            start_spare = not self.idle_workers and not self.starting_spare and not self.shutting_down and self.num_busy <= self.max_workers
+            if start_spare:
+                self.starting_spare = True
+        if start_spare:
+            try:
+                spare = self.create_worker()
+            except Exception:
+                spare = None
+            with self.lock:
+                self.starting_spare = False
+                if spare is not None and not self.shutting_down:
+                    self.idle_workers.append(spare)
+                    spare = None
+            if spare is not None:
+                spare.shutdown()
+        return w
+
+    def prune_idle_workers(self):
+        # Idle workers are ordered from least to most recently used
+        now = monotonic()
+        while len(self.idle_workers) > 1 and now - self.idle_workers[0].last_used > self.max_idle_time:
+            self.idle_workers.popleft().shutdown()
+
+    def put(self, w, reusable=True):
+        with self.lock:
+            self.num_busy -= 1
+            if (
+                reusable
+                and not self.shutting_down
+                and w.num_jobs < self.max_jobs_per_worker
+                and w.rss < self.max_rss * 1024 * 1024
+                and len(self.idle_workers) <= self.max_workers
+            ):
+                w.last_used = monotonic()
+                self.idle_workers.append(w)
+                self.prune_idle_workers()
+                return
+        if reusable:
+            w.shutdown()
+        else:
+            w.kill()
+
+    def shutdown(self):
+        with self.lock:
+            self.shutting_down = True
+            workers = tuple(self.idle_workers)
+            self.idle_workers.clear()
+        for w in workers:
+            w.shutdown()
+
+
 class Job(Thread):
     daemon = True
 
-    def __init__(self, start_event, events_queue):
+    def __init__(self, start_event, events_queue, worker_pool):
         Thread.__init__(self, name=f'JobsMonitor{start_event.job_id}')
         self.abort_event = Event()
         self.events_queue = events_queue
+        self.worker_pool = worker_pool
         self.job_name = start_event.name
         self.job_id = start_event.job_id
-        self.func = partial(
-            fork_job,
-            start_event.module,
-            start_event.function,
-            start_event.args,
-            start_event.kwargs,
-            abort=self.abort_event,
-        )
+        self.job_args = (start_event.module, start_event.function, start_event.args, start_event.kwargs)
         self.data, self.callback = start_event.data, start_event.callback
-        self.result = self.traceback = None
+        self.result = self.traceback = self.log = None
         self.done = False
         self.start_time = monotonic()
-        self.end_time = self.log_path = None
+        self.end_time = None
         self.wait_for_end = Event()
         self.start()
 
     def run(self):
-        func, self.func = self.func, None
-        assert func is not None
+        args, self.job_args = self.job_args, None
+        assert args is not None
         try:
-            result = func()
-        except WorkerError as err:
+            self.run_in_worker(*args)
+        except Exception:
             import traceback
 
-            self.traceback = err.orig_tb or traceback.format_exc()
-            self.log_path = getattr(err, 'log_path', None)
-        else:
-            self.result, self.log_path = result['result'], result['stdout_stderr']
+            self.traceback = traceback.format_exc()
         self.done = True
         self.end_time = monotonic()
         self.wait_for_end.set()
         self.events_queue.put(DoneEvent(self.job_id))
 
+    def run_in_worker(self, module, func, args, kwargs):
+        w = self.worker_pool.get()
+        log_start, reusable = w.log_size(), False
+        try:
+            self.result = w(module, func, args, kwargs, self.abort_event)
+            reusable = not self.abort_event.is_set()
+        except WorkerError as err:
+            import traceback
+
+            self.traceback = err.orig_tb or traceback.format_exc()
+            # The job failed but the worker is fine unless it died
+            reusable = bool(err.orig_tb)
+        finally:
+            self.read_worker_log(w.log_path, log_start)
+            self.worker_pool.put(w, reusable)
+
+    def read_worker_log(self, path, start):
+        try:
+            with open(path, 'rb') as f:
+                f.seek(start)
+                self.log = f.read()
+        except OSError:
+            pass
+
     @property
     def was_aborted(self):
         return self.done and self.result is None and self.abort_event.is_set()
@@ -68,21 +255,10 @@ def failed(self):
         return bool(self.traceback) or self.was_aborted
 
     def remove_log(self):
-        lp, self.log_path = self.log_path, None
-        if lp:
-            try:
-                os.remove(lp)
-            except OSError:
-                pass
+        self.log = None
 
     def read_log(self):
-        ans = ''
-        if self.log_path is not None:
-            try:
-                with open(self.log_path, 'rb') as f:
-                    ans = f.read()
-            except OSError:
-                pass
+        ans = self.log or ''
         if isinstance(ans, bytes):
             ans = force_unicode(ans, 'utf-8')
         return ans
@@ -106,6 +282,7 @@ def __init__(self, opts, log):
         self.max_block = None
         self.shutting_down = False
         self.event_loop = None
+        self.worker_pool = WorkerPool(self.max_jobs)
 
     def start_job(self, name, module, func, args=(), kwargs=None, job_done_callback=None, job_data=None):
         with self.lock:
@@ -132,6 +309,12 @@ def job_status(self, job_id):
                     return 'waiting', None, None, None
         return None, None, None, None
 
+    @property
+    def has_spare_capacity(self):
+        # True if a newly started job would run immediately
+        with self.lock:
+            return not self.shutting_down and len(self.jobs) + len(self.waiting_job_ids) < self.max_jobs
+
     def abort_job(self, job_id):
         job = self.jobs.get(job_id)
         if job is not None:
@@ -153,6 +336,7 @@ def shutdown(self, timeout=5.0):
             for job in self.jobs.values():
                 job.abort_event.set()
             self.events.put(False)
+        self.worker_pool.shutdown()
 
     def wait_for_shutdown(self, wait_till):
         for job in self.jobs.values():
@@ -191,7 +375,7 @@ def start_waiting_jobs(self):
         with self.lock:
             while self.waiting_jobs and len(self.jobs) < self.max_jobs:
                 ev = self.waiting_jobs.popleft()
-                self.jobs[ev.job_id] = Job(ev, self.events)
+                self.jobs[ev.job_id] = Job(ev, self.events, self.worker_pool)
                 self.waiting_job_ids.discard(ev.job_id)
         self.update_max_block()
 
@@ -253,10 +437,44 @@ def prune_finished_jobs(self):
     # }}}
 
 
+def warm_up():
+    # Runs in WarmWorker processes when they start, to load the plugins and
+    # import the modules used by server jobs
+    from importlib import import_module
+
+    for name in ('calibre.customize.ui', 'calibre.ebooks.conversion.plumber', 'calibre.srv.render_book'):
+        import_module(name)
+
+
+def run_job(module, func, args, kwargs):
+    # Runs a job in a WarmWorker process, returning its result and the memory
+    # used by the process
+    from importlib import import_module
+
+    from calibre.utils.mem import get_memory
+
+    cwd = os.getcwd()
+    try:
+        ans = getattr(import_module(module), func)(*args, **kwargs)
+    finally:
+        # Jobs such as conversion change the working directory
+        os.chdir(cwd)
+        for f in (sys.stdout, sys.stderr):
+            try:
+                f.flush()
+            except Exception:
+                pass
+    return ans, get_memory()
+
+
 def sleep_test(x):
     time.sleep(x)
     return x
 
 
+def pid_test():
+    return os.getpid()
+
+
 def error_test():
     raise Exception('a testing error')
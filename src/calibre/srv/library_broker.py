@@ -20,6 +20,19 @@ def gui_on_db_event(event_type, library_id, event_data):
         gui.library_broker.on_db_event(event_type, library_id, event_data)
 
 
+def gui_on_coalesced_db_events(library_id, events):
+    from calibre.gui2.ui import get_gui
+
+    gui = get_gui()
+    if gui is not None:
+        gui.library_broker.on_coalesced_db_events(library_id, events)
+
+
+def add_gui_db_listeners(db):
+    db.new_api.add_listener(gui_on_db_event)
+    db.new_api.add_listener(gui_on_coalesced_db_events, coalesce=True)
+
+
 def canonicalize_path(p):
     if isinstance(p, bytes):
         p = p.decode(filesystem_encoding)
@@ -45,9 +58,32 @@ def basename(path):
     return ans or 'Library'
 
 
+# The fields used by the server to sort, search and display the list of books.
+# These are read when the library is opened, rather than during the first
+# request, the others are read when first used.
+PRELOAD_FIELDS = frozenset({
+    'title',
+    'sort',
+    'authors',
+    'author_sort',
+    'series',
+    'series_index',
+    'tags',
+    'rating',
+    'timestamp',
+    'pubdate',
+    'last_modified',
+    'uuid',
+    'path',
+    'formats',
+    'languages',
+    'cover',
+})
+
+
 def init_library(library_path, is_default_library):
     db = Cache(create_backend(library_path, load_user_formatter_functions=is_default_library))
-    db.init()
+    db.init(preload_fields=PRELOAD_FIELDS)
     return db
 
 
@@ -210,7 +246,7 @@ def init_library(self, library_path, is_default_library):
         library_path = self.original_path_map.get(library_path, library_path)
         db = LibraryDatabase(library_path, is_second_db=True)
         if self.listening_for_db_events:
-            db.new_api.add_listener(gui_on_db_event)
+            add_gui_db_listeners(db)
         return db
 
     def get(self, library_id=None):
@@ -223,7 +259,7 @@ def start_listening_for_db_events(self):
         with self:
             self.listening_for_db_events = True
             for db in self.loaded_dbs.values():
-                db.new_api.add_listener(gui_on_db_event)
+                add_gui_db_listeners(db)
 
     def on_db_event(self, event_type, library_id, event_data):
         from calibre.gui2.ui import get_gui
@@ -235,6 +271,16 @@ def on_db_event(self, event_type, library_id, event_data):
             if db is not None:
                 gui.event_in_db.emit(db, event_type, event_data)
 
+    def on_coalesced_db_events(self, library_id, events):
+        from calibre.gui2.ui import get_gui
+
+        gui = get_gui()
+        if gui is not None:
+            with self:
+                db = self.loaded_dbs.get(library_id)
+            if db is not None:
+                gui.events_in_db.emit(db, events)
+
     def get_library(self, original_library_path):
         library_path = canonicalize_path(original_library_path)
         with self:
@@ -288,7 +334,7 @@ def gui_library_changed(self, db, olddb=None):
             self.loaded_dbs[library_id] = db
         db.new_api.server_library_id = library_id
         if self.listening_for_db_events:
-            db.new_api.add_listener(gui_on_db_event)
+            add_gui_db_listeners(db)
         if olddb is not None and samefile(path_for_db(olddb), path_for_db(db)):
             # This happens after a restore database, for example
             olddb.close(), olddb.break_cycles()
@@ -4,12 +4,16 @@
 import ipaddress
 import os
 import select
+import selectors
 import socket
 import ssl
 import traceback
+import weakref
 from contextlib import suppress
 from functools import lru_cache, partial
+from heapq import heappop, heappush
 from io import BytesIO
+from itertools import count
 from queue import Empty, Full
 from typing import Any
 
@@ -19,7 +23,7 @@
 from calibre.srv.errors import JobQueueFull
 from calibre.srv.jobs import JobsManager
 from calibre.srv.opts import Options
-from calibre.srv.pool import PluginPool, ThreadPool
+from calibre.srv.pool import FAST, PluginPool, ThreadPool
 from calibre.srv.utils import (
     DESIRED_SEND_BUFFER_SIZE,
     HandleInterrupt,
@@ -38,6 +42,7 @@
 from calibre.utils.socket_inheritance import set_socket_inherit
 
 READ, WRITE, RDWR, WAIT = 'READ', 'WRITE', 'RDWR', 'WAIT'
+SELECTOR_EVENTS = {READ: selectors.EVENT_READ, WRITE: selectors.EVENT_WRITE, RDWR: selectors.EVENT_READ | selectors.EVENT_WRITE, WAIT: 0}
 WAKEUP, JOB_DONE = b'\0', b'\x01'
 IPPROTO_IPV6 = getattr(socket, 'IPPROTO_IPV6', 41)
 
@@ -167,6 +172,11 @@ def is_local_address(addr: ipaddress.IPv4Address | ipaddress.IPv6Address | None)
 
 
 class Connection:  # {{{
+    # Called with no arguments whenever wait_for changes, set by the server
+    # loop so that it can update the events it is waiting for on this
+    # connection. Note that wait_for can be changed from other threads.
+    wait_for_changed = None
+
     def __init__(self, socket, opts, ssl_context, tdir, addr, pool, log, access_log, wakeup):
         self.opts, self.pool, self.log, self.wakeup, self.access_log = opts, pool, log, wakeup, access_log
         try:
@@ -181,7 +191,7 @@ def __init__(self, socket, opts, ssl_context, tdir, addr, pool, log, access_log,
             self.is_trusted_ip = is_ip_trusted(self.parsed_remote_addr, parsed_trusted_ips(self.opts.trusted_ips))
         self.orig_send_bufsize = self.send_bufsize = 4096
         self.tdir = tdir
-        self.wait_for = READ
+        self._wait_for = READ
         self.response_started = False
         self.read_buffer = ReadBuffer()
         self.handle_event = None
@@ -214,6 +224,17 @@ def end_send_optimization(self):
         if self.send_bufsize != self.orig_send_bufsize:
             self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, self.orig_send_bufsize)
 
+    @property
+    def wait_for(self):
+        return self._wait_for
+
+    @wait_for.setter
+    def wait_for(self, val):
+        if val is not self._wait_for:
+            self._wait_for = val
+            if self.wait_for_changed is not None:
+                self.wait_for_changed()
+
     def set_state(self, wait_for, func, *args, **kwargs):
         self.wait_for = wait_for
         if args or kwargs:
@@ -347,11 +368,11 @@ def close(self):
         except OSError:
             pass
 
-    def queue_job(self, func, *args):
+    def queue_job(self, func, *args, job_class=FAST):
         if args:
             func = partial(func, *args)
         try:
-            self.pool.put_nowait(self.socket.fileno(), func)
+            self.pool.put_nowait(self.socket.fileno(), func, job_class)
         except Full:
             raise JobQueueFull()
         self.set_state(WAIT, self._job_done)
@@ -418,6 +439,14 @@ def __init__(
         self.bind_address = ba
         self.bound_address = None
         self.connection_map = {}
+        self.selector = None
+        # Sockets whose connection has changed wait_for since the selector was last updated
+        self.wait_for_changes = set()
+        # Sockets whose connection has data that was read but not yet consumed
+        self.buffered = set()
+        # Heap of (deadline, seq, socket, connection reference) for expiring idle connections
+        self.timeouts = []
+        self.timeout_seq = count()
 
         self.ssl_context = None
         if self.opts.ssl_certfile is not None and self.opts.ssl_keyfile is not None:
@@ -524,7 +553,11 @@ def serve(self):
         from calibre.utils.network import format_addr_for_url
 
         self.connection_map = {}
+        self.wait_for_changes, self.buffered, self.timeouts = set(), set(), []
         assert self.socket is not None
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(self.socket.fileno(), selectors.EVENT_READ)
+        self.selector.register(self.control_out.fileno(), selectors.EVENT_READ)
         if not self.socket_was_preactivated:
             self.socket.listen(min(socket.SOMAXCONN, 128))
         self.bound_address = ba = self.socket.getsockname()
@@ -582,65 +615,47 @@ def bind(self, family, atype, proto=0):
 
     def tick(self):
         now = monotonic()
-        read_needed, write_needed, readable, remove, close_needed = [], [], [], [], []
-        has_ssl = self.ssl_context is not None
-        for s, conn in self.connection_map.items():
-            if now - conn.last_activity > self.opts.timeout:
-                if conn.handle_timeout():
-                    conn.last_activity = now
-                else:
-                    remove.append((s, conn))
-                    continue
-            wf = conn.wait_for
-            if wf is READ or wf is RDWR:
-                if wf is RDWR:
-                    write_needed.append(s)
-                if conn.read_buffer.has_data:
-                    readable.append(s)
-                elif has_ssl:
-                    conn.drain_ssl_buffer()
-                    if conn.ready:
-                        (readable if conn.read_buffer.has_data else read_needed).append(s)
-                    else:
-                        close_needed.append((s, conn))
-                else:
-                    read_needed.append(s)
-            elif wf is WRITE:
-                write_needed.append(s)
-
-        for s, conn in remove:
-            self.log(f'Closing connection because of extended inactivity: {conn.state_description}')
-            self.close(s, conn)
-
-        for x, conn in close_needed:
-            self.close(s, conn)
-
+        self.expire_idle_connections(now)
+        self.update_selector()
+        readable = [s for s in self.buffered if s in self.connection_map]
+        self.buffered = set()
         if readable:
-            writable = []
+            # Data has already been read for some connections, so do not wait
+            # for more
+            timeout = 0
         else:
-            assert self.socket is not None
-            try:
-                readable, writable, _ = select.select([self.socket.fileno(), self.control_out.fileno()] + read_needed, write_needed, [], self.opts.timeout)
-            except ValueError:  # self.socket.fileno() == -1
-                self.ready = False
-                self.log.error('Listening socket was unexpectedly terminated')
-                return
-            except OSError as e:
-                # select.error has no errno attribute. errno is instead
-                # e.args[0]
-                if getattr(e, 'errno', e.args[0]) in socket_errors_eintr:
-                    return
-                for s, conn in tuple(self.connection_map.items()):
-                    try:
-                        select.select([s], [], [], 0)
-                    except OSError as e:
-                        if getattr(e, 'errno', e.args[0]) not in socket_errors_eintr:
-                            self.close(s, conn)  # Bad socket, discard
+            timeout = self.opts.timeout
+            if self.timeouts:
+                timeout = max(0, min(timeout, self.timeouts[0][0] - now))
+        try:
+            events = self.selector.select(timeout)
+        except ValueError:  # self.socket.fileno() == -1
+            self.ready = False
+            self.log.error('Listening socket was unexpectedly terminated')
+            return
+        except OSError as e:
+            # select.error has no errno attribute. errno is instead
+            # e.args[0]
+            if getattr(e, 'errno', e.args[0]) in socket_errors_eintr:
                 return
+            for s, conn in tuple(self.connection_map.items()):
+                try:
+                    select.select([s], [], [], 0)
+                except OSError as e:
+                    if getattr(e, 'errno', e.args[0]) not in socket_errors_eintr:
+                        self.close(s, conn)  # Bad socket, discard
+            return
 
         if not self.ready:
             return
 
+        writable, already_readable = [], set(readable)
+        for key, mask in events:
+            if mask & selectors.EVENT_READ and key.fd not in already_readable:
+                readable.append(key.fd)
+            if mask & selectors.EVENT_WRITE:
+                writable.append(key.fd)
+
         ignore = set()
         for s, conn, event in self.get_actions(readable, writable):
             if s in ignore:
@@ -649,6 +664,8 @@ def tick(self):
                 conn.handle_event(event)
                 if not conn.ready:
                     self.close(s, conn)
+                else:
+                    self.check_for_buffered_data(s, conn)
             except JobQueueFull:
                 self.log.exception(f'Server busy handling request: {conn.state_description}')
                 if conn.ready:
@@ -679,6 +696,60 @@ def tick(self):
                         self.log.error(f'Error in SSL handshake, terminating connection: {as_unicode(e)}')
                         self.close(s, conn)
 
+    def update_selector(self):
+        # Bring the events registered with the selector in line with the
+        # current state of every connection whose state has changed
+        while self.wait_for_changes:
+            s = self.wait_for_changes.pop()
+            conn = self.connection_map.get(s)
+            if conn is None:
+                continue
+            events = SELECTOR_EVENTS[conn.wait_for]
+            key = self.selector.get_map().get(s)
+            if key is None:
+                if events:
+                    self.selector.register(s, events)
+            elif not events:
+                self.selector.unregister(s)
+            elif key.events != events:
+                self.selector.modify(s, events)
+
+    def check_for_buffered_data(self, s, conn):
+        # Data that has already been read into the read buffer, or that is
+        # pending in the SSL layer, will not be reported by the selector
+        wf = conn.wait_for
+        if wf is READ or wf is RDWR:
+            if not conn.read_buffer.has_data and self.ssl_context is not None:
+                conn.drain_ssl_buffer()
+                if not conn.ready:
+                    self.close(s, conn)
+                    return
+            if conn.read_buffer.has_data:
+                self.buffered.add(s)
+
+    def schedule_timeout(self, s, conn):
+        heappush(self.timeouts, (conn.last_activity + self.opts.timeout, next(self.timeout_seq), s, weakref.ref(conn)))
+
+    def expire_idle_connections(self, now):
+        # Every connection has a single entry in the heap. Activity on a
+        # connection does not touch the heap, instead the entry is
+        # rescheduled when it falls due and the connection turns out to
+        # have been active.
+        timeouts = self.timeouts
+        while timeouts and timeouts[0][0] <= now:
+            s, conn = heappop(timeouts)[2:]
+            conn = conn()
+            if conn is None or self.connection_map.get(s) is not conn:
+                continue
+            if now - conn.last_activity >= self.opts.timeout:
+                if conn.handle_timeout():
+                    conn.last_activity = now
+                else:
+                    self.log(f'Closing connection because of extended inactivity: {conn.state_description}')
+                    self.close(s, conn)
+                    continue
+            self.schedule_timeout(s, conn)
+
     def write_to_control(self, what):
         if iswindows:
             self.control_in.sendall(what)
@@ -692,6 +763,12 @@ def wakeup(self):
     def job_completed(self):
         self.write_to_control(JOB_DONE)
 
+    def wait_for_changed(self, s):
+        # Can be called from any thread, changes are applied to the selector
+        # at the start of the next tick. Threads other than the one running
+        # the loop must call wakeup() after changing wait_for.
+        self.wait_for_changes.add(s)
+
     def dispatch_job_results(self):
         while True:
             try:
@@ -703,7 +780,11 @@ def dispatch_job_results(self):
                 yield s, conn, (ok, result)
 
     def close(self, s, conn):
-        self.connection_map.pop(s, None)
+        if self.connection_map.get(s) is conn:
+            del self.connection_map[s]
+            with suppress(KeyError, ValueError):
+                self.selector.unregister(s)
+            self.buffered.discard(s)
         conn.close()
 
     def get_actions(self, readable, writable):
@@ -727,6 +808,9 @@ def get_actions(self, readable, writable):
                             self.access_log,
                             self.wakeup,
                         )
+                        conn.wait_for_changed = partial(self.wait_for_changed, s)
+                        self.wait_for_changed(s)
+                        self.schedule_timeout(s, conn)
                         if self.ssl_context is not None:
                             yield s, conn, RDWR
             elif s == control:
@@ -749,7 +833,9 @@ def get_actions(self, readable, writable):
                     self.log.error('Control connection failed to read after signalling ready')
                     raise Exception('Control connection failed to read, something bad happened')
             else:
-                yield s, self.connection_map[s], READ
+                conn = self.connection_map.get(s)
+                if conn is not None:
+                    yield s, conn, READ
         for s in writable:
             try:
                 conn = self.connection_map[s]
@@ -779,6 +865,9 @@ def shutdown(self):
                 self.socket = None
         for s, conn in tuple(self.connection_map.items()):
             self.close(s, conn)
+        if self.selector is not None:
+            self.selector.close()
+            self.selector = None
         wait_till = monotonic() + self.opts.shutdown_timeout
         for pool in (self.plugin_pool, self.pool):
             pool.stop(wait_till)
@@ -26,6 +26,7 @@
 from calibre.srv.http_request import parse_uri
 from calibre.srv.http_response import RequestData
 from calibre.srv.opts import Options
+from calibre.srv.pool import SLOW
 from calibre.srv.routes import endpoint
 from calibre.srv.utils import MultiDict, Offsets, get_library_data, http_date
 from calibre.utils.config import prefs
@@ -651,7 +652,7 @@ def getter(x: str) -> str:
     return TopLevel(last_modified, cats, rc).root
 
 
-@endpoint('/opds/navcatalog/{which}', postprocess=atom)
+@endpoint('/opds/navcatalog/{which}', postprocess=atom, job_class=SLOW)
 def opds_navcatalog(ctx: Context, rd: RequestData, which: str) -> etree.Element:
     try:
         offset = int(rd.query.get('offset', 0))
@@ -671,7 +672,7 @@ def opds_navcatalog(ctx: Context, rd: RequestData, which: str) -> etree.Element:
     raise HTTPNotFound('Not found')
 
 
-@endpoint('/opds/category/{category}/{which}', postprocess=atom)
+@endpoint('/opds/category/{category}/{which}', postprocess=atom, job_class=SLOW)
 def opds_category(ctx: Context, rd: RequestData, category: str, which: str) -> etree.Element:
     try:
         offset = int(rd.query.get('offset', 0))
@@ -722,7 +723,7 @@ def opds_category(ctx: Context, rd: RequestData, category: str, which: str) -> e
     return get_acquisition_feed(rc, ids, offset, page_url, up_url, 'calibre-category:' + category + ':' + str(which), sort_by=sort_by)
 
 
-@endpoint('/opds/categorygroup/{category}/{which}', postprocess=atom)
+@endpoint('/opds/categorygroup/{category}/{which}', postprocess=atom, job_class=SLOW)
 def opds_categorygroup(ctx: Context, rd: RequestData, category: str, which: str) -> etree.Element:
     try:
         offset = int(rd.query.get('offset', 0))
@@ -79,6 +79,22 @@ def __new__(cls, *args):
     'max_job_time',
     60,
     _('Maximum amount of time worker processes are allowed to run (in minutes). Set to zero for no limit.'),
+    _('Max. disk space for books prepared for reading (in MB)'),
+    'reader_cache_size',
+    2048,
+    _(
+        'Books are prepared for reading in the browser and the results are cached on disk.'
+        ' When the cache becomes larger than this size, the least recently read books are'
+        ' removed from it. Set to zero to instead remove books that have not been read for a day.'
+    ),
+    _('Number of newly added books to prepare for reading in advance'),
+    'prerender_books',
+    0,
+    _(
+        'Prepare the most recently added books in each library for reading in the browser in the background,'
+        ' so that they open without delay the first time they are read. Only libraries that have been'
+        ' opened in the server are checked. Set to zero to disable.'
+    ),
     _('The port on which to listen for connections'),
     'port',
     8080,
@@ -256,6 +272,8 @@ class Options:
     worker_count: int
     max_jobs: int
     max_job_time: int
+    reader_cache_size: int
+    prerender_books: int
     port: int
     url_prefix: str | None
     num_per_page: int
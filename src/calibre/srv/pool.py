@@ -2,17 +2,31 @@
 # License: GPLv3 Copyright: 2015, Kovid Goyal <kovid at kovidgoyal.net>
 
 import sys
+from collections import deque
+from itertools import count as counter
 from queue import Full, Queue
-from threading import Thread
+from threading import Condition, Thread
 
 from calibre.utils.monotonic import monotonic
 
+# Request jobs are divided into classes, in order of decreasing priority.
+# Cheap requests (JSON, covers) are fast, expensive ones (OPDS category
+# feeds, conversion data, calibredb commands) are slow and requests that
+# mostly copy data (format downloads) are bulk.
+FAST, SLOW, BULK = JOB_CLASSES = ('fast', 'slow', 'bulk')
+
+
+def default_class_limits(count):
+    # The slow and bulk classes are limited so that some workers are always
+    # left over for fast requests
+    return {FAST: count, SLOW: max(1, count // 2), BULK: max(1, count // 4)}
+
 
 class Worker(Thread):
     daemon = True
 
-    def __init__(self, log, notify_server, num, request_queue, result_queue):
-        self.request_queue, self.result_queue = request_queue, result_queue
+    def __init__(self, log, notify_server, num, pool):
+        self.pool, self.result_queue = pool, pool.result_queue
         self.notify_server = notify_server
         self.log = log
         self.working = False
@@ -20,10 +34,10 @@ def __init__(self, log, notify_server, num, request_queue, result_queue):
 
     def run(self):
         while True:
-            x = self.request_queue.get()
+            x = self.pool.next_job(self)
             if x is None:
                 break
-            job_id, func = x
+            job_class, job_id, func = x
             self.working = True
             try:
                 result = func()
@@ -33,6 +47,7 @@ def run(self):
                 self.result_queue.put((job_id, True, result))
             finally:
                 self.working = False
+                self.pool.job_finished(job_class)
             try:
                 self.notify_server()
             except Exception:
@@ -43,32 +58,125 @@ def handle_error(self, job_id):
 
 
 class ThreadPool:
-    def __init__(self, log, notify_server, count=10, queue_size=1000):
-        self.request_queue, self.result_queue = Queue(queue_size), Queue(queue_size)
-        self.workers = [Worker(log, notify_server, i, self.request_queue, self.result_queue) for i in range(count)]
+    """
+    A pool of up to count worker threads. Jobs are queued by class and idle
+    workers pick the highest priority job whose class is below its
+    concurrency limit, so slow requests cannot tie up all the workers while
+    fast ones wait. Workers are started as needed, and workers beyond
+    min_count exit after idle_timeout seconds without work.
+    """
+
+    def __init__(self, log, notify_server, count=10, queue_size=1000, class_limits=None, min_count=None, idle_timeout=60):
+        self.log, self.notify_server = log, notify_server
+        self.max_count, self.queue_size, self.idle_timeout = count, queue_size, idle_timeout
+        self.min_count = max(1, count // 2) if min_count is None else min_count
+        self.class_limits = default_class_limits(count)
+        self.class_limits.update(class_limits or {})
+        self.result_queue = Queue(queue_size)
+        self.cond = Condition()
+        self.queues = {jc: deque() for jc in JOB_CLASSES}
+        self.running = dict.fromkeys(JOB_CLASSES, 0)
+        self.num_queued = self.num_waiting = self.num_woken = 0
+        self.started = self.stopping = False
+        self.worker_num = counter()
+        self.reset_stats()
+        self.workers = [self.create_worker() for i in range(count)]
+
+    def create_worker(self):
+        return Worker(self.log, self.notify_server, next(self.worker_num), self)
 
     def start(self):
-        for w in self.workers:
+        with self.cond:
+            self.started = True
+            workers = self.workers
+        for w in workers:
             w.start()
 
-    def put_nowait(self, job_id, func):
-        self.request_queue.put_nowait((job_id, func))
+    def put_nowait(self, job_id, func, job_class=FAST):
+        with self.cond:
+            if self.num_queued >= self.queue_size:
+                raise Full()
+            self.queues[job_class].append((monotonic(), job_id, func))
+            self.num_queued += 1
+            w = None
+            if self.num_waiting > self.num_woken:
+                # num_woken stops jobs queued in quick succession from all
+                # waking the same worker instead of starting new ones
+                self.num_woken += 1
+                self.cond.notify()
+            elif self.started and not self.stopping and len(self.workers) < self.max_count and self.running[job_class] < self.class_limits[job_class]:
+                w = self.create_worker()
+                self.workers = self.workers + [w]
+        if w is not None:
+            w.start()
 
     def get_nowait(self):
         return self.result_queue.get_nowait()
 
+    def pop_job(self):
+        for jc in JOB_CLASSES:
+            q = self.queues[jc]
+            if q and self.running[jc] < self.class_limits[jc]:
+                queued_at, job_id, func = q.popleft()
+                self.num_queued -= 1
+                self.running[jc] += 1
+                s = self.job_stats[jc]
+                wait = monotonic() - queued_at
+                s['started'] += 1
+                s['total_wait'] += wait
+                s['max_wait'] = max(s['max_wait'], wait)
+                return jc, job_id, func
+
+    def next_job(self, worker):
+        timed_out = False
+        with self.cond:
+            while True:
+                job = self.pop_job()
+                if job is not None:
+                    return job
+                if self.stopping:
+                    return
+                if timed_out and len(self.workers) > self.min_count:
+                    self.workers = [w for w in self.workers if w is not worker]
+                    return
+                self.num_waiting += 1
+                try:
+                    timed_out = not self.cond.wait(self.idle_timeout)
+                finally:
+                    self.num_waiting -= 1
+                    self.num_woken = max(0, self.num_woken - 1)
+
+    def job_finished(self, job_class):
+        with self.cond:
+            self.running[job_class] -= 1
+
+    def reset_stats(self):
+        self.job_stats = {jc: {'started': 0, 'total_wait': 0.0, 'max_wait': 0.0} for jc in JOB_CLASSES}
+
+    def stats(self, reset=False):
+        """
+        Return the number of queued and running jobs for each job class, along
+        with the number of jobs started and the total and maximum time they
+        spent waiting in the queue, as a dictionary. If reset is True the
+        counters are reset after being returned.
+        """
+        with self.cond:
+            ans = {jc: dict(self.job_stats[jc], queued=len(self.queues[jc]), running=self.running[jc], limit=self.class_limits[jc]) for jc in JOB_CLASSES}
+            if reset:
+                self.reset_stats()
+        return ans
+
     def stop(self, wait_till):
-        for w in self.workers:
-            try:
-                self.request_queue.put_nowait(None)
-            except Full:
-                break
-        for w in self.workers:
+        with self.cond:
+            self.stopping = True
+            self.cond.notify_all()
+            workers = self.workers
+        for w in workers:
             now = monotonic()
             if now >= wait_till:
                 break
             w.join(wait_till - now)
-        self.workers = [w for w in self.workers if w.is_alive()]
+        self.workers = [w for w in workers if w.is_alive()]
 
     @property
     def busy(self):
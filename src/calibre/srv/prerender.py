@@ -0,0 +1,151 @@
+#!/usr/bin/env python
+# License: GPLv3 Copyright: 2026, Kovid Goyal <kovid at kovidgoyal.net>
+
+from collections import OrderedDict
+from queue import Empty, Queue
+from threading import Thread
+
+from calibre.customize.ui import available_input_formats
+from calibre.srv.books import prerender_book
+from calibre.srv.changes import BooksAdded, FormatsAdded
+from calibre.srv.library_broker import samefile
+from calibre.utils.config import prefs
+from calibre.utils.monotonic import monotonic
+
+# Keep in sync with FORMAT_PRIORITIES in pyj/book_list/book_details.pyj
+FORMAT_PRIORITIES = ('EPUB', 'AZW3', 'DOCX', 'LIT', 'MOBI', 'ODT', 'RTF', 'MD', 'MARKDOWN', 'TXT', 'PDF')
+
+
+def reader_format(formats, output_format, input_formats):
+    # The format the web reader opens a book in, see get_preferred_format() in
+    # pyj/book_list/book_details.pyj
+    formats = [f.upper() for f in formats]
+    fmt = output_format.upper()
+    if fmt == 'PDF':
+        fmt = 'EPUB'
+    if fmt in formats:
+        return fmt
+    input_formats = {f.upper() for f in input_formats}
+    for q in sorted(formats, key=lambda f: FORMAT_PRIORITIES.index(f) if f in FORMAT_PRIORITIES else len(FORMAT_PRIORITIES)):
+        if q in input_formats:
+            return q
+
+
+class Prerenderer(Thread):
+    """
+    Prepares newly added books for reading in the browser in the background,
+    so that readers get a cache hit the first time they open them. Books are
+    found from the change notifications for books added via the server and by
+    periodically checking the newly added books of the libraries the server
+    has opened, which also finds books added by other programs. Renders are
+    low priority: one is started only when the jobs manager has spare
+    capacity and at most max_concurrent run at a time.
+    """
+
+    max_concurrent = 1
+    scan_interval = 5 * 60
+    poll_interval = 2
+
+    def __init__(self, ctx):
+        Thread.__init__(self, name='Prerenderer', daemon=True)
+        self.ctx = ctx
+        self.count = ctx.opts.prerender_books
+        self.queue = Queue()
+        self.pending = OrderedDict()
+        self.done = OrderedDict()
+        self.running = set()
+        self.last_scan = None
+        self.keep_going = True
+
+    def notify_changes(self, library_path, change_event):
+        if isinstance(change_event, (BooksAdded, FormatsAdded)):
+            self.queue.put((library_path, change_event.book_ids))
+
+    def stop(self):
+        self.keep_going = False
+        self.queue.put(None)
+
+    def run(self):
+        while self.keep_going:
+            x = self.wait_for_event()
+            if x is None:
+                break
+            try:
+                self.do_work(x)
+            except Exception:
+                import traceback
+
+                if self.ctx.log is not None:
+                    self.ctx.log.error(f'Failed to prepare books for reading:\n{traceback.format_exc()}')
+
+    def wait_for_event(self):
+        if self.pending or self.running:
+            timeout = self.poll_interval
+        elif self.last_scan is None:
+            timeout = 0
+        else:
+            timeout = max(0, self.last_scan + self.scan_interval - monotonic())
+        try:
+            return self.queue.get(timeout=timeout)
+        except Empty:
+            return ()
+
+    def do_work(self, x):
+        libraries = self.loaded_libraries()
+        if x:
+            library_path, book_ids = x
+            for library_id, lpath, db in libraries:
+                if samefile(library_path, lpath):
+                    self.add_books(library_id, book_ids, force=True)
+                    break
+        if self.last_scan is None or monotonic() - self.last_scan >= self.scan_interval:
+            self.last_scan = monotonic()
+            for library_id, lpath, db in libraries:
+                self.add_books(library_id, db.newly_added_book_ids(count=self.count))
+        self.start_renders({library_id: db for library_id, lpath, db in libraries})
+
+    def loaded_libraries(self):
+        broker = self.ctx.library_broker
+        with broker:
+            return [
+                (library_id, broker.lmap[library_id], db.new_api)
+                for library_id, db in broker.loaded_dbs.items()
+                if db is not None and library_id in broker.lmap
+            ]
+
+    def add_books(self, library_id, book_ids, force=False):
+        # Books are rendered newest first and only the newest count books are
+        # kept. Books already handled are skipped unless force is True, so
+        # that books evicted from the cache without being read are not
+        # rendered again by every scan.
+        for book_id in sorted(book_ids)[-self.count :]:
+            key = library_id, book_id
+            if force:
+                self.done.pop(key, None)
+            elif key in self.done:
+                continue
+            self.pending.pop(key, None)
+            self.pending[key] = True
+        while len(self.pending) > self.count:
+            self.pending.popitem(last=False)
+
+    def start_renders(self, dbs):
+        jm = self.ctx.jobs_manager
+        if jm is None:
+            return
+        self.running = {job_id for job_id in self.running if self.ctx.job_status(job_id)[0] in ('waiting', 'running')}
+        output_format, input_formats = prefs['output_format'], available_input_formats()
+        while self.pending and len(self.running) < self.max_concurrent and jm.has_spare_capacity:
+            key, _ = self.pending.popitem()
+            self.done[key] = True
+            while len(self.done) > 10 * self.count:
+                self.done.popitem(last=False)
+            library_id, book_id = key
+            db = dbs.get(library_id)
+            if db is None or not db.has_id(book_id):
+                continue
+            fmt = reader_format(db.formats(book_id), output_format, input_formats)
+            if fmt is not None:
+                job_id = prerender_book(self.ctx, db, book_id, fmt)
+                if job_id is not None:
+                    self.running.add(job_id)
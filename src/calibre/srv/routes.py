@@ -16,6 +16,7 @@
 from urllib.parse import quote as urlquote
 
 from calibre.srv.errors import HTTPNotFound, HTTPSimpleResponse, RouteError
+from calibre.srv.pool import FAST
 from calibre.srv.utils import http_date
 from calibre.utils.serialize import MSGPACK_MIME, json_dumps, msgpack_dumps
 
@@ -98,6 +99,7 @@ class RouteFunction:
     ok_code: int | None
     postprocess: PostProcessFunc | None
     needs_db_write: bool
+    job_class: str | Callable[..., str] = FAST
 
     is_endpoint: bool = True
 
@@ -127,6 +129,10 @@ def endpoint[**P](
     postprocess: PostProcessFunc | None = None,
     # Needs write access to the calibre database
     needs_db_write: bool = False,
+    # The class of worker job used to run this endpoint, one of fast, slow
+    # or bulk, see srv.pool. Can also be a function that is called with the
+    # path arguments and returns the class.
+    job_class: str | Callable[..., str] = FAST,
 ) -> Callable[[Callable[Concatenate[Context, RequestData, P], Any]], RouteFunction]:
     from calibre.srv.handler import Context  # noqa
     from calibre.srv.http_response import RequestData  # noqa
@@ -145,6 +151,7 @@ def annotate[**P](f: Callable[Concatenate[Context, RequestData, P], Any]) -> Rou
             postprocess=postprocess,
             ok_code=ok_code,
             needs_db_write=needs_db_write,
+            job_class=job_class,
         )
         argspec = inspect.getfullargspec(f)
         if len(argspec.args) < 2:
@@ -337,6 +344,14 @@ def find_route(self, path):
                     return route.endpoint, args
         raise HTTPNotFound()
 
+    def job_class_for(self, path):
+        try:
+            endpoint_, args = self.find_route(path)
+        except Exception:
+            return FAST
+        jc = endpoint_.job_class
+        return jc if isinstance(jc, str) else jc(*args)
+
     def read_cookies(self, data):
         data.cookies = c = {}
 
@@ -75,7 +75,13 @@ def __init__(self, libraries, opts):
         plugins = []
         if opts.use_bonjour:
             plugins.append(BonJour(wait_for_stop=max(0, opts.shutdown_timeout - 0.2)))
-        self.loop = ServerLoop(create_http_handler(self.handler.dispatch), opts=opts, log=log, access_log=access_log, plugins=plugins)
+        self.loop = ServerLoop(
+            create_http_handler(self.handler.dispatch, job_class_for=self.handler.router.job_class_for),
+            opts=opts,
+            log=log,
+            access_log=access_log,
+            plugins=plugins,
+        )
         self.handler.set_log(self.loop.log)
         self.handler.set_jobs_manager(self.loop.jobs_manager)
         self.serve_forever = self.loop.serve_forever
@@ -310,3 +310,118 @@ def test_last_read_cache(self):  # {{{
         self.ae(len(lrc.get_recently_read('user')), lrc.limit)
 
     # }}}
+
+    def test_rendered_books_cache(self):  # {{{
+        from threading import Event
+        from unittest.mock import patch
+
+        from calibre.srv import books
+
+        base = self.mkdtemp()
+        os.mkdir(os.path.join(base, 'f'))
+        orig, books._books_cache_dir = books._books_cache_dir, base
+
+        def render(bhash, size, age=0):
+            path = os.path.join(base, 'f', bhash)
+            os.mkdir(path)
+            mpath = os.path.join(path, 'calibre-book-manifest.json')
+            with open(mpath, 'wb') as f:
+                f.write(b'x' * size)
+            tm = time.time() - age
+            os.utime(mpath, (tm, tm))
+            return path
+
+        def present():
+            return set(os.listdir(os.path.join(base, 'f')))
+
+        try:
+            render('older', 100, age=9000)
+            render('old', 100, age=7200)
+            # The index is built in the background, readers do not wait for it
+            rb = books.RenderedBooks()
+            gate, orig_dir_size = Event(), books.dir_size
+            with patch.object(books, 'dir_size', lambda path: gate.wait() and orig_dir_size(path)):
+                rb.accessed('old', is_hit=True)
+                s = rb.stats()
+                self.ae((s['loaded'], s['num_books'], s['hits']), (False, 0, 1))
+                gate.set()
+                rb.ensure_loaded(wait=True)
+            s = rb.stats(reset=True)
+            self.ae((s['loaded'], s['num_books'], s['size']), (True, 2, 200))
+            rb = books.RenderedBooks()
+            rb.ensure_loaded(wait=True)
+            rb.budget = 250
+            # The least recently accessed book is evicted
+            rb.add('new', render('new', 100))
+            self.ae(present(), {'old', 'new'})
+            s = rb.stats()
+            self.ae((s['num_books'], s['size'], s['evicted'], s['evicted_size'], s['pinned']), (2, 200, 1, 100, 1))
+            # Recently accessed books are pinned
+            rb.accessed('old')
+            rb.add('newer', render('newer', 100))
+            self.ae(present(), {'old', 'new', 'newer'})
+            self.ae(rb.stats()['pinned'], 3)
+            rb.pin_time = 0
+            rb.evict()
+            self.ae(present(), {'old', 'newer'})
+            # Hit and miss statistics
+            rb.accessed('old', is_hit=True), rb.missed()
+            s = rb.stats(reset=True)
+            self.ae((s['hits'], s['misses'], s['added']), (1, 1, 2))
+            self.ae(rb.stats()['hits'], 0)
+            # With no budget books are evicted by age
+            rb.budget = 0
+            rb.evict()
+            self.ae(present(), {'old', 'newer'})
+            rb.max_age = 0
+            rb.evict()
+            self.ae(present(), set())
+            self.ae(rb.stats()['size'], 0)
+            # The statistics are available to users with write access
+            with self.create_server(auth=True, auth_mode='basic') as server:
+                server.handler.ctx.user_manager.add_user('12', 'test')
+                server.handler.ctx.user_manager.add_user('ro', 'test', readonly=True)
+                conn = server.connect()
+
+                def get_stats(user):
+                    conn.request('GET', '/reader-cache-stats', headers={'Authorization': 'Basic ' + as_base64_bytes(user + ':test').decode()})
+                    r = conn.getresponse()
+                    return r.status, r.read()
+
+                status, raw = get_stats('12')
+                self.ae(status, http.client.OK)
+                self.assertIn('evicted', json.loads(raw))
+                self.ae(get_stats('ro')[0], http.client.FORBIDDEN)
+        finally:
+            books._books_cache_dir = orig
+
+    # }}}
+
+    def test_prerender(self):  # {{{
+        from calibre.srv.opts import Options
+        from calibre.srv.prerender import Prerenderer, reader_format
+
+        # The same format is chosen as by the web reader
+        self.ae(reader_format(('EPUB', 'AZW3'), 'azw3', ('epub', 'azw3')), 'AZW3')
+        self.ae(reader_format(('PDF', 'MOBI'), 'PDF', ('pdf', 'mobi')), 'MOBI')
+        self.ae(reader_format(('PDF', 'TXT', 'RTF'), 'EPUB', ('pdf', 'txt', 'rtf')), 'RTF')
+        self.ae(reader_format(('XYZ',), 'EPUB', ('epub',)), None)
+
+        class Ctx:
+            opts = Options(prerender_books=2)
+
+        p = Prerenderer(Ctx())
+        # Only the newest books are rendered, newest first
+        p.add_books('l', (3, 1, 2))
+        p.add_books('m', (1,))
+        self.ae(list(p.pending), [('l', 3), ('m', 1)])
+        self.ae(p.pending.popitem()[0], ('m', 1))
+        p.done[('m', 1)] = True
+        # Books already handled are skipped unless they were changed
+        p.add_books('m', (1,))
+        self.ae(list(p.pending), [('l', 3)])
+        p.add_books('m', (1,), force=True)
+        self.ae(list(p.pending), [('l', 3), ('m', 1)])
+        self.assertNotIn(('m', 1), p.done)
+
+    # }}}
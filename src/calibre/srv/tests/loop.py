@@ -98,6 +98,66 @@ def test_workers(self):
             w.join()
         self.ae(0, sum(int(w.is_alive()) for w in server.loop.pool.workers))
 
+    def test_job_classes(self):
+        "Test scheduling of the different classes of worker jobs"
+        from queue import Empty
+
+        from calibre.srv.pool import BULK, FAST, SLOW, ThreadPool
+
+        pool = ThreadPool(None, lambda: None, count=4, min_count=1, idle_timeout=0.1)
+        self.ae(pool.class_limits, {FAST: 4, SLOW: 2, BULK: 1})
+        pool.start()
+        block = Event()
+
+        def wait_for(condition):
+            st = monotonic()
+            while not condition() and monotonic() - st < 5:
+                time.sleep(0.01)
+            self.assertTrue(condition())
+
+        def results():
+            ans = {}
+            while True:
+                try:
+                    job_id, ok, result = pool.get_nowait()
+                except Empty:
+                    return ans
+                self.assertTrue(ok)
+                ans[job_id] = result
+
+        try:
+            for i in range(3):
+                pool.put_nowait(('slow', i), block.wait, SLOW)
+                pool.put_nowait(('bulk', i), block.wait, BULK)
+            wait_for(lambda: pool.busy == 3)
+            stats = pool.stats()
+            self.ae((stats[SLOW]['running'], stats[SLOW]['queued']), (2, 1))
+            self.ae((stats[BULK]['running'], stats[BULK]['queued']), (1, 2))
+            # Fast jobs are not held up by the slow and bulk jobs
+            for i in range(5):
+                pool.put_nowait(('fast', i), lambda: 'fast', FAST)
+            wait_for(lambda: pool.stats()[FAST]['started'] == 5)
+            wait_for(lambda: pool.result_queue.qsize() == 5)
+            self.ae(set(results()), {('fast', i) for i in range(5)})
+            block.set()
+            wait_for(lambda: pool.result_queue.qsize() == 6)
+            self.ae(set(results()), {(jc, i) for jc in ('slow', 'bulk') for i in range(3)})
+            stats = pool.stats(reset=True)
+            self.ae({jc: s['started'] for jc, s in stats.items()}, {FAST: 5, SLOW: 3, BULK: 3})
+            self.assertGreater(stats[BULK]['max_wait'], 0)
+            self.ae(pool.stats()[BULK]['started'], 0)
+            # Idle workers exit and new ones are started on demand
+            wait_for(lambda: len(pool.workers) == 1)
+            block.clear()
+            for i in range(3):
+                pool.put_nowait(i, block.wait, FAST)
+            wait_for(lambda: pool.busy == 3)
+            self.ae(len(pool.workers), 3)
+        finally:
+            block.set()
+            pool.stop(monotonic() + 5)
+        self.ae(pool.workers, [])
+
     def test_fallback_interface(self):
         "Test falling back to default interface"
         with TestServer(lambda data: data.path[0] + data.read(), listen_on='1.1.1.1', fallback_to_detected_interface=True) as server:
@@ -135,6 +195,35 @@ def test_dual_stack(self):
             self.ae(r.status, http.client.OK)
             self.ae(r.read(), b'testbody')
 
+    def test_idle_connections(self):
+        "Test that idle connections are expired and unregistered from the selector"
+        with TestServer(lambda data: data.path[0] + data.read().decode('utf-8'), timeout=0.2) as server:
+            idle = []
+            for i in range(20):
+                idle.append(socket.create_connection(server.address))
+            conn = server.connect(timeout=5)
+            for i in range(10):
+                conn.request('GET', '/test', 'body')
+                r = conn.getresponse()
+                self.ae(r.status, http.client.OK)
+                self.ae(r.read(), b'testbody')
+            st = monotonic()
+            while server.loop.num_active_connections and monotonic() - st < 5:
+                time.sleep(0.05)
+            self.ae(server.loop.num_active_connections, 0)
+            # Only the listening socket and the control connection remain
+            self.ae(len(server.loop.selector.get_map()), 2)
+            for s in idle:
+                s.settimeout(5)
+                data = b''
+                while True:
+                    x = s.recv(4096)
+                    if not x:
+                        break
+                    data += x
+                self.assertTrue(data.startswith(b'HTTP/1.0 408 '), data)
+                s.close()
+
     def test_ring_buffer(self):
         "Test the ring buffer used for reads"
 
@@ -305,9 +394,84 @@ def job_status(jid):
         self.assertFalse(was_aborted)
         self.assertTrue(tb)
         self.assertIn('a testing error', tb)
+
+        # Worker processes are reused and recycled after max_jobs_per_worker jobs
+        def worker_pid():
+            job_id = jm.start_job('pid test', 'calibre.srv.jobs', 'pid_test')
+            while job_status(job_id) in s:
+                time.sleep(0.01)
+            return jm.job_status(job_id)[1]
+
+        pid = worker_pid()
+        self.assertNotEqual(pid, os.getpid())
+        self.ae(pid, worker_pid())
+        jm.worker_pool.max_jobs_per_worker = 1
+        pids = [worker_pid() for i in range(3)]
+        self.ae(pids[0], pid)
+        self.ae(len(set(pids)), 3)
         jm.start_job('simple test', 'calibre.srv.jobs', 'sleep_test', args=(1.0,))
         jm.shutdown(), jm.wait_for_shutdown(monotonic() + 1)
 
+    def test_worker_pool(self):
+        "Test that starting and checking worker processes is done without the worker pool lock"
+        from threading import Thread
+
+        from calibre.srv.jobs import WorkerPool
+
+        pool = WorkerPool(2)
+
+        def lock_is_free():
+            ans = []
+
+            def check():
+                ans.append(pool.lock.acquire(timeout=1))
+                if ans[0]:
+                    pool.lock.release()
+
+            t = Thread(target=check)
+            t.start(), t.join()
+            return ans[0]
+
+        class Worker:
+            num_jobs = rss = 0
+
+            def __init__(self):
+                self.last_used = monotonic()
+                self.killed = self.stopped = False
+                self.healthy = True
+                self.started_without_lock = lock_is_free()
+                self.checked_without_lock = None
+
+            def is_healthy(self):
+                self.checked_without_lock = lock_is_free()
+                return self.healthy
+
+            def kill(self):
+                self.killed = True
+
+            def shutdown(self):
+                self.stopped = True
+
+        pool.create_worker = Worker
+        w = pool.get()
+        self.assertTrue(w.started_without_lock)
+        self.ae(len(pool.idle_workers), 1)
+        spare = pool.idle_workers[0]
+        self.assertTrue(spare.started_without_lock)
+        pool.put(w)
+        # A worker unused for a while is checked before reuse, and killed if
+        # it does not respond
+        w.last_used -= 2 * pool.health_check_interval
+        w.healthy = False
+        self.assertIs(pool.get(), spare)
+        self.assertTrue(w.checked_without_lock)
+        self.assertTrue(w.killed)
+        self.ae(len(pool.idle_workers), 1)
+        pool.put(spare, reusable=False)
+        self.assertTrue(spare.killed)
+        pool.shutdown()
+        self.assertTrue(all(x.stopped for x in (w, spare) if not x.killed))
+
 
 def find_tests():
     import unittest
@@ -95,10 +95,14 @@ def soak_opt(ctx, dest, rest):
         def quoting(ctx, dest, x):
             pass
 
-        @endpoint('/get/{a}/{b=None}')
+        @endpoint('/get/{a}/{b=None}', job_class=lambda a, b: 'bulk' if a == 'epub' else 'fast')
         def get(ctx, dest, a, b):
             pass
 
+        @endpoint('/slow', job_class='slow')
+        def slow(ctx, dest):
+            pass
+
         for x in locals().values():
             if getattr(x, 'is_endpoint', False):
                 router.add(x)
@@ -130,3 +134,12 @@ def get(ctx, dest, a, b):
         self.ae(router.url_for('/needs quoting', x='a/b c'), '/needs quoting/a%2Fb%20c')
         self.ae(router.url_for(None), '/')
         self.ae(router.url_for('/get', a='1', b='xxx'), '/get/1/xxx')
+
+        def job_class(path):
+            return router.job_class_for(list(filter(None, path.split('/'))))
+
+        self.ae(job_class('/slow'), 'slow')
+        self.ae(job_class('/get/epub/1'), 'bulk')
+        self.ae(job_class('/get/cover/1'), 'fast')
+        self.ae(job_class('/'), 'fast')
+        self.ae(job_class('/does/not/exist'), 'fast')
@@ -1008,7 +1008,7 @@ def error(self, message, line_number) -> NoReturn:
         m = _('Interpreter: {0} - line number {1}').format(message, line_number)
         raise ValueError(m)
 
-    def program(self, funcs, parent, prog, val, is_call=False, args=None, global_vars=None, break_reporter=None):
+    def program(self, funcs, parent, prog, val, is_call=False, args=None, global_vars=None, break_reporter=None, compiled=None):
         self.parent = parent
         self.parent_kwargs = parent.kwargs
         self.parent_book = parent.book
@@ -1027,6 +1027,8 @@ def program(self, funcs, parent, prog, val, is_call=False, args=None, global_var
             if is_call:
                 # prog is an instance of the function definition class
                 ret = self.do_node_stored_template_call(StoredTemplateCallNode(1, prog.name, prog, None), args=args)
+            elif compiled is not None:
+                ret = compiled(self)
             else:
                 ret = self.expression_list(prog)
         except ReturnExecuted as e:
@@ -1671,6 +1673,595 @@ def expr(self, prog):
             self.error(_("Internal error evaluating an expression: '{0}'").format(str(e)), prog.line_number)
 
 
+class _Compiler:
+    """
+    Turns a parsed template program into a tree of Python closures, removing
+    the cost of dispatching on the node type for every node every time the
+    template is evaluated. Each closure takes the :class:`_Interpreter` that
+    holds the evaluation state (locals, book, etc.) and behaves exactly like
+    the corresponding do_node_*() method of the interpreter when no break
+    reporter is in use. Stored templates and f-strings are run by the
+    interpreter.
+    """
+
+    def __init__(self):
+        # Map of local function definitions to their compiled defaults and body
+        self.local_functions = {}
+
+    def compile(self, prog):
+        return self.expr(prog)
+
+    def expr(self, prog):
+        if isinstance(prog, list):
+            return self.expression_list(prog)
+        return self.NODE_COMPILERS[prog.node_type](self, prog)
+
+    def guarded(self, func, line_number):
+        # The equivalent of the error handling in _Interpreter.expr()
+        def guarded(ip):
+            try:
+                return func(ip)
+            except ValueError, ExecutionBase, StopException:
+                raise
+            except Exception as e:
+                if DEBUG:
+                    traceback.print_exc()
+                ip.error(_("Internal error evaluating an expression: '{0}'").format(str(e)), line_number)
+
+        return guarded
+
+    def expression_list(self, prog):
+        exprs = tuple(self.expr(p) for p in prog)
+
+        def expression_list(ip):
+            val = ''
+            try:
+                for e in exprs:
+                    val = e(ip)
+            except (BreakExecuted, ContinueExecuted) as e:
+                e.set_value(val)
+                raise e
+            return val
+
+        return expression_list
+
+    def compile_with(self, prog):
+        line_number = prog.line_number
+        book_id_expr, block = self.expr(prog.book_id), self.expr(prog.block)
+
+        def do_with(ip):
+            parent_book = ip.parent_book
+            try:
+                book_id = int(book_id_expr(ip))
+                ip.parent_book = ip.parent.book = get_database(parent_book, 'with statement').new_api.get_proxy_metadata(book_id)
+                return block(ip)
+            except (StopException, ValueError, ReturnExecuted) as e:
+                raise e
+            except Exception as e:
+                ip.error(_("Unhandled exception '{0}'").format(e), line_number)
+            finally:
+                ip.parent_book = ip.parent.book = parent_book
+
+        return do_with
+
+    def compile_if(self, prog):
+        condition, then_part = self.expr(prog.condition), self.expr(prog.then_part)
+        else_part = self.expr(prog.else_part) if prog.else_part else None
+
+        def do_if(ip):
+            if condition(ip):
+                return then_part(ip)
+            if else_part is not None:
+                return else_part(ip)
+            return ''
+
+        return do_if
+
+    def compile_for(self, prog):
+        line_number, variable = prog.line_number, prog.variable
+        separator_expr = None if prog.separator is None else self.expr(prog.separator)
+        list_field_expr, block = self.expr(prog.list_field_expr), self.expr(prog.block)
+
+        def do_for(ip):
+            try:
+                separator = ',' if separator_expr is None else separator_expr(ip)
+                f = list_field_expr(ip)
+                res = getattr(ip.parent_book, f, f)
+                if res is not None:
+                    if isinstance(res, str):
+                        res = [r.strip() for r in res.split(separator) if r.strip()]
+                    ret = ''
+                    try:
+                        for x in res:
+                            try:
+                                ip.locals[variable] = x
+                                ret = block(ip)
+                            except ContinueExecuted as e:
+                                ret = e.get_value()
+                    except BreakExecuted as e:
+                        ret = e.get_value()
+                return ret
+            except (StopException, ValueError, ReturnExecuted) as e:
+                raise e
+            except Exception as e:
+                ip.error(_("Unhandled exception '{0}'").format(e), line_number)
+
+        return do_for
+
+    def compile_range(self, prog):
+        line_number, variable = prog.line_number, prog.variable
+        start_expr, stop_expr, step_expr = self.expr(prog.start_expr), self.expr(prog.stop_expr), self.expr(prog.step_expr)
+        limit_expr = None if prog.limit_expr is None else self.expr(prog.limit_expr)
+        block = self.expr(prog.block)
+
+        def do_range(ip):
+            try:
+                vals = []
+                for name, e in (('start', start_expr), ('stop', stop_expr), ('step', step_expr), ('limit', limit_expr)):
+                    try:
+                        vals.append(1000 if e is None else int(ip.float_deal_with_none(e(ip))))
+                    except ValueError:
+                        ip.error(_('{0}: {1} must be an integer').format('for', name), line_number)
+                start_val, stop_val, step_val, limit_val = vals
+                ret = ''
+                try:
+                    range_gen = range(start_val, stop_val, step_val)
+                    if len(range_gen) > limit_val:
+                        ip.error(
+                            _('{0}: the range length ({1}) is larger than the limit ({2})').format('for', str(len(range_gen)), str(limit_val)),
+                            line_number,
+                        )
+                    for x in (str(x) for x in range_gen):
+                        try:
+                            ip.locals[variable] = x
+                            ret = block(ip)
+                        except ContinueExecuted as e:
+                            ret = e.get_value()
+                except BreakExecuted as e:
+                    ret = e.get_value()
+                return ret
+            except (StopException, ValueError) as e:
+                raise e
+            except Exception as e:
+                ip.error(_("Unhandled exception '{0}'").format(e), line_number)
+
+        return do_range
+
+    def compile_rvalue(self, prog):
+        name, line_number = prog.name, prog.line_number
+
+        def do_rvalue(ip):
+            try:
+                return ip.locals[name]
+            except Exception:
+                ip.error(_("Unknown identifier '{0}'").format(name), line_number)
+
+        return do_rvalue
+
+    def compile_func(self, prog):
+        name, args = prog.name.strip(), tuple(self.expr(arg) for arg in prog.expression_list)
+
+        def do_func(ip):
+            vals = [arg(ip) for arg in args]
+            return ip.funcs[name].eval_(ip.parent, ip.parent_kwargs, ip.parent_book, ip.locals, *vals)
+
+        return self.guarded(do_func, prog.line_number)
+
+    def compile_stored_template_call(self, prog):
+        args = tuple(self.expr(arg) for arg in prog.expression_list)
+
+        def do_stored_template_call(ip):
+            return ip.do_node_stored_template_call(prog, args=[arg(ip) for arg in args])
+
+        return self.guarded(do_stored_template_call, prog.line_number)
+
+    def compile_local_function_define(self, prog):
+        self.local_functions[prog] = tuple(self.expr(arg.right) for arg in prog.argument_list), self.expr(prog.block)
+        name = prog.name
+
+        def do_local_function_define(ip):
+            ip.local_functions[name] = prog
+            return ''
+
+        return do_local_function_define
+
+    def compile_local_function_call(self, prog):
+        name, line_number = prog.name, prog.line_number
+        args = tuple(self.expr(arg) for arg in prog.arguments)
+        compiled_functions = self.local_functions
+
+        def do_local_function_call(ip):
+            definition = ip.local_functions[name]
+            argument_list = definition.argument_list
+            if len(args) > len(argument_list):
+                ip.error(
+                    _('Function {0}: argument count mismatch -- {1} given, at most {2} required').format(name, len(args), len(argument_list)),
+                    line_number,
+                )
+            compiled = compiled_functions.get(definition)
+            new_locals = {}
+            for i, arg in enumerate(argument_list):
+                if len(args) > i:
+                    new_locals[arg.left] = args[i](ip)
+                else:
+                    new_locals[arg.left] = ip.expr(arg.right) if compiled is None else compiled[0][i](ip)
+            saved_locals = ip.locals
+            ip.locals = new_locals
+            try:
+                val = ip.expr(definition.block) if compiled is None else compiled[1](ip)
+            except ReturnExecuted as e:
+                val = e.get_value()
+            finally:
+                ip.locals = saved_locals
+            return val
+
+        return self.guarded(do_local_function_call, line_number)
+
+    def compile_arguments(self, prog):
+        args = tuple((dex, arg.left, self.expr(arg.right)) for dex, arg in enumerate(prog.expression_list))
+
+        def do_arguments(ip):
+            for dex, left, right in args:
+                ip.locals[left] = ip.locals.get('*arg_' + str(dex), right(ip))
+            return ''
+
+        return do_arguments
+
+    def compile_globals(self, prog):
+        args = tuple((arg.left, self.expr(arg.right)) for arg in prog.expression_list)
+
+        def do_globals(ip):
+            res = ''
+            for left, right in args:
+                res = ip.locals[left] = ip.global_vars.get(left, right(ip))
+            return res
+
+        return do_globals
+
+    def compile_set_globals(self, prog):
+        args = tuple((arg.left, self.expr(arg.right)) for arg in prog.expression_list)
+
+        def do_set_globals(ip):
+            res = ''
+            for left, right in args:
+                res = ip.global_vars[left] = ip.locals.get(left, right(ip))
+            return res
+
+        return do_set_globals
+
+    def compile_constant(self, prog):
+        value = prog.value
+        return lambda ip: value
+
+    def compile_field(self, prog):
+        line_number, name_expr = prog.line_number, self.expr(prog.expression)
+
+        def do_field(ip):
+            try:
+                name = name_expr(ip)
+                try:
+                    return ip.parent.get_value(name, [], ip.parent_kwargs)
+                except StopException:
+                    raise
+                except Exception:
+                    ip.error(_("Unknown field '{0}'").format(name), line_number)
+            except StopException, ValueError:
+                raise
+            except Exception:
+                ip.error(_("Unknown field '{0}'").format('internal parse error'), line_number)
+
+        return do_field
+
+    def compile_raw_field(self, prog):
+        line_number, name_expr = prog.line_number, self.expr(prog.expression)
+        default = None if prog.default is None else self.expr(prog.default)
+        # Field names are almost always constants, look them up only once
+        expression = prog.expression
+        if isinstance(expression, list) and len(expression) == 1:
+            expression = expression[0]
+        key = field_metadata.search_term_to_field_key(expression.value) if getattr(expression, 'node_type', None) == Node.NODE_CONSTANT else None
+
+        def do_raw_field(ip):
+            try:
+                name = field_metadata.search_term_to_field_key(name_expr(ip)) if key is None else key
+                res = getattr(ip.parent_book, name, None)
+                if res is None and default is not None:
+                    return default(ip)
+                if res is not None:
+                    if isinstance(res, list):
+                        fm = ip.parent_book.metadata_for_field(name)
+                        if fm is None:
+                            res = ', '.join(res)
+                        else:
+                            res = fm['is_multiple']['list_to_ui'].join(res)
+                    else:
+                        res = str(res)
+                else:
+                    res = str(res)  # Should be the string "None"
+                return res
+            except (StopException, ValueError) as e:
+                raise e
+            except Exception:
+                ip.error(_("Unknown field '{0}'").format('internal parse error'), line_number)
+
+        return do_raw_field
+
+    def compile_assign(self, prog):
+        left, right = prog.left, self.expr(prog.right)
+
+        def do_assign(ip):
+            t = ip.locals[left] = right(ip)
+            return t
+
+        return do_assign
+
+    def compile_first_non_empty(self, prog):
+        exprs = tuple(self.expr(e) for e in prog.expression_list)
+
+        def do_first_non_empty(ip):
+            for e in exprs:
+                v = e(ip)
+                if v:
+                    return v
+            return ''
+
+        return do_first_non_empty
+
+    def compile_switch(self, prog):
+        exprs = tuple(self.expr(e) for e in prog.expression_list)
+        value_expr, default = exprs[0], exprs[-1]
+        cases = tuple((exprs[i], exprs[i + 1]) for i in range(1, len(exprs) - 1, 2))
+
+        def do_switch(ip):
+            val = value_expr(ip)
+            for pattern, result in cases:
+                if re.search(pattern(ip), val, flags=re.I):
+                    return result(ip)
+            return default(ip)
+
+        return self.guarded(do_switch, prog.line_number)
+
+    def compile_switch_if(self, prog):
+        exprs = tuple(self.expr(e) for e in prog.expression_list)
+        cases, default = tuple((exprs[i], exprs[i + 1]) for i in range(0, len(exprs) - 1, 2)), exprs[-1]
+
+        def do_switch_if(ip):
+            for test, result in cases:
+                if test(ip):
+                    return result(ip)
+            return default(ip)
+
+        return do_switch_if
+
+    def compile_strcat(self, prog):
+        exprs = tuple(self.expr(e) for e in prog.expression_list)
+
+        def do_strcat(ip):
+            return ''.join([e(ip) for e in exprs])
+
+        return self.guarded(do_strcat, prog.line_number)
+
+    def compile_f_string(self, prog):
+        return self.guarded(lambda ip: ip.do_node_f_string(prog), prog.line_number)
+
+    def compile_list_count_field(self, prog):
+        line_number, name_expr = prog.line_number, self.expr(prog.expression)
+
+        def do_list_count_field(ip):
+            name = field_metadata.search_term_to_field_key(name_expr(ip))
+            res = getattr(ip.parent_book, name, None)
+            if res is None or not isinstance(res, (list, tuple, set, dict)):
+                ip.error(_("Field '{0}' is either not a field or not a list").format(name), line_number)
+            return str(len(res))
+
+        return self.guarded(do_list_count_field, line_number)
+
+    def compile_break(self, prog):
+        def do_break(ip):
+            raise BreakExecuted()
+
+        return do_break
+
+    def compile_continue(self, prog):
+        def do_continue(ip):
+            raise ContinueExecuted()
+
+        return do_continue
+
+    def compile_return(self, prog):
+        value_expr = self.expr(prog.expr)
+
+        def do_return(ip):
+            e = ReturnExecuted()
+            e.set_value(value_expr(ip))
+            raise e
+
+        return do_return
+
+    def compile_contains(self, prog):
+        value_expr, test_expr = self.expr(prog.value_expression), self.expr(prog.test_expression)
+        match_expr, not_match_expr = self.expr(prog.match_expression), self.expr(prog.not_match_expression)
+
+        def do_contains(ip):
+            v = value_expr(ip)
+            t = test_expr(ip)
+            if re.search(t, v, flags=re.I):
+                return match_expr(ip)
+            return not_match_expr(ip)
+
+        return self.guarded(do_contains, prog.line_number)
+
+    def compile_string_infix(self, prog):
+        line_number, operator, left_expr, right_expr = prog.line_number, prog.operator, self.expr(prog.left), self.expr(prog.right)
+        op = _Interpreter.INFIX_STRING_COMPARE_OPS.get(operator)
+
+        def do_string_infix(ip):
+            try:
+                left = left_expr(ip)
+                right = right_expr(ip)
+                if op is not None:
+                    return '1' if op(left, right) else ''
+                if operator == 'inlist_field':
+                    return ip.do_inlist_field(left, right, prog)
+                raise KeyError(operator)
+            except (StopException, ValueError) as e:
+                raise e
+            except Exception:
+                ip.error(_("Error during string comparison: operator '{0}'").format(operator), line_number)
+
+        return do_string_infix
+
+    def compile_numeric_infix(self, prog):
+        line_number, operator, left_expr, right_expr = prog.line_number, prog.operator, self.expr(prog.left), self.expr(prog.right)
+        op = _Interpreter.INFIX_NUMERIC_COMPARE_OPS.get(operator)
+
+        def do_numeric_infix(ip):
+            try:
+                left = ip.float_deal_with_none(left_expr(ip))
+                right = ip.float_deal_with_none(right_expr(ip))
+                return '1' if op(left, right) else ''
+            except (StopException, ValueError) as e:
+                raise e
+            except Exception:
+                ip.error(_("Value used in comparison is not a number: operator '{0}'").format(operator), line_number)
+
+        return do_numeric_infix
+
+    def compile_logop(self, prog):
+        line_number, operator, left_expr, right_expr = prog.line_number, prog.operator, self.expr(prog.left), self.expr(prog.right)
+        is_and = operator == 'and'
+
+        def do_logop(ip):
+            try:
+                if is_and:
+                    return '1' if left_expr(ip) and right_expr(ip) else ''
+                return '1' if left_expr(ip) or right_expr(ip) else ''
+            except (StopException, ValueError) as e:
+                raise e
+            except Exception:
+                ip.error(_("Error during operator evaluation: operator '{0}'").format(operator), line_number)
+
+        return do_logop
+
+    def compile_logop_unary(self, prog):
+        line_number, operator, value_expr = prog.line_number, prog.operator, self.expr(prog.expr)
+        op = _Interpreter.LOGICAL_UNARY_OPS.get(operator)
+
+        def do_logop_unary(ip):
+            try:
+                expr = value_expr(ip)
+                return '1' if op(expr) else ''
+            except (StopException, ValueError) as e:
+                raise e
+            except Exception:
+                ip.error(_("Error during operator evaluation: operator '{0}'").format(operator), line_number)
+
+        return do_logop_unary
+
+    def compile_binary_arithop(self, prog):
+        line_number, operator, left_expr, right_expr = prog.line_number, prog.operator, self.expr(prog.left), self.expr(prog.right)
+        op = _Interpreter.ARITHMETIC_BINARY_OPS.get(operator)
+
+        def do_binary_arithop(ip):
+            try:
+                answer = op(ip.float_deal_with_none(left_expr(ip)), ip.float_deal_with_none(right_expr(ip)))
+                return str(answer if modf(answer)[0] != 0 else int(answer))
+            except (StopException, ValueError) as e:
+                raise e
+            except Exception:
+                ip.error(_("Error during operator evaluation: operator '{0}'").format(operator), line_number)
+
+        return do_binary_arithop
+
+    def compile_unary_arithop(self, prog):
+        line_number, operator, value_expr = prog.line_number, prog.operator, self.expr(prog.expr)
+        op = _Interpreter.ARITHMETIC_UNARY_OPS.get(operator)
+
+        def do_unary_arithop(ip):
+            try:
+                expr = op(float(value_expr(ip)))
+                return str(expr if modf(expr)[0] != 0 else int(expr))
+            except (StopException, ValueError) as e:
+                raise e
+            except Exception:
+                ip.error(_("Error during operator evaluation: operator '{0}'").format(operator), line_number)
+
+        return do_unary_arithop
+
+    def compile_stringops(self, prog):
+        line_number, operator, left_expr, right_expr = prog.line_number, prog.operator, self.expr(prog.left), self.expr(prog.right)
+
+        def do_stringops(ip):
+            try:
+                return left_expr(ip) + right_expr(ip)
+            except (StopException, ValueError) as e:
+                raise e
+            except Exception:
+                ip.error(_("Error during operator evaluation: operator '{0}'").format(operator), line_number)
+
+        return do_stringops
+
+    def compile_character(self, prog):
+        line_number, key_expr = prog.line_number, self.expr(prog.expression)
+
+        def do_character(ip):
+            key = key_expr(ip)
+            ret = ip.characters.get(key, None)
+            if ret is None:
+                ip.error(_("Function {0}: invalid character name '{1}").format('character', key), line_number)
+            return ret
+
+        return self.guarded(do_character, line_number)
+
+    def compile_print(self, prog):
+        args = tuple(self.expr(arg) for arg in prog.arguments)
+
+        def do_print(ip):
+            res = [arg(ip) for arg in args]
+            print(res)
+            return res[0] if res else ''
+
+        return self.guarded(do_print, prog.line_number)
+
+    NODE_COMPILERS = {
+        Node.NODE_IF: compile_if,
+        Node.NODE_ASSIGN: compile_assign,
+        Node.NODE_CONSTANT: compile_constant,
+        Node.NODE_RVALUE: compile_rvalue,
+        Node.NODE_FUNC: compile_func,
+        Node.NODE_FIELD: compile_field,
+        Node.NODE_RAW_FIELD: compile_raw_field,
+        Node.NODE_COMPARE_STRING: compile_string_infix,
+        Node.NODE_COMPARE_NUMERIC: compile_numeric_infix,
+        Node.NODE_ARGUMENTS: compile_arguments,
+        Node.NODE_CALL_STORED_TEMPLATE: compile_stored_template_call,
+        Node.NODE_FIRST_NON_EMPTY: compile_first_non_empty,
+        Node.NODE_SWITCH: compile_switch,
+        Node.NODE_SWITCH_IF: compile_switch_if,
+        Node.NODE_FOR: compile_for,
+        Node.NODE_RANGE: compile_range,
+        Node.NODE_GLOBALS: compile_globals,
+        Node.NODE_SET_GLOBALS: compile_set_globals,
+        Node.NODE_CONTAINS: compile_contains,
+        Node.NODE_BINARY_LOGOP: compile_logop,
+        Node.NODE_UNARY_LOGOP: compile_logop_unary,
+        Node.NODE_BINARY_ARITHOP: compile_binary_arithop,
+        Node.NODE_UNARY_ARITHOP: compile_unary_arithop,
+        Node.NODE_PRINT: compile_print,
+        Node.NODE_BREAK: compile_break,
+        Node.NODE_CONTINUE: compile_continue,
+        Node.NODE_RETURN: compile_return,
+        Node.NODE_CHARACTER: compile_character,
+        Node.NODE_STRCAT: compile_strcat,
+        Node.NODE_BINARY_STRINGOP: compile_stringops,
+        Node.NODE_LOCAL_FUNCTION_DEFINE: compile_local_function_define,
+        Node.NODE_LOCAL_FUNCTION_CALL: compile_local_function_call,
+        Node.NODE_LIST_COUNT_FIELD: compile_list_count_field,
+        Node.NODE_WITH: compile_with,
+        Node.NODE_FSTRING: compile_f_string,
+    }
+
+
 @lru_cache(maxsize=2)
 def args_scanner() -> re.Scanner:  # type: ignore
     return re.Scanner([  # type: ignore
@@ -1784,14 +2375,22 @@ def lex_scanner(self):
         return cached_lex_scanner()
 
     def _eval_program(self, val, prog, column_name, global_vars, break_reporter):
+        compiled = None
         if column_name is not None and self.template_cache is not None:
             tree = self.template_cache.get(column_name, None)
             if not tree:
                 tree = self.gpm_parser.program(self, self.funcs, self.lex_scanner.scan(prog))
                 self.template_cache[column_name] = tree
+            if break_reporter is None:
+                # Cached templates are evaluated many times, so it is worth
+                # compiling them. The break reporter needs the interpreter.
+                cached = self.template_cache.get(column_name + '::compiled', None)
+                if cached is None or cached[0] is not tree:
+                    cached = self.template_cache[column_name + '::compiled'] = tree, _Compiler().compile(tree)
+                compiled = cached[1]
         else:
             tree = self.gpm_parser.program(self, self.funcs, self.lex_scanner.scan(prog))
-        return self.gpm_interpreter.program(self.funcs, self, tree, val, global_vars=global_vars, break_reporter=break_reporter)
+        return self.gpm_interpreter.program(self.funcs, self, tree, val, global_vars=global_vars, break_reporter=break_reporter, compiled=compiled)
 
     def _eval_sfm_call(self, template_name, args, global_vars):
         func = self.funcs[template_name]
@@ -2088,6 +2687,195 @@ def safe_format(
         finally:
             self.restore_state(state)
 
+    # ######### evaluate one template for many books ############
+
+    def safe_format_books(
+        self,
+        format_spec,
+        books,
+        error_value,
+        column_name=None,
+        template_cache=None,
+        strip_results=True,
+        template_functions=None,
+        global_vars=None,
+        database=None,
+        max_workers=1,
+    ):
+        """
+        Evaluate format_spec for many books, returning a dict mapping book id
+        to the result. books is an iterable of (book_id, mi) pairs, mi is used
+        both as the kwargs and as the book, like in the usual call
+        safe_format(format_spec, mi, error_value, mi). The result for each book
+        is the same as that of safe_format() but the template is parsed and the
+        formatter set up only once. Every book gets its own copy of global_vars.
+
+        If max_workers is greater than one, the books are divided between that
+        many threads, each with its own formatter. Only do that if the mi
+        objects can be used from other threads.
+        """
+        if template_cache is None:
+            # Parse the template only once, even if the caller has no cache
+            template_cache = {}
+            if column_name is None:
+                column_name = ''
+        if max_workers > 1:
+            return self._safe_format_books_in_threads(
+                format_spec,
+                books,
+                error_value,
+                max_workers,
+                column_name=column_name,
+                template_cache=template_cache,
+                strip_results=strip_results,
+                template_functions=template_functions,
+                global_vars=global_vars,
+                database=database,
+            )
+        state = self.save_state()
+        is_base_level = self.recursion_level == 0
+        if is_base_level:
+            self.database = database
+        ans = {}
+        try:
+            self._caller = FormatterFuncsCaller(self)
+            self.strip_results = strip_results
+            self.column_name = column_name
+            self.template_cache = template_cache
+            self.funcs = template_functions or formatter_functions().get_functions()
+            for book_id, book in books:
+                if is_base_level:
+                    self.composite_values = {}
+                self.kwargs = self.book = book
+                self.global_vars = dict(global_vars) if isinstance(global_vars, dict) else {}
+                self.python_context_object = PythonTemplateContext()
+                self.locals = {}
+                try:
+                    val = self.evaluate(format_spec, [], book, self.global_vars)
+                except StopException as e:
+                    val = error_message(e)
+                except Exception as e:
+                    template_error_reporter(e, format_spec, book, book, column_name)
+                    val = error_value + ' ' + error_message(e)
+                ans[book_id] = val
+            return ans
+        finally:
+            self.restore_state(state)
+
+    def _safe_format_books_in_threads(self, format_spec, books, error_value, max_workers, **kwargs):
+        from concurrent.futures import ThreadPoolExecutor
+
+        books = iter(books)
+        # Evaluate the first book here so that the threads find the template
+        # already parsed in the cache
+        ans = self.safe_format_books(format_spec, [b for b in (next(books, None),) if b is not None], error_value, **kwargs)
+        books = tuple(books)
+        if not books:
+            return ans
+        chunk_size = -(-len(books) // max_workers)
+
+        def run(chunk):
+            formatter = self.__class__()
+            formatter.allow_python_templates = self.allow_python_templates
+            return formatter.safe_format_books(format_spec, chunk, error_value, **kwargs)
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            for result in executor.map(run, (books[i : i + chunk_size] for i in range(0, len(books), chunk_size))):
+                ans.update(result)
+        return ans
+
+
+# Builtin template functions whose result depends only on their arguments
+PURE_TEMPLATE_FUNCTIONS = frozenset(
+    '''
+    add and capitalize ceiling character cmp contains date_arithmetic days_between divide encode_for_url
+    first_matching_cmp first_non_empty floor format_date format_duration format_number fractional_part
+    human_readable identifier_in_list ifempty language_codes language_strings list_contains list_count
+    list_count_matching list_difference list_equals list_intersection list_item list_join list_re list_re_group
+    list_remove_duplicates list_sort list_split list_union lowercase make_url make_url_extended mod multiply not
+    or query_string range re re_group rating_to_stars round select shorten str_in_list strcat strcat_max strcmp
+    strcmpcase strlen sublist subitems substr subtract swap_around_articles swap_around_comma switch switch_if
+    test titlecase to_hex transliterate uppercase
+    '''.split()
+)
+
+
+def template_field_references(template, funcs=None):
+    """
+    Return the set of names of the fields used by the template, as written in
+    the template, or None if they cannot be determined without running the
+    template. That is the case for Python templates and for templates that
+    compute field names at run time, use other books or call functions that
+    read metadata themselves.
+    """
+    ff = formatter_functions()
+    funcs = ff.get_functions() if funcs is None else funcs
+    builtins = ff.get_builtins()
+    refs = set()
+
+    def walk(node):
+        if isinstance(node, (list, tuple)):
+            return all(walk(x) for x in node)
+        if not isinstance(node, Node):
+            return True
+        nt = node.node_type
+        if nt in (Node.NODE_FIELD, Node.NODE_RAW_FIELD, Node.NODE_LIST_COUNT_FIELD):
+            expression = node.expression
+            if isinstance(expression, list) and len(expression) == 1:
+                expression = expression[0]
+            if getattr(expression, 'node_type', None) != Node.NODE_CONSTANT:
+                return False
+            refs.add(expression.value.lower())
+            return walk(getattr(node, 'default', None))
+        if nt in (Node.NODE_FOR, Node.NODE_WITH, Node.NODE_CALL_STORED_TEMPLATE, Node.NODE_FSTRING):
+            return False
+        if nt == Node.NODE_FUNC and (node.name not in PURE_TEMPLATE_FUNCTIONS or funcs.get(node.name) is not builtins.get(node.name)):
+            return False
+        if getattr(node, 'operator', None) == 'inlist_field':
+            return False
+        return all(walk(v) for v in vars(node).values())
+
+    def program(text):
+        try:
+            tree = _Parser().program(TemplateFormatter(), funcs, cached_lex_scanner().scan(text))
+        except Exception:
+            return False
+        return walk(tree)
+
+    def single_function_mode(text):
+        try:
+            parsed = tuple(string.Formatter().parse(text))
+        except ValueError:
+            return False
+        for literal, field_name, format_spec, conversion in parsed:
+            if field_name is None:
+                continue
+            if field_name:
+                refs.add(field_name.lower())
+            if not format_spec:
+                continue
+            if '{' in format_spec and not single_function_mode(format_spec):
+                return False
+            m = TemplateFormatter.format_string_re.match(format_spec)
+            if m is not None:
+                format_spec = m.group(1)
+            p = 0 if format_spec.startswith("'") else format_spec.find(":'") + 1
+            if (p > 0 or format_spec.startswith("'")) and format_spec.endswith("'"):
+                if not program(format_spec[p + 1 : -1]):
+                    return False
+                continue
+            p = format_spec.find('(')
+            if p >= 0 and format_spec.endswith(')'):
+                fname = format_spec[format_spec.find(':', 0, p) + 1 : p].strip()
+                if fname not in PURE_TEMPLATE_FUNCTIONS or funcs.get(fname) is not builtins.get(fname):
+                    return False
+        return True
+
+    if template.startswith('python:'):
+        return None
+    ok = program(template[len('program:') :]) if template.startswith('program:') else single_function_mode(template)
+    return frozenset(refs) if ok else None
+
 
 class ValidateFormatter:
     """
@@ -2126,3 +2914,52 @@ def get_value(self, key, args, kwargs):
 
 # DEPRECATED. This is not thread safe. Do not use.
 eval_formatter = EvalFormatter()
+
+
+def benchmark(num_of_books=2000, repeat=5):
+    """
+    Compare the speed of interpreting template programs with running their
+    compiled form. Run with:
+
+    calibre-debug -c "from calibre.utils.formatter import benchmark; benchmark()"
+    """
+    from time import perf_counter
+
+    from calibre.ebooks.metadata.book.base import Metadata
+    from calibre.ebooks.metadata.book.formatter import SafeFormat
+
+    templates = (
+        "program: if $series then strcat($series, ' [', $series_index, ']') else $title fi",
+        "program: t = ''; for a in $authors: t = strcat(t, uppercase(a), ' & ') rof; re(t, ' & $', '')",
+        "program: if $#rating >=# 4 then 'good' elif $#rating >=# 2 then 'fine' else 'bad' fi",
+        "program: list_union(list_sort($tags, 0, ','), 'Fiction, Read', ',')",
+        "program: strcat(uppercase($title), ' - ', sublist($authors, 0, 1, '&'), test($series, strcat(' (', $series, ')'), ''))",
+    )
+    books = []
+    for i in range(num_of_books):
+        mi = Metadata(f'Title {i}', [f'Author {i}', 'Another Author'])
+        mi.series = f'Series {i % 7}' if i % 3 else None
+        mi.series_index = i % 10
+        mi.tags = [f'tag{i % 5}', 'Fiction']
+        mi.set_all_user_metadata({'#rating': {'datatype': 'rating', 'is_multiple': {}, 'kind': 'field', 'display': {}, '#value#': i % 6, 'label': 'rating'}})
+        books.append(mi)
+
+    def run(template, compiled):
+        formatter = SafeFormat()
+        kwargs = {'column_name': 'benchmark', 'template_cache': {}}
+        formatter.safe_format(template, books[0], 'TEMPLATE ERROR', books[0], **kwargs)
+        if not compiled:
+            # Keep the cached parse tree but make the interpreter run it
+            kwargs['template_cache']['benchmark::compiled'] = kwargs['template_cache']['benchmark'], None
+        best = float('inf')
+        for r in range(repeat):
+            st = perf_counter()
+            for mi in books:
+                formatter.safe_format(template, mi, 'TEMPLATE ERROR', mi, **kwargs)
+            best = min(best, perf_counter() - st)
+        return best
+
+    for template in templates:
+        interpreted, compiled = run(template, False), run(template, True)
+        print(template)
+        print(f'  interpreted: {interpreted:.4f}s compiled: {compiled:.4f}s speedup: {interpreted / compiled:.2f}x')